@@ -1,5 +1,9 @@
 from flask import Flask
+from utils.json_provider import MongoJSONProvider
 
 app = Flask(__name__)
+app.json = MongoJSONProvider(app)
 
-from app import views
+# metrics is imported before compression, its after_request hook runs
+# last and sees the compressed response
+from app import views, debug, commands, metrics, compression
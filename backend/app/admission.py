@@ -0,0 +1,133 @@
+"""
+Admitted Read Endpoints
+
+Decorator applying the admission control of the worker
+('utils.admission') to a read endpoint. It is applied inside
+cached_response, so cached responses and 304 Not Modified answers are
+served without waiting for a slot; only requests running the
+aggregation are limited.
+
+A rejected request is answered by handle_exception:
+
+    HTTP/1.1 503 SERVICE UNAVAILABLE
+    Retry-After: 1
+
+    {
+        "code": 503,
+        "name": "Service Unavailable",
+        "description": "Too many concurrent requests of /groups, ..."
+    }
+"""
+
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from flask import request, make_response
+from werkzeug.exceptions import ServiceUnavailable
+from utils import metrics
+from utils.admission import AdmissionController
+from config.config import (ADMISSION_CONTROL_ENABLED,
+                           ADMISSION_LIMITS,
+                           ADMISSION_QUEUE_SIZE,
+                           ADMISSION_QUEUE_TIMEOUT,
+                           ADMISSION_MAX_THREADS,
+                           ADMISSION_RETRY_AFTER,
+                           )
+
+admission = None
+if ADMISSION_CONTROL_ENABLED:
+    admission = AdmissionController(ADMISSION_LIMITS,
+                                    ADMISSION_QUEUE_SIZE,
+                                    ADMISSION_QUEUE_TIMEOUT,
+                                    ADMISSION_MAX_THREADS)
+
+
+class StreamSlot:
+    """
+    Frees the slot of a request with a streamed response once, after
+    the last chunk was sent or when the server closes the response
+    (e.g. the client disconnected before).
+    """
+
+    def __init__(self, route):
+        self.route = route
+        self._released = False
+        self._lock = threading.Lock()
+
+    def release(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        admission.release(self.route)
+
+    def wrap(self, chunks):
+        try:
+            yield from chunks
+        finally:
+            self.release()
+
+
+def reject(route, reason):
+    """
+    Count a rejected request of a route and raise its 503 Service
+    Unavailable.
+    """
+    if metrics.ENABLED:
+        metrics.REQUESTS_SHED.labels(route, reason).inc()
+    raise ServiceUnavailable(
+        f"Too many concurrent requests of {route}, "
+        f"retry in {ADMISSION_RETRY_AFTER} s",
+        retry_after=ADMISSION_RETRY_AFTER)
+
+
+@contextmanager
+def waiting_thread():
+    """
+    Account for the thread of a request waiting for an identical request
+    in flight ('app.single_flight'). It takes no slot of its route, but
+    counts against ADMISSION_MAX_THREADS like a queued request; when they
+    are occupied the request is rejected with 503 Service Unavailable.
+    """
+    if admission is None:
+        yield
+        return
+    if not admission.follow():
+        reject(request.url_rule.rule, 'threads')
+    try:
+        yield
+    finally:
+        admission.unfollow()
+
+
+def admission_controlled(view):
+    """
+    Limit the concurrent requests of the view's route, requests that get
+    no slot are rejected with 503 Service Unavailable.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        route = request.url_rule.rule
+        if admission is None or not admission.limited(route):
+            return view(*args, **kwargs)
+
+        reason, waited = admission.acquire(route)
+        if metrics.ENABLED:
+            metrics.ADMISSION_WAIT.labels(route).observe(waited)
+        if reason:
+            reject(route, reason)
+
+        try:
+            response = make_response(view(*args, **kwargs))
+        except BaseException:
+            admission.release(route)
+            raise
+        if response.is_streamed:
+            slot = StreamSlot(route)
+            response.response = slot.wrap(response.response)
+            response.call_on_close(slot.release)
+        else:
+            admission.release(route)
+        return response
+
+    return wrapper
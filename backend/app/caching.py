@@ -0,0 +1,213 @@
+"""
+Cached Read Endpoints
+
+Decorator caching successful responses of read endpoints in two levels:
+- the per-worker ResponseCache ('utils.cache'),
+- the SharedResponseCache ('utils.shared_cache') shared by all workers of
+the host.
+Responses are keyed by the route, the normalized query arguments and the
+data version ('models.counters'), so a response cached before a write is
+never served after it, even for writes that do not call
+invalidate_responses() (other services, the async application). Both
+levels also use the generation stored in the shared cache file:
+invalidate_responses() drops the cached responses of all workers, which
+frees their memory at once.
+
+Configuration (see 'config.config'):
+- RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAXSIZE and
+RESPONSE_CACHE_MAX_BYTES,
+- SHARED_CACHE_ENABLED, SHARED_CACHE_PATH, SHARED_CACHE_SLOTS and
+SHARED_CACHE_SLOT_SIZE.
+
+Responses are compressed ('app.compression') before they are cached and
+the negotiated encoding is part of the key, so a cached response is not
+compressed again on every hit.
+
+The conditional_response decorator adds ETags derived from the data
+version ('models.counters'), so unchanged data is answered with
+304 Not Modified without running the view.
+
+Requests with the consistency token of a write ('app.routing') are not
+served from the cache: a response cached after the write may have been
+read from a secondary that did not have it yet.
+"""
+
+import json
+from functools import wraps
+from flask import g, request, make_response
+from models.counters import get_data_version
+from utils.json_provider import negotiated_format
+from utils.serializers import JSON_MIMETYPE
+from app.routing import request_reads, has_consistency_token
+from app.compression import (compress_response, negotiated_encoding,
+                             encoded_etag, encoded_etags)
+from utils.cache import ResponseCache
+from utils.shared_cache import open_shared_file, SharedResponseCache
+from config.config import (RESPONSE_CACHE_ENABLED,
+                           RESPONSE_CACHE_TTL,
+                           RESPONSE_CACHE_MAXSIZE,
+                           RESPONSE_CACHE_MAX_BYTES,
+                           SHARED_CACHE_ENABLED,
+                           SHARED_CACHE_PATH,
+                           SHARED_CACHE_SLOTS,
+                           SHARED_CACHE_SLOT_SIZE,
+                           )
+
+# response headers stored together with the body
+CACHED_HEADERS = ('Content-Type', 'Content-Encoding', 'Vary',
+                  'X-Next-Cursor')
+
+shared_cache = None
+if SHARED_CACHE_ENABLED:
+    shared_file = open_shared_file(SHARED_CACHE_PATH,
+                                   SHARED_CACHE_SLOTS,
+                                   SHARED_CACHE_SLOT_SIZE)
+    if shared_file is not None:
+        shared_cache = SharedResponseCache(shared_file, RESPONSE_CACHE_TTL)
+
+response_cache = ResponseCache(
+    RESPONSE_CACHE_MAXSIZE,
+    RESPONSE_CACHE_MAX_BYTES,
+    RESPONSE_CACHE_TTL,
+    generation=shared_cache.generation if shared_cache else None)
+
+
+def pack_response(body, headers):
+    """
+    Serialize a response body and its headers for the shared cache.
+    """
+    return json.dumps(headers).encode('utf-8') + b'\n' + body
+
+
+def unpack_response(value):
+    """
+    Reverse pack_response.
+
+    Returns:
+        tuple: (body, headers)
+    """
+    headers, body = value.split(b'\n', 1)
+    return body, json.loads(headers)
+
+
+def request_cache_key():
+    """
+    Cache key of the current request: the path, the query arguments
+    sorted by name (arguments without a value are ignored), the
+    negotiated format and content coding.
+    """
+    args = tuple(sorted((name, value)
+                        for name, value in request.args.items(multi=True)
+                        if value))
+    return (request.path, args, negotiated_format(), negotiated_encoding())
+
+
+def cached_response(view):
+    """
+    Serve the view from the response cache when possible.
+
+    Only complete (not streamed) 200 responses are cached, they are
+    compressed first. Responses get an 'X-Cache' header with 'HIT' or
+    'MISS'.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not RESPONSE_CACHE_ENABLED or has_consistency_token():
+            return view(*args, **kwargs)
+
+        key = request_cache_key() + (request_data_version(),)
+        cached = response_cache.get(key)
+        if cached is None and shared_cache is not None:
+            shared = shared_cache.get(key)
+            if shared is not None:
+                cached = unpack_response(shared)
+                response_cache.set(key, cached, len(cached[0]),
+                                   response_cache.generation.value)
+        if cached is not None:
+            body, headers = cached
+            response = make_response(body, 200, headers)
+            response.headers['X-Cache'] = 'HIT'
+            return response
+
+        generation = response_cache.generation.value
+        response = compress_response(make_response(view(*args, **kwargs)))
+        if response.status_code == 200 and not response.is_streamed:
+            body = response.get_data()
+            headers = {name: response.headers[name]
+                       for name in CACHED_HEADERS if name in response.headers}
+            response_cache.set(key, (body, headers), len(body), generation)
+            if shared_cache is not None:
+                shared_cache.set(key, pack_response(body, headers),
+                                 generation)
+        response.headers['X-Cache'] = 'MISS'
+        return response
+
+    return wrapper
+
+
+def request_data_version():
+    """
+    Data version of the current request, read once: conditional_response
+    and cached_response use the same version.
+    """
+    version = g.get('data_version')
+    if version is None:
+        # read in the session of the request, before the body
+        version = g.data_version = get_data_version(request_reads())
+    return version
+
+
+def invalidate_responses():
+    """
+    Drop all cached responses of all workers, call it after every
+    image write.
+    """
+    response_cache.invalidate()
+
+
+def conditional_response(cache_control, etag_suffix=None):
+    """
+    Answer conditional GET requests of a read endpoint.
+
+    The strong ETag of a response is the data version read before the
+    view runs, so it never claims newer data than the body holds, with
+    the format appended for binary formats (e.g. "42-msgpack") and the
+    content coding appended for compressed responses. If the
+    request has an If-None-Match header matching any representation,
+    304 Not Modified is returned without running the view.
+
+    Args:
+        cache_control (str): Value of the Cache-Control header.
+        etag_suffix (callable, optional): Function returning a string
+            that is added to the ETag, for responses that also change
+            without writes (e.g. with the current day).
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            etag = str(request_data_version())
+            if etag_suffix:
+                etag = f"{etag}-{etag_suffix()}"
+            mimetype = negotiated_format()
+            if mimetype != JSON_MIMETYPE:
+                etag = f"{etag}-{mimetype.split('/')[1]}"
+
+            matched = [tag for tag in encoded_etags(etag)
+                       if request.if_none_match.contains_weak(tag)]
+            if matched:
+                response = make_response('', 304)
+                etag = matched[0]
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                encoding = response.headers.get('Content-Encoding')
+                if encoding:
+                    etag = encoded_etag(etag, encoding)
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = cache_control
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,113 @@
+"""
+Flask CLI Commands
+
+Maintenance commands of the service. Run them from the backend directory:
+
+    flask --app run <command>
+"""
+
+import sys
+import click
+from app import app
+from models.models import check_server_version
+from models.counters import rebuild_counters
+from models.statistics import rebuild_daily_statistics
+from models.indexes import migrate_indexes, verify_indexes, index_usage
+
+
+@app.cli.command('rebuild-counters')
+@click.option('--dry-run', is_flag=True,
+              help='Only report the drift, do not fix the counters.')
+def rebuild_counters_command(dry_run):
+    """
+    Rebuild the image counters from the images collection and report
+    every counter that drifted.
+
+    With --dry-run the command exits with status 1 when there is drift,
+    so it can be used as a periodic check.
+    """
+    drift = rebuild_counters(dry_run=dry_run)
+    for counter_id, status, stored, actual in drift:
+        click.echo(f"{counter_id} {status}: stored {stored}, actual {actual}")
+    if dry_run:
+        click.echo(f"{len(drift)} counters drifted")
+        if drift:
+            sys.exit(1)
+    else:
+        click.echo(f"{len(drift)} counters drifted and were fixed")
+
+
+@app.cli.command('rebuild-statistics')
+@click.option('--dry-run', is_flag=True,
+              help='Only report the drift, do not roll the days up.')
+def rebuild_statistics_command(dry_run):
+    """
+    Roll up the daily statistics again from the images collection,
+    e.g. after images were imported into past days, and report every
+    count of a sealed day that drifted. Run it once after the images
+    were loaded, it seals the past days and the requests seal the
+    following ones.
+
+    With --dry-run the command exits with status 1 when there is drift,
+    so it can be used as a periodic check.
+    """
+    drift = rebuild_daily_statistics(dry_run=dry_run)
+    for day, status, stored, actual in drift:
+        click.echo(f"{day:%Y-%m-%d} {status}: stored {stored}, "
+                   f"actual {actual}")
+    if dry_run:
+        click.echo(f"{len(drift)} daily counts drifted")
+        if drift:
+            sys.exit(1)
+    else:
+        click.echo(f"{len(drift)} daily counts drifted and were fixed")
+
+
+@app.cli.command('migrate-indexes')
+@click.option('--dry-run', is_flag=True,
+              help='Only report the indexes that would be changed.')
+@click.option('--force', is_flag=True,
+              help='Apply the migrations that were already applied again.')
+def migrate_indexes_command(dry_run, force):
+    """
+    Create and drop indexes by applying the index migrations that were
+    not applied yet ('models.indexes').
+    """
+    try:
+        check_server_version()
+    except RuntimeError as err:
+        click.echo(str(err), err=True)
+        sys.exit(1)
+    results = migrate_indexes(dry_run=dry_run, force=force)
+    for version, actions in results:
+        click.echo(f"migration {version}: {len(actions)} changes")
+        for action, collection, index in actions:
+            click.echo(f"  {action} {collection}.{index}")
+    if not results:
+        click.echo("indexes are up to date")
+    missing = [] if dry_run else verify_indexes()
+    for collection, index in missing:
+        click.echo(f"missing {collection}.{index}")
+    if missing:
+        sys.exit(1)
+
+
+@app.cli.command('index-usage')
+@click.option('--unused', is_flag=True,
+              help='Only list indexes that were never used.')
+def index_usage_command(unused):
+    """
+    Report how often every index was used since the server started
+    ($indexStats). With --unused the command exits with status 1 when
+    an index other than _id was never used.
+    """
+    usage = index_usage()
+    never_used = [index for index in usage
+                  if index['ops'] == 0 and index['name'] != '_id_']
+    for index in never_used if unused else usage:
+        click.echo(f"{index['collection']}.{index['name']}: "
+                   f"{index['ops']} ops since {index['since']:%Y-%m-%d %H:%M}")
+    if unused:
+        click.echo(f"{len(never_used)} indexes were never used")
+        if never_used:
+            sys.exit(1)
@@ -0,0 +1,112 @@
+"""
+Compressed Responses
+
+Compresses the responses of the application for clients that accept gzip
+or brotli ('utils.compression'). Complete bodies are compressed when they
+are at least COMPRESSION_MIN_SIZE bytes long, streamed bodies (e.g.
+/groups?stream=true) are always compressed chunk by chunk.
+
+Cached read endpoints compress the response before it is stored
+('app.caching'), so a cached response is not compressed again on every
+hit. Responses that already have a Content-Encoding are left unchanged.
+A compressed response gets its own ETag, the ETag of the uncompressed
+response with the encoding appended.
+
+Configuration (see 'config.config'):
+- COMPRESSION_ENABLED, COMPRESSION_MIN_SIZE, COMPRESSION_MIMETYPES,
+- COMPRESSION_GZIP_LEVEL and COMPRESSION_BROTLI_QUALITY.
+"""
+
+from flask import request
+from app import app
+from utils.compression import (available_encodings, negotiate_encoding,
+                               compress, compress_chunks)
+from config.config import (COMPRESSION_ENABLED,
+                           COMPRESSION_MIN_SIZE,
+                           COMPRESSION_MIMETYPES,
+                           COMPRESSION_GZIP_LEVEL,
+                           COMPRESSION_BROTLI_QUALITY,
+                           )
+
+COMPRESSION_LEVELS = {
+    'gzip': COMPRESSION_GZIP_LEVEL,
+    'br': COMPRESSION_BROTLI_QUALITY,
+}
+
+
+def negotiated_encoding():
+    """
+    Content coding of the response to the current request.
+
+    Returns:
+        str: 'br' or 'gzip', or None if the response is not compressed.
+    """
+    if not COMPRESSION_ENABLED:
+        return None
+    return negotiate_encoding(request.accept_encodings)
+
+
+def encoded_etags(etag):
+    """
+    ETags of all representations of a response.
+
+    Args:
+        etag (str): ETag of the uncompressed response.
+
+    Returns:
+        list: The ETag followed by the ETags of the compressed responses.
+    """
+    return [etag] + [encoded_etag(etag, encoding)
+                     for encoding in available_encodings()]
+
+
+def encoded_etag(etag, encoding):
+    """
+    ETag of a response compressed with an encoding.
+    """
+    return f"{etag}-{encoding}"
+
+
+@app.after_request
+def compress_response(response):
+    """
+    Compress a response with the encoding accepted by the client.
+
+    Args:
+        response (Response): Response of the current request.
+
+    Returns:
+        Response: The same response, compressed if it has a compressible
+        mimetype, is large enough (or streamed) and the client accepts
+        a supported encoding. Its ETag, if any, is replaced with the ETag
+        of the compressed representation.
+    """
+    if (not COMPRESSION_ENABLED
+            or response.mimetype not in COMPRESSION_MIMETYPES
+            or response.direct_passthrough):
+        return response
+    response.vary.add('Accept-Encoding')
+    if ('Content-Encoding' in response.headers
+            or response.status_code < 200
+            or response.status_code in (204, 304)):
+        return response
+
+    encoding = negotiated_encoding()
+    if encoding is None:
+        return response
+    level = COMPRESSION_LEVELS[encoding]
+    if response.is_streamed:
+        response.response = compress_chunks(response.response,
+                                            encoding, level)
+        response.headers.pop('Content-Length', None)
+    else:
+        body = response.get_data()
+        if len(body) < COMPRESSION_MIN_SIZE:
+            return response
+        response.set_data(compress(body, encoding, level))
+    response.headers['Content-Encoding'] = encoding
+
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(encoded_etag(etag, encoding), weak)
+    return response
@@ -0,0 +1,178 @@
+"""
+Debug Endpoints
+
+Read-only endpoints exposing internal counters of the worker that
+serves the request, for tuning and troubleshooting.
+"""
+
+from flask import jsonify
+from app import app
+from app.caching import response_cache, shared_cache
+from models.profiler import profiler
+from app.views import write_coalescer
+from app.admission import admission
+from app.single_flight import flights
+
+
+@app.route('/debug/cache', methods=['GET'])
+def get_cache_stats():
+    """
+    Endpoint returning the counters of the response caches of the worker.
+
+    Route:
+        /debug/cache
+
+    Response:
+        {
+            "local": {
+                "entries": 12,
+                "bytes": 1048576,
+                "generation": 3,
+                "hits": 120,
+                "misses": 15,
+                "evictions": 0,
+                "invalidations": 3
+            },
+            "shared": {
+                "hits": 10,
+                "misses": 5,
+                "stores": 5,
+                "replacements": 0,
+                "generation": 3
+            }
+        }
+    """
+    return jsonify({
+        'local': response_cache.stats(),
+        'shared': shared_cache.stats() if shared_cache else None,
+    }), 200
+
+
+@app.route('/debug/slow-queries', methods=['GET'])
+def get_slow_queries():
+    """
+    Endpoint returning the slow aggregations recorded by the profiler of
+    the worker ('models.profiler'), the newest first.
+
+    Route:
+        /debug/slow-queries
+
+    Response:
+        {
+            "slow_ms": 500.0,
+            "sample_rate": 0.1,
+            "slow": 12,
+            "explained": 2,
+            "skipped": 10,
+            "failed": 0,
+            "entries": [
+                {
+                    "name": "groups",
+                    "collection": "groups",
+                    "duration_ms": 812.4,
+                    "at": "2023-09-18T12:00:00Z",
+                    "pipeline": [...],
+                    "plan": {
+                        "plan_stages": ["IXSCAN", "FETCH"],
+                        "pipeline_stages": ["$cursor", "$lookup"],
+                        "keys_examined": 120,
+                        "docs_examined": 5120,
+                        "returned": 50,
+                        "execution_ms": 790,
+                        "collection_scan": false,
+                        "in_memory_sort": false,
+                        "used_disk": false,
+                        "lookups": [...]
+                    }
+                }
+            ]
+        }
+
+        null if the profiler is disabled.
+    """
+    return jsonify(profiler.stats()), 200
+
+
+@app.route('/debug/write-queue', methods=['GET'])
+def get_write_queue_stats():
+    """
+    Endpoint returning the counters of the write coalescing queue of the
+    worker ('models.write_queue').
+
+    Route:
+        /debug/write-queue
+
+    Response:
+        {
+            "max_batch": 500,
+            "interval": 0.2,
+            "pending": 12,
+            "accepted": 1520,
+            "coalesced": 310,
+            "rejected": 0,
+            "batches": 48,
+            "written": 1198,
+            "retried": 0,
+            "failed": 0
+        }
+
+        null if write coalescing is disabled.
+    """
+    return jsonify(write_coalescer.stats() if write_coalescer else None), 200
+
+
+@app.route('/debug/admission', methods=['GET'])
+def get_admission_stats():
+    """
+    Endpoint returning the counters of the admission control of the
+    worker ('utils.admission'), for tuning the limits.
+
+    Route:
+        /debug/admission
+
+    Response:
+        {
+            "queue_size": 2,
+            "queue_timeout": 0.5,
+            "max_threads": 3,
+            "occupied": 2,
+            "routes": {
+                "/groups": {
+                    "limit": 2,
+                    "running": 2,
+                    "waiting": 0,
+                    "admitted": 1520,
+                    "queued": 210,
+                    "shed": {"queue_full": 12, "timeout": 3, "threads": 0}
+                },
+                "/statistics": {...}
+            }
+        }
+
+        null if admission control is disabled.
+    """
+    return jsonify(admission.stats() if admission else None), 200
+
+
+@app.route('/debug/single-flight', methods=['GET'])
+def get_single_flight_stats():
+    """
+    Endpoint returning the counters of the deduplication of identical
+    concurrent read requests of the worker ('app.single_flight').
+
+    Route:
+        /debug/single-flight
+
+    Response:
+        {
+            "timeout": 10.0,
+            "in_flight": 1,
+            "leaders": 820,
+            "followers": 2310,
+            "timeouts": 0,
+            "errors": 2
+        }
+
+        null if single-flight is disabled.
+    """
+    return jsonify(flights.stats() if flights else None), 200
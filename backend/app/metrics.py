@@ -0,0 +1,109 @@
+"""
+Request Metrics
+
+Records the latency, the number of requests in progress and the response
+size of every request ('utils.metrics') and serves all metrics of the
+service in the Prometheus text format at /metrics.
+
+Requests are labeled with their route (e.g. '/groups/<group_id>/images')
+instead of the path, so the number of series stays bounded; requests
+that match no route are labeled 'unmatched'. A streamed response is
+measured when its last chunk was sent.
+"""
+
+import time
+from flask import Response, g, request
+from werkzeug.exceptions import NotFound
+from app import app
+from utils import metrics
+
+
+def request_labels():
+    """
+    Method and route labels of the current request.
+    """
+    rule = request.url_rule
+    return request.method, rule.rule if rule else 'unmatched'
+
+
+def observe_request(started, labels, status, size):
+    """
+    Record a finished request.
+    """
+    metrics.REQUEST_DURATION.labels(*labels, str(status)).observe(
+        time.perf_counter() - started)
+    metrics.RESPONSE_SIZE.labels(*labels).observe(size)
+    metrics.REQUESTS_IN_PROGRESS.labels(*labels).dec()
+
+
+def observe_stream(chunks, started, labels, status):
+    """
+    Pass the chunks of a streamed response through and record the
+    request when the stream is closed.
+    """
+    size = 0
+    try:
+        for chunk in chunks:
+            size += len(chunk)
+            yield chunk
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+        observe_request(started, labels, status, size)
+
+
+if metrics.ENABLED:
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_started = time.perf_counter()
+        g.metrics_labels = request_labels()
+        metrics.REQUESTS_IN_PROGRESS.labels(*g.metrics_labels).inc()
+
+    @app.after_request
+    def record_request_metrics(response):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return response
+        labels = g.pop('metrics_labels')
+        if response.is_streamed:
+            response.response = observe_stream(response.response, started,
+                                               labels, response.status_code)
+        else:
+            observe_request(started, labels, response.status_code,
+                            response.content_length or 0)
+        return response
+
+    @app.teardown_request
+    def end_request_metrics(exc):
+        # the request failed before after_request
+        if g.pop('metrics_started', None) is not None:
+            metrics.REQUESTS_IN_PROGRESS.labels(
+                *g.pop('metrics_labels')).dec()
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Endpoint returning the metrics of the service.
+
+    Route:
+        /metrics
+
+    Response:
+        The metrics in the Prometheus text format, aggregated over all
+        gunicorn workers when PROMETHEUS_MULTIPROC_DIR is set:
+
+        # HELP http_request_duration_seconds Time spent serving HTTP requests.
+        # TYPE http_request_duration_seconds histogram
+        http_request_duration_seconds_bucket{le="0.005",method="GET",route="/groups",status="200"} 12.0
+        ...
+
+    Raises:
+        NotFound: If metrics are disabled or prometheus_client is not
+            installed.
+    """
+    if not metrics.ENABLED:
+        raise NotFound("Metrics are disabled")
+    data, content_type = metrics.render()
+    return Response(data, content_type=content_type)
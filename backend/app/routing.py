@@ -0,0 +1,148 @@
+"""
+Read Routing
+
+Read preference of the requests by route (READ_PREFERENCES). The
+analytics routes /groups, /groups/<group_id>/images and /statistics read
+from secondaries by default (secondaryPreferred), from members lagging
+at most READ_MAX_STALENESS_SECONDS behind the primary, so their
+aggregations do not compete with the status writes. The other routes and
+all writes use the primary.
+
+On a replica set the reads of a request are made in one causally
+consistent session ('models.models.Reads'). The data version of the
+ETag is read first, so the body is never older than its ETag even when
+another secondary answers.
+
+Writes return the consistency token of their session:
+
+    HTTP/1.1 200 OK
+    X-Consistency-Token: HAAAABFvcGVyYXRpb25UaW1lAAEAAAA...
+
+A client sending the token with its next reads sees its own write: the
+session of the read is advanced to the token, a secondary answers only
+once it has replicated the write. Requests with a token bypass the
+response cache and single-flight, which may hold responses read before
+the write.
+
+The token carries only the operation time of the write. It is checked
+against the cluster time before the session is advanced: a malformed
+token, a token from the future and a token the server rejects are
+answered with 400 Bad Request.
+
+Standalone servers have no secondaries, requests get no session there
+and tokens are ignored.
+
+Configuration (see 'config.config'):
+- READ_PREFERENCES (READ_PREFERENCE_GROUPS, READ_PREFERENCE_STATISTICS)
+  and READ_MAX_STALENESS_SECONDS.
+"""
+
+from contextlib import contextmanager
+from flask import g, request
+from pymongo.errors import OperationFailure
+from app import app
+from models.models import (Reads, read_preference, causal_session,
+                           advance_session, session_token)
+from utils.validators import ValidationError
+from config.config import READ_PREFERENCES, READ_MAX_STALENESS_SECONDS
+
+TOKEN_HEADER = 'X-Consistency-Token'
+# errors of a read whose afterClusterTime the server does not accept
+# (InvalidOptions: newer than the cluster time of the server)
+TOKEN_REJECTED_CODES = (72,)
+
+ROUTE_READ_PREFERENCES = {
+    route: read_preference(mode, READ_MAX_STALENESS_SECONDS)
+    for route, mode in READ_PREFERENCES.items()
+}
+
+
+def has_consistency_token():
+    """
+    Whether the client sent the consistency token of a write.
+    """
+    return bool(request.headers.get(TOKEN_HEADER))
+
+
+def request_reads():
+    """
+    Reads of the current request, created on first use.
+
+    Returns:
+        Reads: Read preference of the route and session of the request.
+
+    Raises:
+        ValidationError: If the consistency token is malformed, newer
+            than the cluster time or rejected by the server.
+    """
+    reads = g.get('reads')
+    if reads is None:
+        rule = request.url_rule
+        preference = ROUTE_READ_PREFERENCES.get(rule.rule) if rule else None
+        reads = g.reads = Reads(preference, causal_session())
+        token = request.headers.get(TOKEN_HEADER)
+        if reads.session is not None and token:
+            try:
+                advance_session(reads.session, token)
+            except (ValueError, OperationFailure) as err:
+                raise ValidationError("Invalid consistency token", str(err))
+    return reads
+
+
+@app.errorhandler(OperationFailure)
+def handle_rejected_token(err):
+    """
+    Answer a read the server rejected because of the consistency token
+    with 400 Bad Request, other database errors stay 500.
+    """
+    if not has_consistency_token() or err.code not in TOKEN_REJECTED_CODES:
+        raise err
+    return app.handle_http_exception(
+        ValidationError("Invalid consistency token", str(err)))
+
+
+@contextmanager
+def write_session():
+    """
+    Causally consistent session of the writes of a request, None on a
+    standalone server.
+    """
+    session = causal_session()
+    try:
+        yield session
+    finally:
+        if session is not None:
+            session.end_session()
+
+
+def set_consistency_token(response, session):
+    """
+    Send the consistency token of a write session with a response.
+
+    Returns:
+        Response: The response.
+    """
+    token = session_token(session)
+    if token:
+        response.headers[TOKEN_HEADER] = token
+    return response
+
+
+@app.after_request
+def end_read_session(response):
+    reads = g.pop('reads', None)
+    if reads is not None and reads.session is not None:
+        if response.is_streamed:
+            # the cursor of a streamed response reads until it is sent
+            response.call_on_close(reads.session.end_session)
+        else:
+            reads.session.end_session()
+    return response
+
+
+@app.teardown_request
+def end_failed_read_session(exc):
+    # the request failed before after_request
+    reads = g.pop('reads', None)
+    if reads is not None and reads.session is not None:
+        reads.session.end_session()
@@ -0,0 +1,71 @@
+"""
+Single-Flight Read Endpoints
+
+Decorator deduplicating identical concurrent requests of a read endpoint
+in a worker ('utils.single_flight'). When a dashboard refresh sends the
+same GET /groups?status=review many times at once, the first request
+runs the aggregation and the others wait for it and answer with a copy
+of its response.
+
+Requests are identical when they have the same path, the same query
+arguments (sorted, empty ones ignored, see 'app.caching') and the same
+negotiated format. The cache generation is part of the key, so a request
+that arrives after an image write does not join a request that started
+before it. Errors of the first request (e.g. 400 for invalid arguments)
+are raised in all the waiting requests. Streamed responses can not be
+shared, requests waiting for one run the view themselves. Requests with
+a consistency token ('app.routing') run the view themselves as well.
+
+The decorator is applied inside cached_response and outside
+admission_controlled: waiting requests take no slot of their route, and
+the response cache stores the response once. A waiting request still
+holds a thread of the worker, so it counts against ADMISSION_MAX_THREADS
+('app.admission.waiting_thread') and is rejected with 503 when the
+limited requests occupy them, leaving threads for the status updates.
+
+Configuration (see 'config.config'):
+- SINGLE_FLIGHT_ENABLED and SINGLE_FLIGHT_TIMEOUT.
+"""
+
+from functools import wraps
+from flask import make_response
+from app.admission import waiting_thread
+from app.caching import request_cache_key, response_cache
+from app.routing import has_consistency_token
+from utils.single_flight import SingleFlight
+from config.config import SINGLE_FLIGHT_ENABLED, SINGLE_FLIGHT_TIMEOUT
+
+flights = SingleFlight(SINGLE_FLIGHT_TIMEOUT) if SINGLE_FLIGHT_ENABLED \
+    else None
+
+
+def single_flight(view):
+    """
+    Share the response of the view between identical concurrent
+    requests.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if flights is None or has_consistency_token():
+            return view(*args, **kwargs)
+
+        def run():
+            response = make_response(view(*args, **kwargs))
+            if response.is_streamed:
+                return response, None
+            return response, (response.get_data(), response.status_code,
+                              list(response.headers.items()))
+
+        # path, arguments and format, the encoding is negotiated later
+        path, query, format_ = request_cache_key()[:3]
+        key = (path, query, format_, response_cache.generation.value)
+        (response, shared), is_follower = flights.do(key, run,
+                                                     waiting_thread())
+        if not is_follower:
+            return response
+        if shared is None:
+            return view(*args, **kwargs)
+        body, status, headers = shared
+        return make_response(body, status, headers)
+
+    return wrapper
@@ -1,39 +1,130 @@
 from app import app
-from flask import request, jsonify
-from markupsafe import escape
-from datetime import datetime, timedelta
-from bson import ObjectId
-from bson.errors import InvalidId
-from werkzeug.exceptions import HTTPException
+from flask import request, jsonify, Response, url_for
+from datetime import datetime, timezone
+from werkzeug.exceptions import HTTPException, NotFound
 import json
-from utils.utils import sanitize_json
+from utils.utils import encode_cursor
+from utils.json_provider import negotiated_format
+from utils.serializers import JSON_MIMETYPE
+from utils.validators import (ValidationError, parse_object_id,
+                              parse_status, parse_limit, parse_cursor,
+                              parse_flag, parse_fields, parse_period,
+                              parse_choice)
+from app.caching import (cached_response, invalidate_responses,
+                         conditional_response)
+from app.admission import admission_controlled
+from app.single_flight import single_flight
+from app.routing import (request_reads, write_session,
+                         set_consistency_token)
 from models.models import images_collection, groups_collection
-from config.config import (VALID_STATUSES, STATISTIC_NUMBER_OF_DAYS)
+from models.pipelines import (groups_pipeline, add_images_next,
+                              images_projection, IMAGES_SORT)
+from models.images import set_image_status, set_image_statuses
+from models.profiler import profiler
+from models.write_queue import WriteCoalescer, find_update
+from models.counters import counters_collection, GLOBAL_COUNTER_ID
+from models.statistics import (get_daily_statistics, total_statistics,
+                               bucket_statistics)
+from config.config import (STATISTIC_NUMBER_OF_DAYS,
+                           STATISTIC_MAX_NUMBER_OF_DAYS,
+                           STATISTIC_GRANULARITIES,
+                           CACHE_CONTROL_GROUPS, CACHE_CONTROL_STATISTICS,
+                           BULK_UPDATE_MAX_ITEMS,
+                           WRITE_COALESCING_ENABLED,
+                           WRITE_COALESCING_MAX_BATCH,
+                           WRITE_COALESCING_INTERVAL,
+                           WRITE_COALESCING_MAX_PENDING,
+                           WRITE_COALESCING_MAX_ATTEMPTS,
+                           WRITE_COALESCING_RESULT_TTL,
+                           GROUPS_PAGE_DEFAULT_LIMIT, GROUPS_PAGE_MAX_LIMIT,
+                           GROUP_IMAGES_DEFAULT_LIMIT, GROUP_IMAGES_MAX_LIMIT,
+                           GROUPS_STREAM_DEFAULT, GROUPS_STREAM_BATCH_SIZE,
+                           IMAGE_FIELDS, IMAGE_FIELD_PROFILES,
+                           IMAGE_FIELDS_DEFAULT,
+                           )
+
+
+def write_queued_statuses(updates):
+    """
+    Write a batch of the write coalescing queue and drop the cached
+    responses if an image changed.
+    """
+    results = set_image_statuses(updates)
+    if 'updated' in results.values():
+        invalidate_responses()
+    return results
+
+
+# queue of PUT /images/<image_id> in write coalescing mode, the
+# worker_exit hook of gunicorn_config.py writes it when a worker stops
+write_coalescer = None
+if WRITE_COALESCING_ENABLED:
+    write_coalescer = WriteCoalescer(write_queued_statuses,
+                                     WRITE_COALESCING_MAX_BATCH,
+                                     WRITE_COALESCING_INTERVAL,
+                                     WRITE_COALESCING_MAX_PENDING,
+                                     WRITE_COALESCING_MAX_ATTEMPTS)
 
 
 @app.route('/groups', methods=['GET'])
+@conditional_response(CACHE_CONTROL_GROUPS)
+@cached_response
+@single_flight
+@admission_controlled
 def get_groups_with_images():
     """
-    Endpoint for retrieving a list of groups with associated images.
+    Endpoint for retrieving a page of groups with associated images.
 
     This endpoint performs the following actions:
-    1. Joins the 'groups' collection with the 'images' collection based on the
-      'group_id' field.
-    2. Sorts and filters the list of images, if necessary.
-    3. Groups the images by their associated group and counts them.
+    1. Selects the next page of groups ordered by their '_id', starting
+      after the 'after' cursor.
+    2. Joins the selected groups with the 'images' collection based on the
+      'group_id' field. Filtering by status, sorting by creation date and
+      capping the number of images happen inside the join on the
+      (group_id, status, created_at) index.
+    3. Counts the images of every group.
     4. Returns a JSON response with the grouped data.
 
     Args:
         None
 
+    Query Parameters:
+        status (str, optional): Only include images with this status.
+        limit (int, optional): Number of groups per page
+            (GROUPS_PAGE_DEFAULT_LIMIT by default).
+        after (str, optional): Cursor taken from the 'X-Next-Cursor'
+            header of the previous page.
+        image_limit (int, optional): Maximum number of images returned
+            per group (GROUP_IMAGES_DEFAULT_LIMIT by default).
+        stream (bool, optional): Write groups to the response one by one
+            as they come from the database instead of building the whole
+            list first (GROUPS_STREAM_DEFAULT by default). Only JSON
+            responses are streamed.
+        fields (str, optional): Fields of the images, a comma separated
+            list of IMAGE_FIELDS or the name of a profile: 'compact'
+            (_id, url and status) or 'full' (all stored fields).
+            IMAGE_FIELDS_DEFAULT ('compact') by default. The projection
+            runs inside the join, other fields are not read.
+
     Returns:
         A JSON response containing a list of groups with associated
         images and counts.
         If a 'status' query parameter is provided and is a valid status,
         the response will
         only include images with the specified status.
-        If the 'status' parameter is invalid,
+        Groups without (matching) images are returned with an empty
+        'images' list and a 'count' of 0.
+        'count' is always the total number of (filtered) images in the
+        group. If a group has more images than 'image_limit', the group
+        gets an 'images_next' cursor for
+        GET /groups/<group_id>/images.
+        If there are more groups, the cursor of the next page is returned
+        in the 'X-Next-Cursor' response header.
+        If any parameter is invalid,
         a 400 Bad Request response is returned.
+        If too many requests of /groups run in the worker, a 503 Service
+        Unavailable response with a Retry-After header is returned
+        ('app.admission').
 
     HTTP Methods:
         GET
@@ -42,7 +133,8 @@ def get_groups_with_images():
         /groups
 
     Example Usage:
-        GET /groups?status=approved
+        GET /groups?status=approved&limit=2&image_limit=2
+        GET /groups?fields=url,status,created_at
 
     Response:
         [
@@ -52,18 +144,17 @@ def get_groups_with_images():
                 "images": [
                     {
                         "_id": ObjectId("5f76b5c5a548ebe57f213b3b"),
-                        "name": "Image 1",
-                        "status": "approved",
-                        "created_at": "2023-09-18T12:00:00Z"
+                        "url": "https://bucket.s3.amazonaws.com/output/image_1.png",
+                        "status": "approved"
                     },
                     {
                         "_id": ObjectId("5f76b5c5a548ebe57f213b3c"),
-                        "name": "Image 2",
-                        "status": "approved",
-                        "created_at": "2023-09-18T13:00:00Z"
+                        "url": "https://bucket.s3.amazonaws.com/output/image_2.png",
+                        "status": "approved"
                     }
                 ],
-                "count": 2
+                "count": 3,
+                "images_next": "JwAAAARrAB8AAAAJMAAAyKBq..."
             },
             {
                 "_id": ObjectId("5f76b5c5a548ebe57f213b3d"),
@@ -71,9 +162,8 @@ def get_groups_with_images():
                 "images": [
                     {
                         "_id": ObjectId("5f76b5c5a548ebe57f213b3e"),
-                        "name": "Image 3",
-                        "status": "approved",
-                        "created_at": "2023-09-18T14:00:00Z"
+                        "url": "https://bucket.s3.amazonaws.com/output/image_3.png",
+                        "status": "approved"
                     }
                 ],
                 "count": 1
@@ -82,55 +172,164 @@ def get_groups_with_images():
 
     """
 
-    status_filter = request.args.get('status')
+    status_filter = parse_status(request.args.get('status'))
+    limit = parse_limit(request.args.get('limit'),
+                        GROUPS_PAGE_DEFAULT_LIMIT,
+                        GROUPS_PAGE_MAX_LIMIT)
+    image_limit = parse_limit(request.args.get('image_limit'),
+                              GROUP_IMAGES_DEFAULT_LIMIT,
+                              GROUP_IMAGES_MAX_LIMIT)
+    after = parse_cursor(request.args.get('after'), 1)
+    # streaming writes JSON, binary formats are sent whole
+    stream = (parse_flag(request.args.get('stream'), GROUPS_STREAM_DEFAULT)
+              and negotiated_format() == JSON_MIMETYPE)
+    fields = parse_fields(request.args.get('fields'), IMAGE_FIELDS,
+                          IMAGE_FIELD_PROFILES, IMAGE_FIELDS_DEFAULT)
+
+    # select ids of the groups of this page (keyset pagination by _id),
+    # one extra id tells us whether there is a next page
+    reads = request_reads()
+    collection = reads(groups_collection)
+    groups_filter = {'_id': {'$gt': after[0]}} if after else {}
+    group_ids = [group['_id'] for group in
+                 collection.find(groups_filter, {'_id': 1},
+                                 session=reads.session)
+                           .sort('_id', 1)
+                           .limit(limit + 1)]
+    next_cursor = None
+    if len(group_ids) > limit:
+        group_ids = group_ids[:limit]
+        next_cursor = encode_cursor(group_ids[-1])
+
+    pipeline = groups_pipeline(group_ids, status_filter, image_limit,
+                               fields)
+
+    if stream:
+        cursor = collection.aggregate(pipeline,
+                                      batchSize=GROUPS_STREAM_BATCH_SIZE,
+                                      session=reads.session)
+        response = Response(_stream_groups(cursor),
+                            mimetype='application/json')
+    else:
+        # a streamed response is not profiled, its duration depends on
+        # how fast the client reads
+        with profiler.profile('groups', collection, pipeline):
+            groups = [add_images_next(group)
+                      for group in collection.aggregate(
+                          pipeline, session=reads.session)]
+        response = jsonify(groups)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response, 200
+
+
+def _stream_groups(cursor):
+    """
+    Generate a JSON array from the aggregation cursor chunk by chunk,
+    so only the current batch of groups is held in memory.
+    """
+    try:
+        yield b'['
+        for index, group in enumerate(cursor):
+            group = add_images_next(group)
+            yield (b',' if index else b'') + app.json.dumps_bytes(group)
+        yield b']'
+    finally:
+        cursor.close()
+
+
+@app.route('/groups/<group_id>/images', methods=['GET'])
+@conditional_response(CACHE_CONTROL_GROUPS)
+@cached_response
+@single_flight
+def get_group_images(group_id):
+    """
+    Endpoint for retrieving the next images of a single group.
 
-    pipeline = [
-        # 1 stage join collections by group_id field
-        {
-            '$lookup': {
-                'from': 'images',
-                'localField': '_id',
-                'foreignField': 'group_id',
-                'as': 'images'
-            }
-        },
-        {
-            # 2d stage
-            # we need to destruct list of images to sort and filter (if needed)
-            '$unwind': '$images'
-        },
-        {
-            # 3d stage
-            # sort by creation date
-            '$sort': {
-                'images.created_at': 1
-            }
+    Continues the image list of a group returned by GET /groups when the
+    group has more images than 'image_limit'. Images are sorted by
+    creation date the same way as in GET /groups.
 
-        },
-        {
-            # 4th stage group images back by group id
-            # add count field and get back name of the group filed
-            '$group': {
-                '_id': '$_id',
-                'name': {'$first': '$name'},
-                'images': {'$push': '$images'},
-                'count':  {'$sum': 1}
-            }
-        },
-    ]
+    Args:
+        group_id (str): The unique identifier of the
+        group (in ObjectId format).
+
+    Query Parameters:
+        status (str, optional): Only include images with this status.
+            Must be the same status that was used in GET /groups.
+        after (str, optional): 'images_next' cursor of the group or
+            'X-Next-Cursor' header of the previous page.
+        limit (int, optional): Number of images per page
+            (GROUP_IMAGES_DEFAULT_LIMIT by default).
+        fields (str, optional): Fields of the images, the same as in
+            GET /groups.
 
-    if status_filter and escape(status_filter) in VALID_STATUSES:
-        pipeline.insert(2, {'$match': {'images.status': status_filter}})
-    elif status_filter:
-        return jsonify({
-            "code": 400,
-            "name": "Invalid status",
-            "description": (f"Valid statuses are - {VALID_STATUSES}"),
-            }), 400
+    Returns:
+        A JSON response containing a list of images.
+        If there are more images, the cursor of the next page is returned
+        in the 'X-Next-Cursor' response header.
+        If any parameter is invalid,
+        a 400 Bad Request response is returned.
 
-    groups = sanitize_json(list(groups_collection.aggregate(pipeline)))
+    HTTP Methods:
+        GET
 
-    return jsonify(groups), 200
+    Route:
+        /groups/<group_id>/images
+
+    Example Usage:
+        GET /groups/5f76b5c5a548ebe57f213b3a/images?after=JwAAAARrAB8A...
+
+    Response:
+        [
+            {
+                "_id": ObjectId("5f76b5c5a548ebe57f213b3f"),
+                "url": "https://bucket.s3.amazonaws.com/output/image_4.png",
+                "status": "approved"
+            }
+        ]
+    """
+    group_id = parse_object_id(group_id)
+    status_filter = parse_status(request.args.get('status'))
+    limit = parse_limit(request.args.get('limit'),
+                        GROUP_IMAGES_DEFAULT_LIMIT,
+                        GROUP_IMAGES_MAX_LIMIT)
+    after = parse_cursor(request.args.get('after'), 2)
+    fields = parse_fields(request.args.get('fields'), IMAGE_FIELDS,
+                          IMAGE_FIELD_PROFILES, IMAGE_FIELDS_DEFAULT)
+
+    images_filter = {'group_id': group_id}
+    if status_filter:
+        images_filter['status'] = status_filter
+    if after:
+        created_at, image_id = after
+        images_filter['$or'] = [
+            {'created_at': {'$gt': created_at}},
+            {'created_at': created_at, '_id': {'$gt': image_id}},
+        ]
+
+    reads = request_reads()
+    images = list(reads(images_collection).find(images_filter,
+                                                images_projection(fields),
+                                                session=reads.session)
+                                          .sort(list(IMAGES_SORT.items()))
+                                          .limit(limit + 1))
+
+    next_cursor = None
+    if len(images) > limit:
+        last_image = images[limit - 1]
+        next_cursor = encode_cursor(last_image['created_at'],
+                                    last_image['_id'])
+    images = images[:limit]
+    if fields is not None and 'created_at' not in fields:
+        # created_at was only read for the cursor
+        for image in images:
+            image.pop('created_at', None)
+
+    response = jsonify(images)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response, 200
 
 
 @app.route('/images/<image_id>', methods=['PUT'])
@@ -141,7 +340,14 @@ def update_image_status(image_id):
     This endpoint allows you to update the status of an image
     identified by its 'image_id'.
     The image status is modified based on the
-    data provided in the request JSON.
+    data provided in the request JSON. The image counters of the group
+    and the global counters are updated in the same transaction.
+
+    With WRITE_COALESCING_ENABLED the update is queued and written with
+    the next batch ('models.write_queue'), the response is 202 Accepted
+    with a ticket. Whether the image exists is only known once the
+    batch is written, GET /images/updates/<ticket> returns the result.
+    If the queue of the worker is full the update is written directly.
 
     Args:
         image_id (str): The unique identifier of the
@@ -185,6 +391,13 @@ def update_image_status(image_id):
             "message": "Image status updated"
         }
 
+    Response (Accepted, write coalescing):
+        {
+            "message": "Image status update accepted",
+            "ticket": "65083c1e9b1d4c2a7e5f0a11",
+            "status_url": "/images/updates/65083c1e9b1d4c2a7e5f0a11"
+        }
+
     Response (Invalid ObjectId):
         {
             "code": 400,
@@ -214,43 +427,193 @@ def update_image_status(image_id):
             "description": "An error occurred while updating the image status"
         }
     """
-    try:
-        image_id = ObjectId(image_id)
-    except InvalidId as err:
-        # object id is in wrong format
-        return jsonify({
-            "code": 400,
-            "name": "Invalid ObjectId",
-            "description": str(err),
-        }), 400
+    image_id = parse_object_id(image_id)
 
     data = request.get_json()
-    new_status = data.get('status')
-    if new_status not in VALID_STATUSES:
-        return jsonify({
-            "code": 400,
-            "name": "Invalid status",
-            "description": (f"Valid statuses are - {VALID_STATUSES}"),
-            }), 400
+    new_status = parse_status(data.get('status') if isinstance(data, dict)
+                              else None, required=True)
+
+    if write_coalescer is not None:
+        ticket = write_coalescer.submit(image_id, new_status)
+        if ticket is not None:
+            status_url = url_for('get_image_update', ticket=ticket)
+            response = jsonify({
+                'message': 'Image status update accepted',
+                'ticket': ticket,
+                'status_url': status_url,
+                })
+            response.headers['Location'] = status_url
+            return response, 202
 
     try:
-        result = images_collection.update_one({'_id': image_id},
-                                              {'$set': {'status': new_status}})
-        if result.modified_count:
-            return jsonify({
+        with write_session() as session:
+            image = set_image_status(image_id, new_status, session)
+        if image and image.get('status') != new_status:
+            invalidate_responses()
+            response = jsonify({
                 'message': 'Image status updated'
-                }), 200
-        elif result.matched_count:
-            return jsonify({
+                })
+        elif image:
+            response = jsonify({
                 'message': 'Requested status is the same as current',
-                }), 200
+                })
         else:
             return jsonify({
                 "code": 400,
                 "name": "Image not found",
                 "description": "Specified ID was not found in database",
                 }), 400
+        return set_consistency_token(response, session), 200
+
+    except Exception as err:
+        return jsonify({
+                "code": 500,
+                "name": "MongoDB exeption occured",
+                "description": str(err),
+            }), 500
+
+
+@app.route('/images/updates/<ticket>', methods=['GET'])
+def get_image_update(ticket):
+    """
+    Endpoint returning the state of a status update accepted with
+    202 Accepted by PUT /images/<image_id> in write coalescing mode.
 
+    The worker that accepted the update knows its state, any other
+    worker reads the result from the write batches collection once the
+    update was written. A recent ticket without stored result may still
+    be queued by another worker and is reported as pending.
+
+    Route:
+        /images/updates/<ticket>
+
+    Response (Queued):
+        {
+            "ticket": "65083c1e9b1d4c2a7e5f0a11",
+            "state": "pending"
+        }
+
+    Response (Written):
+        {
+            "ticket": "65083c1e9b1d4c2a7e5f0a11",
+            "state": "flushed",
+            "image_id": "5f76b5c5a548ebe57f213b3a",
+            "status": "accepted",
+            "result": "updated",
+            "flushed_at": "2023-09-18T12:00:00Z"
+        }
+
+        'result' is one of 'updated', 'unchanged', 'not_found',
+        'conflict' (another request set the same status at the same
+        time), 'superseded' (a later update of the image was written instead)
+        or 'failed' (with the 'error' of the batch).
+
+    Raises:
+        ValidationError: If the ticket is not a valid ObjectId.
+        NotFound: If write coalescing is disabled or the ticket is older
+            than WRITE_COALESCING_RESULT_TTL and has no stored result.
+    """
+    if write_coalescer is None:
+        raise NotFound("Write coalescing is disabled")
+    created_at = parse_object_id(ticket).generation_time
+
+    update = write_coalescer.status(ticket)
+    session = None
+    if update is None or update['state'] == 'flushed':
+        # read from the primary, the session holds a consistency token
+        # covering the written batch
+        with write_session() as session:
+            stored = find_update(ticket, session)
+        if stored is not None:
+            update = dict(stored, state='flushed')
+        else:
+            session = None
+    if update is None:
+        age = datetime.now(timezone.utc) - created_at
+        if age.total_seconds() > WRITE_COALESCING_RESULT_TTL:
+            raise NotFound("Unknown ticket")
+        update = {'ticket': ticket, 'state': 'pending'}
+    return set_consistency_token(jsonify(update), session), 200
+
+
+@app.route('/images', methods=['PATCH'])
+def update_image_statuses():
+    """
+    Endpoint to change the status of many images at once.
+
+    All changes are written with one unordered bulk write. Every item is
+    validated the same way as in PUT /images/<image_id>; invalid items
+    are reported and skipped, the valid ones are still applied. If the
+    same image is listed more than once, the last item wins and the
+    previous ones are reported as 'duplicate'.
+
+    HTTP Methods:
+        PATCH
+
+    Route:
+        /images
+
+    Request JSON (list of changes):
+        [
+            {"id": "5f76b5c5a548ebe57f213b3a", "status": "accepted"},
+            {"id": "5f76b5c5a548ebe57f213b3b", "status": "deleted"}
+        ]
+
+    Request JSON (one status for many images):
+        {
+            "ids": ["5f76b5c5a548ebe57f213b3a", "5f76b5c5a548ebe57f213b3b"],
+            "status": "accepted"
+        }
+
+    Returns:
+        A JSON response with the result of every item in request order,
+        one of 'updated', 'unchanged', 'not_found', 'conflict',
+        'invalid_id', 'invalid_status' or 'duplicate', and the number of
+        items per result.
+        - If the request is not one of the formats above or is empty,
+        a 400 Bad Request response is returned.
+        - If it has more than BULK_UPDATE_MAX_ITEMS items, a 400 Bad
+        Request response is returned.
+        - If an exception occurs during the database update, a 500
+        Internal Server Error response is returned.
+
+    Response (Success):
+        {
+            "results": [
+                {"id": "5f76b5c5a548ebe57f213b3a", "result": "updated"},
+                {"id": "5f76b5c5a548ebe57f213b3b", "result": "not_found"}
+            ],
+            "summary": {"updated": 1, "not_found": 1}
+        }
+    """
+    items = _parse_bulk_update(request.get_json())
+
+    results = [None] * len(items)
+    updates = {}
+    positions = {}
+    for position, (raw_id, raw_status) in enumerate(items):
+        try:
+            image_id = parse_object_id(raw_id)
+        except ValidationError:
+            results[position] = 'invalid_id'
+            continue
+        try:
+            new_status = parse_status(raw_status, required=True)
+        except ValidationError:
+            results[position] = 'invalid_status'
+            continue
+        if image_id in positions:
+            results[positions[image_id]] = 'duplicate'
+            del updates[image_id]
+        updates[image_id] = new_status
+        positions[image_id] = position
+
+    try:
+        with write_session() as session:
+            if updates:
+                for image_id, result in set_image_statuses(
+                        updates, session).items():
+                    results[positions[image_id]] = result
     except Exception as err:
         return jsonify({
                 "code": 500,
@@ -258,20 +621,83 @@ def update_image_status(image_id):
                 "description": str(err),
             }), 500
 
+    if 'updated' in results:
+        invalidate_responses()
+    summary = {}
+    for result in results:
+        summary[result] = summary.get(result, 0) + 1
+    return set_consistency_token(jsonify({
+        'results': [{'id': raw_id, 'result': result}
+                    for (raw_id, _), result in zip(items, results)],
+        'summary': summary,
+    }), session), 200
+
+
+def _parse_bulk_update(data):
+    """
+    Turn the body of PATCH /images into a list of (id, status) pairs.
+    """
+    if isinstance(data, list) and all(isinstance(item, dict)
+                                      for item in data):
+        items = [(item.get('id'), item.get('status')) for item in data]
+    elif isinstance(data, dict) and isinstance(data.get('ids'), list):
+        items = [(image_id, data.get('status')) for image_id in data['ids']]
+    else:
+        raise ValidationError(
+            "Invalid request",
+            "Expected a list of {id, status} objects "
+            "or an object with ids and status")
+    if not items:
+        raise ValidationError("Invalid request", "No images to update")
+    if len(items) > BULK_UPDATE_MAX_ITEMS:
+        raise ValidationError(
+            "Batch too large",
+            f"No more than {BULK_UPDATE_MAX_ITEMS} images can be updated "
+            f"at once")
+    return items
+
+
+def _statistics_day():
+    """
+    ETag suffix of /statistics, periods relative to today change
+    at midnight even without writes.
+    """
+    return datetime.utcnow().strftime('%Y%m%d')
+
 
 @app.route('/statistics', methods=['GET'])
+@conditional_response(CACHE_CONTROL_STATISTICS, etag_suffix=_statistics_day)
+@cached_response
+@single_flight
+@admission_controlled
 def get_statistics():
     """
-    Endpoint to retrieve statistics for images created in the last 30 days.
+    Endpoint to retrieve statistics for images created in a period.
 
     This endpoint calculates statistics based on images'
-    creation dates within the last 30 days.
+    creation dates within a period, the last 30 days by default.
     It counts images grouped by their 'status' field and returns
     the counts as a JSON response.
+    Complete days are read from the daily statistics rollups, only the
+    days that are not rolled up yet (normally today) are counted from
+    the images collection.
 
     Args:
         None
 
+    Query Parameters:
+        days (int, optional): Period of the last 'days' days, today
+            included (STATISTIC_NUMBER_OF_DAYS by default).
+        from (str, optional): First day of the period (YYYY-MM-DD),
+            can not be combined with 'days'.
+        to (str, optional): Last day of the period (YYYY-MM-DD),
+            today by default.
+        granularity (str, optional): 'day' or 'week' returns the
+            statistics per day or per week (starting on Monday) instead
+            of the totals of the period.
+        period (str, optional): 'all' returns the number of all images
+            per status, read from the materialized global counters.
+
     HTTP Methods:
         GET
 
@@ -280,11 +706,17 @@ def get_statistics():
 
     Returns:
         A JSON response containing statistics
-        for images created in the last 30 days. The statistics are grouped
+        for images created in the period. The statistics are grouped
         by 'status'and include the count of images for each status.
+        If any parameter is invalid,
+        a 400 Bad Request response is returned.
+        If too many requests of /statistics run in the worker, a 503
+        Service Unavailable response with a Retry-After header is
+        returned ('app.admission').
 
     Example Usage:
         GET /statistics
+        GET /statistics?from=2023-09-01&to=2023-09-30&granularity=week
 
     Response:
         {
@@ -293,41 +725,50 @@ def get_statistics():
             "pending": 8
         }
 
+    Response (granularity):
+        [
+            {
+                "start": "2023-09-18",
+                "counts": {"approved": 12, "rejected": 5}
+            },
+            {
+                "start": "2023-09-25",
+                "counts": {"pending": 8}
+            }
+        ]
+
     Notes:
         - The endpoint uses a default period of the last 30 days
         to calculate statistics.
         - Images outside this time frame are excluded from the statistics.
+        - Days are UTC days.
     """
-    # days = request.args.get('days')
-    # try:
-    #    days = int(days)
-    # except ValueError:
-    #     return jsonify({
-    #         "code": 400,
-    #         "name": "wrong filter",
-    #         "description": "filter must be a number of days",
-    #         }), 400
-    # days = days if days else STATISTIC_NUMBER_OF_DAYS
-    days = STATISTIC_NUMBER_OF_DAYS
-    end_date = datetime.utcnow()
-    start_date = end_date - timedelta(days=days)
-    print(start_date)
-    pipeline = [
-        {
-            '$match': {
-                'created_at': {'$gte': start_date, '$lte': end_date}
-            }
-        },
-        {
-            '$group': {
-                '_id': '$status',
-                'count': {'$sum': 1}
-            }
-        }
-    ]
-
-    items = images_collection.aggregate(pipeline)
-    statistics = sanitize_json({item['_id']: item['count'] for item in items})
+    period = request.args.get('period')
+    if period == 'all':
+        reads = request_reads()
+        counters = reads(counters_collection).find_one(
+            {'_id': GLOBAL_COUNTER_ID}, session=reads.session)
+        counts = counters.get('counts', {}) if counters else {}
+        return jsonify({status: count for status, count in counts.items()
+                        if count}), 200
+    elif period:
+        raise ValidationError("Invalid period",
+                              "period must be 'all' or omitted")
+
+    start_date, end_date = parse_period(request.args.get('days'),
+                                        request.args.get('from'),
+                                        request.args.get('to'),
+                                        STATISTIC_NUMBER_OF_DAYS,
+                                        STATISTIC_MAX_NUMBER_OF_DAYS)
+    granularity = parse_choice(request.args.get('granularity'),
+                               STATISTIC_GRANULARITIES, None, 'granularity')
+
+    counts = get_daily_statistics(start_date, end_date, request_reads())
+    if granularity:
+        statistics = bucket_statistics(counts, start_date, end_date,
+                                       granularity)
+    else:
+        statistics = total_statistics(counts)
     return jsonify(statistics), 200
 
 
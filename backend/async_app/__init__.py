@@ -0,0 +1,73 @@
+"""
+Async Image Service
+
+ASGI variant of the Flask application ('app') built on Starlette and the
+async MongoDB driver Motor ('models.async_models'). While a query runs the
+worker keeps serving other requests, instead of pinning a thread as the
+gthread workers of the Flask application do.
+
+The routes, arguments, validation ('utils.validators'), aggregation
+pipelines and the JSON error format are shared with the Flask
+application. Responses are compressed with gzip by Starlette's
+GZipMiddleware with the same COMPRESSION_* settings; brotli, the response
+cache and conditional requests are only available in the Flask
+application. The Server-Sent Events of GET /events are only available in
+the async application ('async_app.events'): a client holds its
+connection open, which would take a thread of a gthread worker.
+
+To run the application with uvicorn workers under gunicorn:
+    gunicorn -c gunicorn_config.py -k uvicorn.workers.UvicornWorker \
+        async_app:app
+or with uvicorn alone:
+    uvicorn async_app:app --host 0.0.0.0 --port 5000
+"""
+
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from pymongo.errors import PyMongoError
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException as StarletteHTTPException
+from starlette.middleware import Middleware
+from starlette.middleware.gzip import GZipMiddleware
+from werkzeug.exceptions import HTTPException
+from async_app.views import routes, handle_exception
+from async_app.events import broadcaster
+from models.models import check_server_version
+from config.config import (FLASK_DEBUG,
+                           COMPRESSION_ENABLED,
+                           COMPRESSION_MIN_SIZE,
+                           COMPRESSION_GZIP_LEVEL,
+                           )
+
+logger = logging.getLogger(__name__)
+
+middleware = []
+if COMPRESSION_ENABLED:
+    middleware.append(Middleware(GZipMiddleware,
+                                 minimum_size=COMPRESSION_MIN_SIZE,
+                                 compresslevel=COMPRESSION_GZIP_LEVEL))
+
+
+@asynccontextmanager
+async def lifespan(app):
+    try:
+        # raises RuntimeError on an unsupported server, the application
+        # does not start
+        await asyncio.to_thread(check_server_version)
+    except PyMongoError as err:
+        logger.warning("could not check the MongoDB version: %s", err)
+    yield
+    # the events are read from the first client of /events on
+    await broadcaster.close()
+
+
+app = Starlette(debug=FLASK_DEBUG,
+                routes=routes,
+                middleware=middleware,
+                lifespan=lifespan,
+                exception_handlers={
+                    HTTPException: handle_exception,
+                    StarletteHTTPException: handle_exception,
+                    Exception: handle_exception,
+                })
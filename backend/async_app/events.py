@@ -0,0 +1,91 @@
+"""
+Status Change Events
+
+GET /events, a Server-Sent Events stream of the status changes of the
+images, for clients that otherwise poll /groups:
+
+    retry: 3000
+
+    id: 6509a1f2c3d4e5f6a7b8c9d0
+    event: status
+    data: {"group_id": "...", "image_id": "...", "new_status": "review",
+           "old_status": "new", "ts": "2023-09-19T12:00:18Z"}
+
+    : keep-alive
+
+The events are read once per worker from the source of 'models.events'
+and fanned out to the clients by a Broadcaster ('utils.broadcast'): a
+client is an asyncio task waiting for its next event, it does not pin a
+thread. A reconnecting client sends the id of its last event in the
+Last-Event-ID header (EventSource does this by itself) or in the
+last_event_id argument, and first gets the events it missed. When they
+are lost (the id is too old or unknown) it gets a 'resync' event and
+should reload the images with /groups. A client reading slower than the
+events arrive is disconnected and resumes the same way.
+
+Configuration (see 'config.config'):
+- EVENTS_ENABLED, EVENTS_BUFFER_SIZE, EVENTS_QUEUE_SIZE,
+- EVENTS_HEARTBEAT and EVENTS_RETRY_MS.
+"""
+
+from contextlib import aclosing
+from starlette.responses import StreamingResponse
+from werkzeug.exceptions import NotFound
+from utils.broadcast import Broadcaster, RESYNC
+from utils.json_provider import dumps_bytes
+from models.async_models import status_events
+from config.config import (EVENTS_ENABLED,
+                           EVENTS_BUFFER_SIZE,
+                           EVENTS_QUEUE_SIZE,
+                           EVENTS_HEARTBEAT,
+                           EVENTS_RETRY_MS,
+                           )
+
+broadcaster = Broadcaster(status_events, EVENTS_BUFFER_SIZE,
+                          EVENTS_QUEUE_SIZE)
+
+
+def format_event(entry):
+    """
+    Server-Sent Events message of an entry of Broadcaster.subscribe.
+
+    Returns:
+        bytes: The message.
+    """
+    if entry is None:
+        return b': keep-alive\n\n'
+    if entry == RESYNC:
+        return b'event: resync\ndata: {}\n\n'
+    id_, event = entry
+    return (b'id: ' + id_.encode() + b'\nevent: status\ndata: '
+            + dumps_bytes(event) + b'\n\n')
+
+
+async def event_stream(after, broadcaster=broadcaster):
+    """
+    Messages of a client, the events after the one with the id 'after'.
+    """
+    yield f'retry: {EVENTS_RETRY_MS}\n\n'.encode()
+    async with aclosing(broadcaster.subscribe(after,
+                                              EVENTS_HEARTBEAT)) as entries:
+        async for entry in entries:
+            yield format_event(entry)
+
+
+async def get_events(request):
+    """
+    GET /events, Server-Sent Events of the image status changes.
+    """
+    if not EVENTS_ENABLED:
+        raise NotFound()
+    after = (request.headers.get('last-event-id')
+             or request.query_params.get('last_event_id')
+             or None)
+    return StreamingResponse(event_stream(after),
+                             media_type='text/event-stream',
+                             headers={
+                                 'Cache-Control': 'no-cache',
+                                 # not buffered by GZipMiddleware or nginx
+                                 'Content-Encoding': 'identity',
+                                 'X-Accel-Buffering': 'no',
+                             })
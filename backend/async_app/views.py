@@ -0,0 +1,255 @@
+"""
+Async Views
+
+Async versions of the endpoints of 'app.views'. Arguments, results and
+errors are the same, see the Flask views for their documentation.
+GET /events is only served by the async application
+('async_app.events').
+
+A status update bumps the generation of the shared response cache
+('utils.shared_cache'), so Flask workers of the same host drop the
+responses they cached before it, as after their own writes.
+"""
+
+import json
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+from werkzeug.exceptions import (HTTPException, InternalServerError,
+                                 default_exceptions)
+from async_app.wrappers import JSONResponse, get_json
+from async_app.events import get_events
+from utils.utils import encode_cursor
+from utils.shared_cache import open_shared_file, SharedGeneration
+from utils.json_provider import dumps_bytes
+from utils.validators import (parse_object_id, parse_status, parse_limit,
+                              parse_cursor, parse_flag, parse_fields,
+                              parse_period, parse_choice, ValidationError)
+from models.async_models import (images_collection, groups_collection,
+                                 set_image_status, get_global_counts,
+                                 get_daily_statistics)
+from models.pipelines import (groups_pipeline, add_images_next,
+                              images_projection, IMAGES_SORT)
+from models.statistics import total_statistics, bucket_statistics
+from config.config import (STATISTIC_NUMBER_OF_DAYS,
+                           STATISTIC_MAX_NUMBER_OF_DAYS,
+                           STATISTIC_GRANULARITIES,
+                           GROUPS_PAGE_DEFAULT_LIMIT, GROUPS_PAGE_MAX_LIMIT,
+                           GROUP_IMAGES_DEFAULT_LIMIT, GROUP_IMAGES_MAX_LIMIT,
+                           GROUPS_STREAM_DEFAULT, GROUPS_STREAM_BATCH_SIZE,
+                           IMAGE_FIELDS, IMAGE_FIELD_PROFILES,
+                           IMAGE_FIELDS_DEFAULT,
+                           SHARED_CACHE_ENABLED,
+                           SHARED_CACHE_PATH,
+                           SHARED_CACHE_SLOTS,
+                           SHARED_CACHE_SLOT_SIZE,
+                           )
+
+shared_generation = None
+if SHARED_CACHE_ENABLED:
+    shared_file = open_shared_file(SHARED_CACHE_PATH,
+                                   SHARED_CACHE_SLOTS,
+                                   SHARED_CACHE_SLOT_SIZE)
+    if shared_file is not None:
+        shared_generation = SharedGeneration(shared_file)
+
+
+def invalidate_responses():
+    """
+    Drop the responses cached by the Flask workers of the host, see
+    'app.caching.invalidate_responses'.
+    """
+    if shared_generation is not None:
+        shared_generation.bump()
+
+
+async def get_groups_with_images(request):
+    """
+    GET /groups, see 'app.views.get_groups_with_images'.
+    """
+    args = request.query_params
+    status_filter = parse_status(args.get('status'))
+    limit = parse_limit(args.get('limit'),
+                        GROUPS_PAGE_DEFAULT_LIMIT,
+                        GROUPS_PAGE_MAX_LIMIT)
+    image_limit = parse_limit(args.get('image_limit'),
+                              GROUP_IMAGES_DEFAULT_LIMIT,
+                              GROUP_IMAGES_MAX_LIMIT)
+    after = parse_cursor(args.get('after'), 1)
+    stream = parse_flag(args.get('stream'), GROUPS_STREAM_DEFAULT)
+    fields = parse_fields(args.get('fields'), IMAGE_FIELDS,
+                          IMAGE_FIELD_PROFILES, IMAGE_FIELDS_DEFAULT)
+
+    groups_filter = {'_id': {'$gt': after[0]}} if after else {}
+    group_ids = [group['_id'] async for group in
+                 groups_collection.find(groups_filter, {'_id': 1})
+                                  .sort('_id', 1)
+                                  .limit(limit + 1)]
+    headers = {}
+    if len(group_ids) > limit:
+        group_ids = group_ids[:limit]
+        headers['X-Next-Cursor'] = encode_cursor(group_ids[-1])
+
+    pipeline = groups_pipeline(group_ids, status_filter, image_limit,
+                               fields)
+    if stream:
+        cursor = groups_collection.aggregate(
+            pipeline, batchSize=GROUPS_STREAM_BATCH_SIZE)
+        return StreamingResponse(_stream_groups(cursor),
+                                 headers=headers,
+                                 media_type='application/json')
+    groups = [add_images_next(group)
+              async for group in groups_collection.aggregate(pipeline)]
+    return JSONResponse(groups, headers=headers)
+
+
+async def _stream_groups(cursor):
+    """
+    Async version of 'app.views._stream_groups'.
+    """
+    try:
+        yield b'['
+        index = 0
+        async for group in cursor:
+            group = add_images_next(group)
+            yield (b',' if index else b'') + dumps_bytes(group)
+            index += 1
+        yield b']'
+    finally:
+        await cursor.close()
+
+
+async def get_group_images(request):
+    """
+    GET /groups/<group_id>/images, see 'app.views.get_group_images'.
+    """
+    args = request.query_params
+    group_id = parse_object_id(request.path_params['group_id'])
+    status_filter = parse_status(args.get('status'))
+    limit = parse_limit(args.get('limit'),
+                        GROUP_IMAGES_DEFAULT_LIMIT,
+                        GROUP_IMAGES_MAX_LIMIT)
+    after = parse_cursor(args.get('after'), 2)
+    fields = parse_fields(args.get('fields'), IMAGE_FIELDS,
+                          IMAGE_FIELD_PROFILES, IMAGE_FIELDS_DEFAULT)
+
+    images_filter = {'group_id': group_id}
+    if status_filter:
+        images_filter['status'] = status_filter
+    if after:
+        created_at, image_id = after
+        images_filter['$or'] = [
+            {'created_at': {'$gt': created_at}},
+            {'created_at': created_at, '_id': {'$gt': image_id}},
+        ]
+    images = await (images_collection.find(images_filter,
+                                      images_projection(fields))
+                                     .sort(list(IMAGES_SORT.items()))
+                                     .to_list(limit + 1))
+
+    headers = {}
+    if len(images) > limit:
+        last_image = images[limit - 1]
+        headers['X-Next-Cursor'] = encode_cursor(last_image['created_at'],
+                                                 last_image['_id'])
+    images = images[:limit]
+    if fields is not None and 'created_at' not in fields:
+        for image in images:
+            image.pop('created_at', None)
+    return JSONResponse(images, headers=headers)
+
+
+async def update_image_status(request):
+    """
+    PUT /images/<image_id>, see 'app.views.update_image_status'.
+    """
+    image_id = parse_object_id(request.path_params['image_id'])
+
+    data = await get_json(request)
+    new_status = parse_status(data.get('status') if isinstance(data, dict)
+                              else None, required=True)
+
+    try:
+        image = await set_image_status(image_id, new_status)
+    except Exception as err:
+        return JSONResponse({
+                "code": 500,
+                "name": "MongoDB exeption occured",
+                "description": str(err),
+            }, status_code=500)
+    if image and image.get('status') != new_status:
+        invalidate_responses()
+        return JSONResponse({'message': 'Image status updated'})
+    elif image:
+        return JSONResponse({
+            'message': 'Requested status is the same as current',
+            })
+    return JSONResponse({
+        "code": 400,
+        "name": "Image not found",
+        "description": "Specified ID was not found in database",
+        }, status_code=400)
+
+
+async def get_statistics(request):
+    """
+    GET /statistics, see 'app.views.get_statistics'.
+    """
+    args = request.query_params
+    period = args.get('period')
+    if period == 'all':
+        return JSONResponse(await get_global_counts())
+    elif period:
+        raise ValidationError("Invalid period",
+                              "period must be 'all' or omitted")
+
+    start_date, end_date = parse_period(args.get('days'),
+                                        args.get('from'),
+                                        args.get('to'),
+                                        STATISTIC_NUMBER_OF_DAYS,
+                                        STATISTIC_MAX_NUMBER_OF_DAYS)
+    granularity = parse_choice(args.get('granularity'),
+                               STATISTIC_GRANULARITIES, None, 'granularity')
+
+    counts = await get_daily_statistics(start_date, end_date)
+    if granularity:
+        statistics = bucket_statistics(counts, start_date, end_date,
+                                       granularity)
+    else:
+        statistics = total_statistics(counts)
+    return JSONResponse(statistics)
+
+
+async def handle_exception(request, e):
+    """
+    Async version of 'app.views.handle_exception'.
+
+    Errors raised by Starlette (unknown route, wrong method) and
+    unexpected exceptions are converted to the matching werkzeug
+    exception first, so every error has the same JSON format as in the
+    Flask application. The headers of the error (e.g. Allow, Retry-After)
+    are kept.
+    """
+    # the headers of a Starlette error, e.g. Allow of a wrong method
+    headers = dict(getattr(e, 'headers', None) or {})
+    if not isinstance(e, HTTPException):
+        if hasattr(e, 'status_code'):
+            e = default_exceptions.get(e.status_code, InternalServerError)()
+        else:
+            e = InternalServerError(original_exception=e)
+    # the headers of a werkzeug error, e.g. Retry-After of 503
+    headers.update((name, value) for name, value in e.get_headers()
+                   if name.lower() != 'content-type')
+    return Response(json.dumps({
+        "code": e.code,
+        "name": e.name,
+        "description": e.description,
+    }), status_code=e.code, headers=headers, media_type="application/json")
+
+
+routes = [
+    Route('/groups', get_groups_with_images, methods=['GET']),
+    Route('/groups/{group_id}/images', get_group_images, methods=['GET']),
+    Route('/images/{image_id}', update_image_status, methods=['PUT']),
+    Route('/statistics', get_statistics, methods=['GET']),
+    Route('/events', get_events, methods=['GET']),
+]
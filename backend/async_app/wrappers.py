@@ -0,0 +1,51 @@
+"""
+Request and Response Helpers
+
+Starlette counterparts of the Flask helpers used by the views, producing
+the same bodies and errors as the Flask application.
+"""
+
+import json
+from starlette.responses import Response
+from werkzeug.exceptions import BadRequest, UnsupportedMediaType
+from utils.json_provider import dumps_bytes
+
+
+class JSONResponse(Response):
+    """
+    JSON response serialized like 'jsonify' with MongoJSONProvider:
+    MongoDB types are converted, keys are sorted and the body ends with
+    a newline.
+    """
+
+    media_type = 'application/json'
+
+    def render(self, content):
+        return dumps_bytes(content) + b'\n'
+
+
+async def get_json(request):
+    """
+    Parse the JSON body of a request like Flask's request.get_json().
+
+    Args:
+        request (Request): Starlette request.
+
+    Returns:
+        The parsed body.
+
+    Raises:
+        UnsupportedMediaType: If the request Content-Type is not JSON.
+        BadRequest: If the body is not valid JSON.
+    """
+    mimetype = request.headers.get('content-type', '').split(';')[0].strip()
+    if not (mimetype == 'application/json'
+            or (mimetype.startswith('application/')
+                and mimetype.endswith('+json'))):
+        raise UnsupportedMediaType(
+            "Did not attempt to load JSON data because the request"
+            " Content-Type was not 'application/json'.")
+    try:
+        return json.loads(await request.body())
+    except ValueError as err:
+        raise BadRequest(f"Failed to decode JSON object: {err}")
@@ -0,0 +1,174 @@
+"""
+Flask (gthread) vs Async (uvicorn) Load Benchmark
+
+Starts the Flask application with gunicorn gthread workers and the async
+application ('async_app') with gunicorn uvicorn workers, one after the
+other, with the same number of processes, and runs the same closed-loop
+load against both: a number of concurrent clients, each sending the next
+request as soon as the previous one is answered. Requests per second,
+latency percentiles and errors are printed side by side.
+
+The servers use the database configured in .env, seed it first with
+createtestdb/imagecreator.py. The response cache of the Flask application
+is disabled so both applications run the same queries; pass --cache to
+keep it.
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_async --concurrency 64 --duration 20
+    python -m benchmarks.bench_async --path "/groups?limit=50" \
+        --path "/statistics?days=365"
+
+Dependencies:
+- gunicorn, uvicorn and httpx, see requirements-async.txt.
+"""
+
+import argparse
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import time
+import httpx
+
+SERVERS = {
+    'flask-gthread': ['run:app'],
+    'async-uvicorn': ['-k', 'uvicorn.workers.UvicornWorker', 'async_app:app'],
+}
+DEFAULT_PATHS = ['/groups', '/groups?status=new', '/statistics']
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of sorted values.
+    """
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, round(fraction * len(values)) - 1))
+    return values[index]
+
+
+def start_server(name, port, args):
+    env = dict(os.environ,
+               GUNICORN_BIND=f'127.0.0.1:{port}',
+               GUNICORN_PROCESSES=str(args.workers),
+               GUNICORN_THREADS=str(args.threads))
+    if not args.cache:
+        env['RESPONSE_CACHE_ENABLED'] = 'false'
+        env['SHARED_CACHE_ENABLED'] = 'false'
+    return subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn_config.py']
+        + SERVERS[name],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def stop_server(process):
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+async def wait_until_ready(base_url, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get('/statistics?period=all')
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"server at {base_url} did not start")
+
+
+async def run_load(base_url, paths, concurrency, duration):
+    """
+    Send requests from concurrent clients for a number of seconds.
+
+    Returns:
+        dict: Number of requests and errors, requests per second and
+        latency percentiles in milliseconds.
+    """
+    latencies = []
+    errors = 0
+    limits = httpx.Limits(max_connections=concurrency,
+                          max_keepalive_connections=concurrency)
+
+    async def client_loop(client, number, deadline):
+        nonlocal errors
+        index = number
+        while time.monotonic() < deadline:
+            path = paths[index % len(paths)]
+            index += 1
+            start = time.perf_counter()
+            try:
+                response = await client.get(path)
+                await response.aread()
+                if response.status_code != 200:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits,
+                                 timeout=60) as client:
+        started = time.monotonic()
+        deadline = started + duration
+        await asyncio.gather(*(client_loop(client, number, deadline)
+                               for number in range(concurrency)))
+        elapsed = time.monotonic() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / elapsed,
+        'p50': percentile(latencies, 0.50) * 1000,
+        'p95': percentile(latencies, 0.95) * 1000,
+        'p99': percentile(latencies, 0.99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--warmup', type=float, default=3)
+    parser.add_argument('--workers', type=int, default=2,
+                        help="gunicorn processes of both servers")
+    parser.add_argument('--threads', type=int, default=4,
+                        help="threads per gthread worker")
+    parser.add_argument('--port', type=int, default=5100)
+    parser.add_argument('--path', action='append', dest='paths',
+                        help="request path, may be repeated")
+    parser.add_argument('--cache', action='store_true',
+                        help="keep the response cache of the Flask app")
+    args = parser.parse_args()
+    paths = args.paths or DEFAULT_PATHS
+
+    print(f"{args.workers} workers, {args.threads} threads per gthread "
+          f"worker, {args.concurrency} clients, {args.duration:g} s")
+    print(f"paths: {', '.join(paths)}")
+    print(f"{'server':<16}{'requests':>10}{'errors':>8}{'req/s':>10}"
+          f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for number, name in enumerate(SERVERS):
+        port = args.port + number
+        base_url = f'http://127.0.0.1:{port}'
+        process = start_server(name, port, args)
+        try:
+            asyncio.run(wait_until_ready(base_url))
+            if args.warmup:
+                asyncio.run(run_load(base_url, paths, args.concurrency,
+                                     args.warmup))
+            result = asyncio.run(run_load(base_url, paths,
+                                          args.concurrency, args.duration))
+        finally:
+            stop_server(process)
+        print(f"{name:<16}{result['requests']:>10}{result['errors']:>8}"
+              f"{result['rps']:>10.1f}{result['p50']:>10.1f}"
+              f"{result['p95']:>10.1f}{result['p99']:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+JSON Serialization Micro-benchmark
+
+Compares the previous serialization path of the views
+(bson.json_util.dumps -> json.loads -> jsonify) with the single-pass
+MongoJSONProvider on a synthetic /groups payload. The provider is measured
+with the standard json backend and, when it is installed, with orjson.
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_json --groups 50 --images 100 --repeat 20
+"""
+
+import argparse
+import json
+import random
+import timeit
+from datetime import datetime, timedelta
+from bson import ObjectId, json_util
+from flask import Flask, jsonify
+import utils.json_provider as json_provider
+from utils.json_provider import MongoJSONProvider
+
+STATUSES = ['new', 'review', 'accepted', 'deleted']
+
+
+def make_payload(groups, images):
+    """
+    Build a list of groups shaped like the /groups aggregation result.
+    """
+    start = datetime.utcnow() - timedelta(days=30)
+    payload = []
+    for group_number in range(groups):
+        group_id = ObjectId()
+        payload.append({
+            '_id': group_id,
+            'name': f"Group {group_number}",
+            'count': images,
+            'images': [{
+                '_id': ObjectId(),
+                'created_at': start + timedelta(
+                    seconds=random.randrange(30 * 24 * 3600)),
+                'url': (f"https://bucket.s3.us-west-2.amazonaws.com/"
+                        f"output/group_{group_number}_image_{number}.png"),
+                'status': random.choice(STATUSES),
+                'group_id': group_id,
+            } for number in range(images)],
+        })
+    return payload
+
+
+def measure(name, app, serialize, payload, repeat):
+    with app.app_context():
+        body = serialize(payload).get_data()
+        seconds = min(timeit.repeat(lambda: serialize(payload).get_data(),
+                                    number=1, repeat=repeat))
+    print(f"{name:<32} {seconds * 1000:9.2f} ms {len(body):>10} bytes")
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--groups', type=int, default=50)
+    parser.add_argument('--images', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    payload = make_payload(args.groups, args.images)
+    print(f"payload: {args.groups} groups x {args.images} images")
+
+    legacy_app = Flask('legacy')
+    baseline = measure(
+        'json_util round-trip + jsonify', legacy_app,
+        lambda data: jsonify(json.loads(json_util.dumps(data))),
+        payload, args.repeat)
+
+    provider_app = Flask('provider')
+    provider_app.json = MongoJSONProvider(provider_app)
+    orjson = json_provider.orjson
+    results = {}
+    if orjson is not None:
+        results['MongoJSONProvider (orjson)'] = measure(
+            'MongoJSONProvider (orjson)', provider_app, jsonify,
+            payload, args.repeat)
+    json_provider.orjson = None
+    try:
+        results['MongoJSONProvider (json)'] = measure(
+            'MongoJSONProvider (json)', provider_app, jsonify,
+            payload, args.repeat)
+    finally:
+        json_provider.orjson = orjson
+
+    for name, seconds in results.items():
+        print(f"{name}: {baseline / seconds:.1f}x faster")
+
+
+if __name__ == '__main__':
+    main()
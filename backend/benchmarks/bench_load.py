@@ -0,0 +1,381 @@
+"""
+End-to-end Load Benchmark
+
+Seeds a synthetic dataset into a dedicated MongoDB database, starts the
+application with gunicorn and the real gunicorn_config.py, and drives a
+mixed read/write workload from concurrent closed-loop clients:
+
+- groups: GET /groups,
+- groups_status: GET /groups?status=<random status>,
+- statistics: GET /statistics,
+- put_image: PUT /images/<random image> with a random status.
+
+The share of every operation is set with --mix. Requests per second,
+p50/p95/p99 latency and error rate (connection errors and responses
+other than 2xx) are reported for every operation and in total as JSON,
+with the commit and the arguments of the run, so the results of two
+commits can be diffed. --baseline prints the change against an earlier
+result.
+
+The benchmark database (--db, never the database of the service) is
+dropped and seeded again unless --no-seed is passed. Indexes, counters
+and daily statistics are created with the CLI commands of the service
+after seeding.
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_load --groups 200 --images 500 \
+        --duration 30 --output results/load.json
+    python -m benchmarks.bench_load --no-seed --mix groups=1,put_image=1 \
+        --baseline results/load.json
+
+Dependencies:
+- gunicorn and httpx (see requirements-async.txt), and a MongoDB server,
+by default on localhost.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+import httpx
+from pymongo import MongoClient
+from benchmarks.bench_async import (SERVERS, percentile, start_server,
+                                    stop_server, wait_until_ready)
+from config.config import (MONGODB_URI,
+                           MONGODB_IMAGE_COLLECTION_NAME,
+                           MONGODB_GROUPS_COLLECTION_NAME,
+                           MONGODB_COUNTERS_COLLECTION_NAME,
+                           MONGODB_DAILY_STATISTICS_COLLECTION_NAME,
+                           VALID_STATUSES,
+                           )
+
+DEFAULT_MIX = 'groups=4,groups_status=3,statistics=2,put_image=1'
+# share of the seeded images in every status
+STATUS_WEIGHTS = [0.4, 0.3, 0.2, 0.1]
+SEED_BATCH_SIZE = 1000
+# number of image ids sampled for put_image
+IMAGE_SAMPLE_SIZE = 10000
+
+
+def parse_mix(value):
+    """
+    Parse --mix, e.g. 'groups=4,put_image=1'.
+
+    Returns:
+        dict: Weight of every operation.
+    """
+    mix = {}
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(
+                f"unknown operation {name!r}, "
+                f"choose from {', '.join(OPERATIONS)}")
+        try:
+            mix[name] = float(weight or 1)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid weight {weight!r}")
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError("all weights are zero")
+    return mix
+
+
+def groups_request(rng, image_ids):
+    return 'GET', '/groups', None
+
+
+def groups_status_request(rng, image_ids):
+    return 'GET', f'/groups?status={rng.choice(VALID_STATUSES)}', None
+
+
+def statistics_request(rng, image_ids):
+    return 'GET', '/statistics', None
+
+
+def put_image_request(rng, image_ids):
+    return ('PUT', f'/images/{rng.choice(image_ids)}',
+            {'status': rng.choice(VALID_STATUSES)})
+
+
+OPERATIONS = {
+    'groups': groups_request,
+    'groups_status': groups_status_request,
+    'statistics': statistics_request,
+    'put_image': put_image_request,
+}
+
+
+def seed(db, groups, images, days, rng):
+    """
+    Replace the data of the benchmark database with groups of images.
+
+    Images get a status drawn from STATUS_WEIGHTS and a creation time
+    spread uniformly over the last days.
+
+    Returns:
+        int: Number of inserted images.
+    """
+    images_collection = db[MONGODB_IMAGE_COLLECTION_NAME]
+    groups_collection = db[MONGODB_GROUPS_COLLECTION_NAME]
+    for name in (MONGODB_IMAGE_COLLECTION_NAME,
+                 MONGODB_GROUPS_COLLECTION_NAME,
+                 MONGODB_COUNTERS_COLLECTION_NAME,
+                 MONGODB_DAILY_STATISTICS_COLLECTION_NAME):
+        db[name].delete_many({})
+
+    group_ids = groups_collection.insert_many(
+        [{'name': f"Group {number}"} for number in range(groups)]
+        ).inserted_ids
+    now = datetime.utcnow()
+    period = days * 86400
+    batch = []
+    for group_number, group_id in enumerate(group_ids):
+        for image_number in range(images):
+            batch.append({
+                'created_at': now - timedelta(seconds=rng.random() * period),
+                'url': (f"https://example.com/group_{group_number}"
+                        f"_image_{image_number}.png"),
+                'status': rng.choices(VALID_STATUSES, STATUS_WEIGHTS)[0],
+                'group_id': group_id,
+            })
+            if len(batch) == SEED_BATCH_SIZE:
+                images_collection.insert_many(batch, ordered=False)
+                batch = []
+    if batch:
+        images_collection.insert_many(batch, ordered=False)
+    return groups * images
+
+
+def run_command(command):
+    """
+    Run a CLI command of the service ('app.commands').
+    """
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'run']
+                   + command, check=True, stdout=subprocess.DEVNULL)
+
+
+def sample_image_ids(db):
+    """
+    Ids of random images of the benchmark database, for put_image.
+    """
+    return [str(image['_id']) for image in
+            db[MONGODB_IMAGE_COLLECTION_NAME].aggregate([
+                {'$sample': {'size': IMAGE_SAMPLE_SIZE}},
+                {'$project': {'_id': 1}},
+            ])]
+
+
+def summarize(latencies, errors, status_codes, elapsed):
+    """
+    Requests, error rate, requests per second and latency percentiles in
+    milliseconds of one operation (or of all of them).
+    """
+    latencies = sorted(latencies)
+    requests = len(latencies)
+    return {
+        'requests': requests,
+        'errors': errors,
+        'error_rate': errors / requests if requests else 0.0,
+        'rps': requests / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'status_codes': dict(sorted(status_codes.items())),
+    }
+
+
+async def run_mixed_load(base_url, mix, image_ids, concurrency, duration,
+                         seed_value):
+    """
+    Send the operations of a mix from concurrent clients for a number of
+    seconds. Every client draws its operations from its own random
+    generator, so a run with the same seed sends the same sequence.
+
+    Returns:
+        dict: 'total' and 'endpoints', the summaries of all requests and
+        of every operation.
+    """
+    names = [name for name in mix if mix[name]]
+    weights = [mix[name] for name in names]
+    samples = {name: ([], [0], {}) for name in names}
+    limits = httpx.Limits(max_connections=concurrency,
+                          max_keepalive_connections=concurrency)
+
+    async def client_loop(client, number, deadline):
+        rng = random.Random(seed_value * 1000003 + number)
+        while time.monotonic() < deadline:
+            name = rng.choices(names, weights)[0]
+            latencies, errors, status_codes = samples[name]
+            method, path, body = OPERATIONS[name](rng, image_ids)
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, path, json=body)
+                await response.aread()
+                status = str(response.status_code)
+                if not 200 <= response.status_code < 300:
+                    errors[0] += 1
+            except httpx.HTTPError:
+                status = 'error'
+                errors[0] += 1
+            latencies.append(time.perf_counter() - start)
+            status_codes[status] = status_codes.get(status, 0) + 1
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits,
+                                 timeout=60) as client:
+        started = time.monotonic()
+        deadline = started + duration
+        await asyncio.gather(*(client_loop(client, number, deadline)
+                               for number in range(concurrency)))
+        elapsed = time.monotonic() - started
+
+    endpoints = {}
+    all_latencies, all_errors, all_status_codes = [], 0, {}
+    for name, (latencies, errors, status_codes) in samples.items():
+        endpoints[name] = summarize(latencies, errors[0], status_codes,
+                                    elapsed)
+        all_latencies += latencies
+        all_errors += errors[0]
+        for status, count in status_codes.items():
+            all_status_codes[status] = all_status_codes.get(status, 0) + count
+    return {
+        'total': summarize(all_latencies, all_errors, all_status_codes,
+                           elapsed),
+        'endpoints': endpoints,
+    }
+
+
+def git_commit():
+    """
+    Commit of the working tree, with '-dirty' if it has changes.
+    """
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'],
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_comparison(result, baseline):
+    """
+    Print the change of every summary against a baseline result.
+    """
+    rows = [('total', result['total'], baseline.get('total'))]
+    rows += [(name, summary, baseline.get('endpoints', {}).get(name))
+             for name, summary in result['endpoints'].items()]
+    print(f"{'operation':<16}{'req/s':>16}{'p50 ms':>16}{'p95 ms':>16}"
+          f"{'p99 ms':>16}{'errors':>10}", file=sys.stderr)
+    for name, summary, before in rows:
+        if before is None:
+            print(f"{name:<16}{'not in baseline':>16}", file=sys.stderr)
+            continue
+        cells = ''
+        for key in ('rps', 'p50_ms', 'p95_ms', 'p99_ms'):
+            change = ((summary[key] / before[key] - 1) * 100
+                      if before[key] else 0.0)
+            cells += f"{summary[key]:>9.1f}{change:>+6.0f}%"
+        error_change = (summary['error_rate'] - before['error_rate']) * 100
+        print(f"{name:<16}{cells}{error_change:>+9.2f}%", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--uri', default=MONGODB_URI or 'mongodb://localhost',
+                        help="MongoDB server, MONGODB_URI by default")
+    parser.add_argument('--db', default='image_service_bench',
+                        help="benchmark database, dropped when seeding")
+    parser.add_argument('--groups', type=int, default=100)
+    parser.add_argument('--images', type=int, default=100,
+                        help="images per group")
+    parser.add_argument('--days', type=int, default=60,
+                        help="images are created over this many days")
+    parser.add_argument('--no-seed', action='store_true',
+                        help="use the data of an earlier run")
+    parser.add_argument('--server', choices=list(SERVERS),
+                        default='flask-gthread')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help=f"operation weights, default {DEFAULT_MIX}")
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--warmup', type=float, default=3)
+    parser.add_argument('--workers', type=int, default=2,
+                        help="gunicorn processes")
+    parser.add_argument('--threads', type=int, default=4,
+                        help="threads per gthread worker")
+    parser.add_argument('--port', type=int, default=5200)
+    parser.add_argument('--cache', action='store_true',
+                        help="keep the response cache enabled")
+    parser.add_argument('--seed', type=int, default=1,
+                        help="seed of the data and of the workload")
+    parser.add_argument('--output', help="write the result to this file "
+                                         "instead of stdout")
+    parser.add_argument('--baseline', help="earlier result to compare with")
+    args = parser.parse_args()
+
+    # the server and the CLI commands inherit the benchmark database
+    os.environ['MONGODB_URI'] = args.uri
+    os.environ['MONGODB_DB_NAME'] = args.db
+    client = MongoClient(args.uri)
+    db = client[args.db]
+    if not args.no_seed:
+        started = time.monotonic()
+        count = seed(db, args.groups, args.images, args.days,
+                     random.Random(args.seed))
+        run_command(['migrate-indexes', '--force'])
+        run_command(['rebuild-counters'])
+        run_command(['rebuild-statistics'])
+        print(f"seeded {args.groups} groups, {count} images in "
+              f"{time.monotonic() - started:.1f} s", file=sys.stderr)
+    image_ids = sample_image_ids(db)
+    client.close()
+    if args.mix.get('put_image') and not image_ids:
+        parser.error("the benchmark database has no images, "
+                     "run without --no-seed")
+
+    base_url = f'http://127.0.0.1:{args.port}'
+    process = start_server(args.server, args.port, args)
+    try:
+        asyncio.run(wait_until_ready(base_url))
+        if args.warmup:
+            asyncio.run(run_mixed_load(base_url, args.mix, image_ids,
+                                       args.concurrency, args.warmup,
+                                       args.seed + 1))
+        result = asyncio.run(run_mixed_load(base_url, args.mix, image_ids,
+                                            args.concurrency, args.duration,
+                                            args.seed))
+    finally:
+        stop_server(process)
+
+    result['run'] = {
+        'commit': git_commit(),
+        'date': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+        'server': args.server,
+        'workers': args.workers,
+        'threads': args.threads,
+        'concurrency': args.concurrency,
+        'duration': args.duration,
+        'cache': args.cache,
+        'mix': args.mix,
+        'seed': args.seed,
+        'groups': args.groups if not args.no_seed else None,
+        'images': args.images if not args.no_seed else None,
+    }
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+    if args.baseline:
+        with open(args.baseline) as file:
+            print_comparison(result, json.load(file))
+
+
+if __name__ == '__main__':
+    main()
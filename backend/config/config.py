@@ -11,6 +11,68 @@ MONGODB_IMAGE_COLLECTION_NAME = os.environ.get('MONGODB_IMAGE_COLLECTION_NAME')
 MONGODB_GROUPS_COLLECTION_NAME = os.environ.get(
                                             'MONGODB_GROUPS_COLLECTION_NAME'
                                             )
+MONGODB_COUNTERS_COLLECTION_NAME = os.environ.get(
+                                        'MONGODB_COUNTERS_COLLECTION_NAME',
+                                        'counters')
+MONGODB_DAILY_STATISTICS_COLLECTION_NAME = os.environ.get(
+                                'MONGODB_DAILY_STATISTICS_COLLECTION_NAME',
+                                'daily_statistics')
+# applied index migrations
+MONGODB_MIGRATIONS_COLLECTION_NAME = os.environ.get(
+                                        'MONGODB_MIGRATIONS_COLLECTION_NAME',
+                                        'migrations')
+# results of the batches written by write coalescing
+MONGODB_WRITE_BATCHES_COLLECTION_NAME = os.environ.get(
+                                    'MONGODB_WRITE_BATCHES_COLLECTION_NAME',
+                                    'write_batches')
+# status change events published when change streams are not available
+MONGODB_EVENTS_COLLECTION_NAME = os.environ.get(
+                                        'MONGODB_EVENTS_COLLECTION_NAME',
+                                        'image_events')
+# run multi-document writes in transactions: auto, true or false
+# auto uses transactions when the server is a replica set or mongos
+MONGODB_TRANSACTIONS = os.environ.get('MONGODB_TRANSACTIONS', 'auto').lower()
+
+# connection pool of the MongoClient of a worker, sized from the number of
+# gunicorn threads (gunicorn_config.py passes the actual number)
+WORKER_THREADS = int(os.environ.get('GUNICORN_THREADS', '4'))
+# one connection per thread plus background threads (profiler explains)
+MONGODB_MAX_POOL_SIZE = int(os.environ.get('MONGODB_MAX_POOL_SIZE',
+                                           str(WORKER_THREADS + 2)))
+MONGODB_MIN_POOL_SIZE = int(os.environ.get('MONGODB_MIN_POOL_SIZE', '0'))
+# a thread waiting longer for a free connection fails
+MONGODB_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get(
+                                    'MONGODB_WAIT_QUEUE_TIMEOUT_MS', '2000'))
+MONGODB_CONNECT_TIMEOUT_MS = int(os.environ.get('MONGODB_CONNECT_TIMEOUT_MS',
+                                                '5000'))
+MONGODB_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get(
+                                'MONGODB_SERVER_SELECTION_TIMEOUT_MS', '5000'))
+# 0: no timeout
+MONGODB_SOCKET_TIMEOUT_MS = int(os.environ.get('MONGODB_SOCKET_TIMEOUT_MS',
+                                               '0'))
+MONGODB_MAX_IDLE_TIME_MS = int(os.environ.get('MONGODB_MAX_IDLE_TIME_MS',
+                                              '300000'))
+# connections opened before a worker accepts requests, 0 disables the
+# warm-up
+MONGODB_WARMUP_CONNECTIONS = int(os.environ.get('MONGODB_WARMUP_CONNECTIONS',
+                                                str(WORKER_THREADS)))
+
+# read preference of the read routes: primary, primaryPreferred,
+# secondary, secondaryPreferred or nearest (see app/routing.py); writes
+# always go to the primary
+READ_PREFERENCE_GROUPS = os.environ.get('READ_PREFERENCE_GROUPS',
+                                        'secondaryPreferred')
+READ_PREFERENCE_STATISTICS = os.environ.get('READ_PREFERENCE_STATISTICS',
+                                            'secondaryPreferred')
+READ_PREFERENCES = {
+    '/groups': READ_PREFERENCE_GROUPS,
+    '/groups/<group_id>/images': READ_PREFERENCE_GROUPS,
+    '/statistics': READ_PREFERENCE_STATISTICS,
+}
+# secondaries estimated to lag more seconds behind the primary are not
+# read, at least 90, -1: no limit
+READ_MAX_STALENESS_SECONDS = int(os.environ.get('READ_MAX_STALENESS_SECONDS',
+                                                '90'))
 
 # config flask app
 FLASK_DEBUG = False
@@ -19,3 +81,164 @@ FLASK_HOST = "127.0.0.1" if FLASK_DEBUG else "0.0.0.0"
 # constants
 VALID_STATUSES = ['new', 'review', 'accepted', 'deleted']
 STATISTIC_NUMBER_OF_DAYS = 30
+STATISTIC_MAX_NUMBER_OF_DAYS = int(os.environ.get(
+                                    'STATISTIC_MAX_NUMBER_OF_DAYS', '3660'))
+STATISTIC_GRANULARITIES = ['day', 'week']
+# seconds a worker may seal the daily statistics before another worker
+# takes over the seal
+STATISTIC_SEAL_LEASE = int(os.environ.get('STATISTIC_SEAL_LEASE', '300'))
+# days counted and written in one transaction when sealing
+STATISTIC_SEAL_MAX_DAYS = int(os.environ.get('STATISTIC_SEAL_MAX_DAYS',
+                                             '31'))
+
+# pagination of /groups
+GROUPS_PAGE_DEFAULT_LIMIT = int(os.environ.get('GROUPS_PAGE_DEFAULT_LIMIT',
+                                               '50'))
+GROUPS_PAGE_MAX_LIMIT = int(os.environ.get('GROUPS_PAGE_MAX_LIMIT', '500'))
+GROUP_IMAGES_DEFAULT_LIMIT = int(os.environ.get('GROUP_IMAGES_DEFAULT_LIMIT',
+                                                '100'))
+GROUP_IMAGES_MAX_LIMIT = int(os.environ.get('GROUP_IMAGES_MAX_LIMIT', '1000'))
+
+# image fields returned by /groups and /groups/<group_id>/images
+IMAGE_FIELDS = ['_id', 'group_id', 'url', 'status', 'created_at']
+# named sets of fields for the fields argument, None returns every
+# stored field
+IMAGE_FIELD_PROFILES = {
+    'compact': ['_id', 'url', 'status'],
+    'full': None,
+}
+IMAGE_FIELDS_DEFAULT = os.environ.get('IMAGE_FIELDS_DEFAULT', 'compact')
+
+# streaming of /groups
+GROUPS_STREAM_DEFAULT = os.environ.get('GROUPS_STREAM_DEFAULT',
+                                       'false').lower() == 'true'
+GROUPS_STREAM_BATCH_SIZE = int(os.environ.get('GROUPS_STREAM_BATCH_SIZE',
+                                              '20'))
+
+# in-process cache of read responses
+RESPONSE_CACHE_ENABLED = os.environ.get('RESPONSE_CACHE_ENABLED',
+                                        'true').lower() == 'true'
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', '10'))
+RESPONSE_CACHE_MAXSIZE = int(os.environ.get('RESPONSE_CACHE_MAXSIZE', '256'))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES',
+                                              str(64 * 1024 * 1024)))
+
+# response cache shared by the worker processes of a host
+SHARED_CACHE_ENABLED = os.environ.get('SHARED_CACHE_ENABLED',
+                                      'true').lower() == 'true'
+SHARED_CACHE_PATH = os.environ.get(
+    'SHARED_CACHE_PATH',
+    os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else '/tmp',
+                 'image-service-response-cache'))
+# 32 MB by default, the file must fit into /dev/shm (64 MB in Docker)
+SHARED_CACHE_SLOTS = int(os.environ.get('SHARED_CACHE_SLOTS', '32'))
+SHARED_CACHE_SLOT_SIZE = int(os.environ.get('SHARED_CACHE_SLOT_SIZE',
+                                            str(1024 * 1024)))
+
+# Cache-Control header of the read endpoints
+CACHE_CONTROL_GROUPS = os.environ.get('CACHE_CONTROL_GROUPS', 'no-cache')
+CACHE_CONTROL_STATISTICS = os.environ.get('CACHE_CONTROL_STATISTICS',
+                                          'no-cache')
+
+# compression of responses (gzip, and brotli when it is installed)
+COMPRESSION_ENABLED = os.environ.get('COMPRESSION_ENABLED',
+                                     'true').lower() == 'true'
+# smaller complete responses are sent uncompressed
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '1024'))
+COMPRESSION_MIMETYPES = ['application/json', 'application/msgpack',
+                         'application/cbor']
+COMPRESSION_GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', '6'))
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get('COMPRESSION_BROTLI_QUALITY',
+                                                '5'))
+
+# PATCH /images
+BULK_UPDATE_MAX_ITEMS = int(os.environ.get('BULK_UPDATE_MAX_ITEMS', '1000'))
+
+# write coalescing of PUT /images/<image_id>: updates are queued per
+# worker and written in batches (see models/write_queue.py)
+WRITE_COALESCING_ENABLED = os.environ.get('WRITE_COALESCING_ENABLED',
+                                          'false').lower() == 'true'
+# a batch is written when it has this many images...
+WRITE_COALESCING_MAX_BATCH = int(os.environ.get('WRITE_COALESCING_MAX_BATCH',
+                                                '500'))
+# ...or this many seconds after its oldest update was accepted
+WRITE_COALESCING_INTERVAL = float(os.environ.get('WRITE_COALESCING_INTERVAL',
+                                                 '0.2'))
+# images queued by a worker, further updates are written directly
+WRITE_COALESCING_MAX_PENDING = int(os.environ.get(
+                                    'WRITE_COALESCING_MAX_PENDING', '10000'))
+# writes of a batch before its updates are reported as failed
+WRITE_COALESCING_MAX_ATTEMPTS = int(os.environ.get(
+                                    'WRITE_COALESCING_MAX_ATTEMPTS', '3'))
+# seconds the results of written batches are kept for status checks
+WRITE_COALESCING_RESULT_TTL = int(os.environ.get(
+                                    'WRITE_COALESCING_RESULT_TTL', '3600'))
+
+# identical concurrent read requests of a worker share one response (see
+# app/single_flight.py)
+SINGLE_FLIGHT_ENABLED = os.environ.get('SINGLE_FLIGHT_ENABLED',
+                                       'true').lower() == 'true'
+# seconds a request waits for the identical one in flight, then it runs
+# the view itself
+SINGLE_FLIGHT_TIMEOUT = float(os.environ.get('SINGLE_FLIGHT_TIMEOUT', '10'))
+
+# admission control of the expensive read routes of a worker (see
+# utils/admission.py): concurrent requests per route, 0 disables a limit
+ADMISSION_CONTROL_ENABLED = os.environ.get('ADMISSION_CONTROL_ENABLED',
+                                           'true').lower() == 'true'
+ADMISSION_LIMITS = {
+    '/groups': int(os.environ.get('ADMISSION_LIMIT_GROUPS',
+                                  str(max(1, WORKER_THREADS // 2)))),
+    '/statistics': int(os.environ.get('ADMISSION_LIMIT_STATISTICS',
+                                      str(max(1, WORKER_THREADS // 4)))),
+}
+# requests of a route waiting for a free slot, more are rejected at once
+ADMISSION_QUEUE_SIZE = int(os.environ.get('ADMISSION_QUEUE_SIZE', '2'))
+# seconds a request waits at most for a free slot
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT',
+                                               '0.5'))
+# threads that limited requests may occupy, running or waiting; the
+# other threads stay free for writes and cheap reads
+ADMISSION_MAX_THREADS = int(os.environ.get('ADMISSION_MAX_THREADS',
+                                           str(max(1, WORKER_THREADS - 1))))
+# Retry-After (seconds) of rejected requests
+ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', '1'))
+
+# GET /events of the async application, Server-Sent Events of the image
+# status changes (see models/events.py)
+EVENTS_ENABLED = os.environ.get('EVENTS_ENABLED', 'true').lower() == 'true'
+# auto: change streams on a replica set or mongos, otherwise events
+# published by the status updates; change_stream or publisher
+EVENTS_SOURCE = os.environ.get('EVENTS_SOURCE', 'auto').lower()
+# read old_status from the pre-images of the change streams (MongoDB 6.0+)
+EVENTS_PRE_IMAGES = os.environ.get('EVENTS_PRE_IMAGES',
+                                   'true').lower() == 'true'
+# size (bytes) of the capped collection of the published events
+EVENTS_COLLECTION_SIZE = int(os.environ.get('EVENTS_COLLECTION_SIZE',
+                                            str(16 * 1024 * 1024)))
+# last events a worker keeps for reconnecting clients
+EVENTS_BUFFER_SIZE = int(os.environ.get('EVENTS_BUFFER_SIZE', '1000'))
+# events waiting to be sent to a client, a slower client is disconnected
+# and resumes from its last event
+EVENTS_QUEUE_SIZE = int(os.environ.get('EVENTS_QUEUE_SIZE', '100'))
+# seconds between keep-alive comments of an idle stream
+EVENTS_HEARTBEAT = float(os.environ.get('EVENTS_HEARTBEAT', '15'))
+# milliseconds a client waits before it reconnects
+EVENTS_RETRY_MS = int(os.environ.get('EVENTS_RETRY_MS', '3000'))
+# milliseconds a change stream or a tailable cursor waits for new events
+EVENTS_MAX_AWAIT_MS = int(os.environ.get('EVENTS_MAX_AWAIT_MS', '1000'))
+
+# Prometheus metrics at /metrics (needs prometheus_client)
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+
+# profiler of slow aggregations (/debug/slow-queries)
+PROFILER_ENABLED = os.environ.get('PROFILER_ENABLED',
+                                  'true').lower() == 'true'
+PROFILER_SLOW_MS = float(os.environ.get('PROFILER_SLOW_MS', '500'))
+# share of the slow aggregations that are explained
+PROFILER_SAMPLE_RATE = float(os.environ.get('PROFILER_SAMPLE_RATE', '0.1'))
+# seconds between two explains of the same aggregation
+PROFILER_MIN_INTERVAL = float(os.environ.get('PROFILER_MIN_INTERVAL', '60'))
+PROFILER_BUFFER_SIZE = int(os.environ.get('PROFILER_BUFFER_SIZE', '50'))
+PROFILER_EXPLAIN_MAX_TIME_MS = int(os.environ.get(
+                                    'PROFILER_EXPLAIN_MAX_TIME_MS', '5000'))
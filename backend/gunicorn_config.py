@@ -1,4 +1,7 @@
 import os
+import shutil
+import sys
+import tempfile
 
 workers = int(os.environ.get('GUNICORN_PROCESSES', '2'))
 threads = int(os.environ.get('GUNICORN_THREADS', '4'))
@@ -6,4 +9,65 @@ threads = int(os.environ.get('GUNICORN_THREADS', '4'))
 bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
 
 forwarded_allow_ips = '*'
-secure_scheme_headers = { 'X-Forwarded-Proto': 'https' }
\ No newline at end of file
+secure_scheme_headers = { 'X-Forwarded-Proto': 'https' }
+
+# the workers write their Prometheus metrics to this directory, /metrics
+# aggregates them (see utils/metrics.py); it is inherited by the workers
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR',
+                      os.path.join(tempfile.gettempdir(),
+                                   f'image-service-metrics-{os.getpid()}'))
+
+
+def on_starting(server):
+    # metrics of a previous run must not be added to this one
+    metrics_dir = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+
+def child_exit(server, worker):
+    try:
+        from prometheus_client import multiprocess
+    except ImportError:
+        return
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def post_fork(server, worker):
+    # the connection pool of the worker is sized from the thread count
+    # (see config/config.py), pass the actual one, e.g. from --threads
+    os.environ['GUNICORN_THREADS'] = str(server.cfg.threads)
+
+
+def post_worker_init(worker):
+    # open MongoDB connections before the worker accepts requests, only
+    # the Flask application (sync/gthread workers) uses models.models
+    if not type(worker).__module__.startswith('gunicorn.'):
+        return
+    from pymongo.errors import PyMongoError
+    from models.models import warm_up
+    from models.indexes import verify_indexes
+    warm_up()
+    # indexes are created by 'flask --app run migrate-indexes', not at boot
+    try:
+        missing = verify_indexes()
+    except PyMongoError as err:
+        worker.log.warning("could not verify MongoDB indexes: %s", err)
+        return
+    except RuntimeError as err:
+        # an unsupported server version, the worker does not boot
+        worker.log.error("%s", err)
+        raise
+    if missing:
+        worker.log.warning("missing MongoDB indexes: %s, run "
+                           "'flask --app run migrate-indexes'",
+                           ', '.join(f'{collection}.{index}'
+                                     for collection, index in missing))
+
+
+def worker_exit(server, worker):
+    # status updates queued by write coalescing are written before a
+    # stopped or recycled worker exits (see models/write_queue.py)
+    views = sys.modules.get('app.views')
+    if views is not None and views.write_coalescer is not None:
+        views.write_coalescer.close()
@@ -0,0 +1,372 @@
+"""
+Async MongoDB Access
+
+Motor (asyncio) counterparts of the database functions used by the views,
+for the async entry point ('async_app'). Queries, pipelines and write
+requests are built by the same helpers as in the synchronous models
+('models.pipelines', 'models.counters', 'models.statistics'), only the
+I/O is awaited, so both entry points read and write the same documents.
+
+status_events() is the source of the status change events of GET
+/events ('async_app.events'): the change streams of the images
+collection, or the events published to the events collection
+('models.events').
+
+The Motor client is created on first use in every process, like the
+MongoClient of 'models.models': it attaches to the event loop running
+then, and a forked worker creates its own. Checks of the server
+(transactions, change streams) and the sealing of the daily statistics
+are done once by the synchronous models in a thread.
+
+Usage:
+- Configure the MongoDB connection in 'config.config', the same way as
+for 'models.models'. Indexes are created by 'models.indexes'.
+
+Dependencies:
+- motor, see requirements-async.txt.
+"""
+
+import asyncio
+import logging
+import os
+import re
+from collections import Counter, defaultdict
+from contextlib import aclosing
+from datetime import datetime
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import CursorType
+from pymongo.errors import CollectionInvalid, OperationFailure, PyMongoError
+import models.models
+import models.events
+import models.statistics
+from models.models import LazyProxy
+from models.counters import GLOBAL_COUNTER_ID
+from models.images import IMAGE_STATE_PROJECTION, status_change_requests
+from models.events import (STATUS_CHANGES_PIPELINE, RESUME_ERROR_CODES,
+                           status_event, change_event, published_event)
+from models.statistics import (day_start, images_per_day_pipeline,
+                               SEAL_ID)
+from config.config import (MONGODB_URI,
+                           MONGODB_DB_NAME,
+                           MONGODB_IMAGE_COLLECTION_NAME,
+                           MONGODB_GROUPS_COLLECTION_NAME,
+                           MONGODB_COUNTERS_COLLECTION_NAME,
+                           MONGODB_DAILY_STATISTICS_COLLECTION_NAME,
+                           MONGODB_EVENTS_COLLECTION_NAME,
+                           EVENTS_PRE_IMAGES,
+                           EVENTS_COLLECTION_SIZE,
+                           EVENTS_MAX_AWAIT_MS,
+                           )
+from utils.broadcast import ResumeError
+
+logger = logging.getLogger(__name__)
+
+_client = None
+
+
+def get_client():
+    """
+    Motor client of the current process, created on first use.
+
+    Returns:
+        AsyncIOMotorClient: The client.
+    """
+    global _client
+    if _client is None:
+        _client = AsyncIOMotorClient(MONGODB_URI)
+    return _client
+
+
+def _reset_after_fork():
+    # see 'models.models._reset_after_fork'
+    global _client
+    _client = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+client = LazyProxy(get_client)
+db = LazyProxy(lambda: get_client()[MONGODB_DB_NAME])
+
+images_collection = LazyProxy(
+    lambda: get_client()[MONGODB_DB_NAME][MONGODB_IMAGE_COLLECTION_NAME])
+groups_collection = LazyProxy(
+    lambda: get_client()[MONGODB_DB_NAME][MONGODB_GROUPS_COLLECTION_NAME])
+counters_collection = LazyProxy(
+    lambda: get_client()[MONGODB_DB_NAME][MONGODB_COUNTERS_COLLECTION_NAME])
+daily_statistics_collection = LazyProxy(
+    lambda: get_client()[MONGODB_DB_NAME][
+        MONGODB_DAILY_STATISTICS_COLLECTION_NAME])
+
+
+_transactions_supported = None
+
+
+async def transactions_supported():
+    """
+    'models.models.transactions_supported', checked once in a thread.
+    """
+    global _transactions_supported
+    if _transactions_supported is None:
+        _transactions_supported = await asyncio.to_thread(
+            models.models.transactions_supported)
+    return _transactions_supported
+
+
+async def run_in_transaction(callback):
+    """
+    Run a coroutine function that writes several documents atomically.
+
+    Args:
+        callback (callable): Coroutine function taking a session (or None
+            when transactions are not used) that performs the writes.
+
+    Returns:
+        The value returned by the callback.
+    """
+    if not await transactions_supported():
+        return await callback(None)
+    async with await client.start_session() as session:
+        return await session.with_transaction(callback)
+
+
+async def set_image_status(image_id, new_status):
+    """
+    Async version of 'models.images.set_image_status'.
+    """
+    async def update(session):
+        image = await images_collection.find_one_and_update(
+            {'_id': image_id},
+            {'$set': {'status': new_status}},
+            projection=IMAGE_STATE_PROJECTION,
+            session=session,
+        )
+        if image and image.get('status') != new_status:
+            counter_requests, statistics_requests = status_change_requests(
+                [(image, new_status)])
+            await counters_collection.bulk_write(counter_requests,
+                                                 ordered=False,
+                                                 session=session)
+            if statistics_requests:
+                await daily_statistics_collection.bulk_write(
+                    statistics_requests, ordered=False, session=session)
+        return image
+
+    image = await run_in_transaction(update)
+    if image and image.get('status') != new_status:
+        await publish_status_events([(image, new_status)])
+    return image
+
+
+async def get_global_counts():
+    """
+    Number of all images per status read from the global counter.
+
+    Returns:
+        dict: {status: number of images} without empty statuses.
+    """
+    counters = await counters_collection.find_one({'_id': GLOBAL_COUNTER_ID})
+    counts = counters.get('counts', {}) if counters else {}
+    return {status: count for status, count in counts.items() if count}
+
+
+async def count_images_per_day(start, end):
+    """
+    Async version of 'models.statistics.count_images_per_day'.
+    """
+    counts = defaultdict(Counter)
+    async for item in images_collection.aggregate(
+            images_per_day_pipeline(start, end)):
+        counts[item['_id']['day']][item['_id']['status']] += item['count']
+    return counts
+
+
+async def sealed_until():
+    """
+    Async version of 'models.statistics.sealed_until'.
+    """
+    seal = await daily_statistics_collection.find_one({'_id': SEAL_ID})
+    return seal.get('sealed_until') if seal else None
+
+
+async def get_daily_statistics(start, end):
+    """
+    Async version of 'models.statistics.get_daily_statistics'.
+
+    The days that ended since the frontier are sealed by
+    'models.statistics.seal_days' in a thread, it runs once a day under
+    the lease of the seal document.
+    """
+    today = day_start(datetime.utcnow())
+    live_from = await sealed_until()
+    if live_from is not None and live_from < today:
+        await asyncio.to_thread(models.statistics.seal_days, today)
+        live_from = await sealed_until()
+    # nothing sealed: every day is counted live
+    live_from = live_from or start
+
+    counts = defaultdict(Counter)
+    async for day in daily_statistics_collection.find(
+            {'_id': {'$gte': start, '$lt': min(end, live_from)}}):
+        counts[day['_id']].update(day.get('counts', {}))
+
+    if end > live_from:
+        live_counts = await count_images_per_day(max(start, live_from), end)
+        for day, day_counts in live_counts.items():
+            counts[day].update(day_counts)
+    return counts
+
+
+_events_collection_created = False
+
+
+async def events_collection():
+    """
+    Async version of 'models.events.events_collection'.
+    """
+    global _events_collection_created
+    if not _events_collection_created:
+        try:
+            await db.create_collection(MONGODB_EVENTS_COLLECTION_NAME,
+                                       capped=True,
+                                       size=EVENTS_COLLECTION_SIZE)
+        except CollectionInvalid:
+            pass  # created by another worker
+        _events_collection_created = True
+    return db[MONGODB_EVENTS_COLLECTION_NAME]
+
+
+_publishes_events = None
+
+
+async def publishes_events():
+    """
+    'models.events.publishes_events', checked once in a thread.
+    """
+    global _publishes_events
+    if _publishes_events is None:
+        _publishes_events = await asyncio.to_thread(
+            models.events.publishes_events)
+    return _publishes_events
+
+
+async def publish_status_events(changes):
+    """
+    Async version of 'models.events.publish_status_events'.
+    """
+    if not changes or not await publishes_events():
+        return
+    ts = datetime.utcnow()
+    try:
+        collection = await events_collection()
+        await collection.insert_many([status_event(image, new_status, ts)
+                                      for image, new_status in changes])
+    except PyMongoError as err:
+        logger.warning("publishing %d status events failed: %s",
+                       len(changes), err)
+
+
+async def watch_status_changes(after=None):
+    """
+    Status change events of the change stream of the images collection,
+    a source of 'utils.broadcast.Broadcaster'.
+
+    Args:
+        after (str, optional): Resume token of the last event, the new
+            events for None.
+
+    Yields:
+        (id, event) tuples, None when no change arrived within
+        EVENTS_MAX_AWAIT_MS.
+
+    Raises:
+        ResumeError: If the stream can not be resumed after the token.
+    """
+    if after is not None and not re.fullmatch('[0-9A-Fa-f]+', after):
+        raise ResumeError(f"Invalid resume token {after!r}")
+    options = {'full_document': 'updateLookup',
+               'max_await_time_ms': EVENTS_MAX_AWAIT_MS}
+    if EVENTS_PRE_IMAGES:
+        options['full_document_before_change'] = 'whenAvailable'
+    if after is not None:
+        options['resume_after'] = {'_data': after}
+    try:
+        async with images_collection.watch(STATUS_CHANGES_PIPELINE,
+                                           **options) as stream:
+            while stream.alive:
+                change = await stream.try_next()
+                yield None if change is None else change_event(change)
+    except OperationFailure as err:
+        if err.code in RESUME_ERROR_CODES:
+            raise ResumeError(str(err)) from err
+        raise
+
+
+async def tail_status_events(after=None):
+    """
+    Status change events of the events collection, read with a tailable
+    cursor, a source of 'utils.broadcast.Broadcaster'.
+
+    Args:
+        after (str, optional): ObjectId of the last event, the new events
+            for None.
+
+    Yields:
+        (id, event) tuples, None when no event arrived within
+        EVENTS_MAX_AWAIT_MS.
+
+    Raises:
+        ResumeError: If the event is not in the collection any more.
+    """
+    collection = await events_collection()
+    if after is None:
+        last = await collection.find_one(sort=[('$natural', -1)])
+        after = str(last['_id']) if last else None
+    elif not ObjectId.is_valid(after):
+        raise ResumeError(f"Invalid event id {after!r}")
+    while True:
+        query = {}
+        if after is not None:
+            # ObjectIds of different workers are not ordered within a
+            # second: read the events of the second of the last one in
+            # the insertion order and skip them up to the last one
+            second = ObjectId(after).generation_time
+            query = {'_id': {'$gte': ObjectId.from_datetime(second)}}
+        found = after is None
+        cursor = collection.find(query,
+                                 cursor_type=CursorType.TAILABLE_AWAIT)
+        cursor.max_await_time_ms(EVENTS_MAX_AWAIT_MS)
+        try:
+            while cursor.alive:
+                try:
+                    document = await cursor.next()
+                except StopAsyncIteration:
+                    if not found:
+                        raise ResumeError(f"Event {after} was dropped")
+                    yield None
+                    continue
+                if not found:
+                    found = str(document['_id']) == after
+                    continue
+                after, event = published_event(document)
+                yield after, event
+        finally:
+            await cursor.close()
+        # a tailable cursor dies e.g. on an empty collection
+        await asyncio.sleep(EVENTS_MAX_AWAIT_MS / 1000)
+
+
+async def status_events(after=None):
+    """
+    Source of the status change events of GET /events: the change stream
+    of the images collection, or the events published by the status
+    updates (see 'models.events').
+    """
+    if await publishes_events():
+        source = tail_status_events
+    else:
+        source = watch_status_changes
+    async with aclosing(source(after)) as events:
+        async for entry in events:
+            yield entry
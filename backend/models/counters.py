@@ -0,0 +1,160 @@
+"""
+Materialized Image Counters
+
+Number of images per group and status, plus the number of images per
+status over all groups, stored in the counters collection:
+
+    {"_id": ObjectId("<group id>"), "counts": {"new": 3, "review": 2}}
+    {"_id": "global", "counts": {"new": 30, "review": 20}}
+
+The same collection holds the data version, a number incremented with
+every change of the counters. It identifies the state of the data for
+conditional requests (ETag):
+
+    {"_id": "data_version", "version": 42}
+
+The counters are updated with $inc together with every status change
+made by the application (see 'models.images') and by the seeding script,
+so reading a count is a single lookup by _id. Images written by other
+services are not counted; rebuild_counters() recomputes the counters
+from the images collection and reports the drift.
+"""
+
+from collections import Counter, defaultdict
+from pymongo import ReplaceOne, UpdateOne
+from models.models import (images_collection, counters_collection,
+                           PRIMARY_READS)
+
+GLOBAL_COUNTER_ID = 'global'
+DATA_VERSION_ID = 'data_version'
+
+
+def counter_updates(changes):
+    """
+    Build counter updates for a set of status changes.
+
+    Args:
+        changes (iterable): Tuples (group_id, old_status, new_status).
+            old_status is None for a new image and new_status is None
+            for a removed image.
+
+    Returns:
+        list: UpdateOne requests for counters_collection.bulk_write.
+    """
+    increments = defaultdict(Counter)
+    for group_id, old_status, new_status in changes:
+        for counter_id in (group_id, GLOBAL_COUNTER_ID):
+            if old_status:
+                increments[counter_id][old_status] -= 1
+            if new_status:
+                increments[counter_id][new_status] += 1
+    requests = []
+    for counter_id, increment in increments.items():
+        inc = {f'counts.{status}': number
+               for status, number in increment.items() if number}
+        if inc:
+            requests.append(UpdateOne({'_id': counter_id},
+                                      {'$inc': inc},
+                                      upsert=True))
+    return requests
+
+
+def data_version_update():
+    """
+    Request incrementing the data version.
+
+    Returns:
+        UpdateOne: Request for counters_collection.bulk_write.
+    """
+    return UpdateOne({'_id': DATA_VERSION_ID},
+                     {'$inc': {'version': 1}},
+                     upsert=True)
+
+
+def bump_data_version(session=None):
+    """
+    Increment the data version, e.g. after the data was changed without
+    a status change ('models.images.write_status_changes').
+    """
+    counters_collection.bulk_write([data_version_update()], session=session)
+
+
+def get_data_version(reads=PRIMARY_READS):
+    """
+    Current data version.
+
+    Args:
+        reads (Reads, optional): Read preference and session of the read
+            ('models.models.Reads'). Read the version in the session of
+            the data it stands for, so the data is at least as new.
+
+    Returns:
+        int: The version, 0 if the data was never changed.
+    """
+    version = reads(counters_collection).find_one({'_id': DATA_VERSION_ID},
+                                                  session=reads.session)
+    return version['version'] if version else 0
+
+
+def count_images():
+    """
+    Count images per group and status by scanning the images collection.
+
+    Returns:
+        dict: {counter id: {status: number of images}} including the
+        global counter.
+    """
+    counts = defaultdict(Counter)
+    pipeline = [
+        {
+            '$group': {
+                '_id': {'group_id': '$group_id', 'status': '$status'},
+                'count': {'$sum': 1}
+            }
+        }
+    ]
+    for item in images_collection.aggregate(pipeline):
+        status = item['_id']['status']
+        counts[item['_id']['group_id']][status] += item['count']
+        counts[GLOBAL_COUNTER_ID][status] += item['count']
+    return counts
+
+
+def rebuild_counters(dry_run=False):
+    """
+    Recompute the counters from scratch and report the drift.
+
+    Status changes made while the images are being counted can be lost,
+    run it when the service is quiet or check again with dry_run.
+
+    Args:
+        dry_run (bool): Only report the drift, do not fix the counters.
+
+    Returns:
+        list: Tuples (counter id, status, stored count, actual count)
+        for every counter that did not match the images collection.
+    """
+    actual = count_images()
+    stored = {counter['_id']: counter.get('counts', {})
+              for counter in counters_collection.find(
+                  {'_id': {'$ne': DATA_VERSION_ID}})}
+
+    drift = []
+    for counter_id in set(actual) | set(stored):
+        actual_counts = actual.get(counter_id, {})
+        stored_counts = stored.get(counter_id, {})
+        for status in sorted(set(actual_counts) | set(stored_counts)):
+            if actual_counts.get(status, 0) != stored_counts.get(status, 0):
+                drift.append((counter_id, status,
+                              stored_counts.get(status, 0),
+                              actual_counts.get(status, 0)))
+
+    if drift and not dry_run:
+        drifted = {counter_id for counter_id, *_ in drift}
+        counters_collection.bulk_write([
+            ReplaceOne({'_id': counter_id},
+                       {'counts': dict(actual.get(counter_id, {}))},
+                       upsert=True)
+            for counter_id in drifted
+        ] + [data_version_update()], ordered=False)
+    return drift
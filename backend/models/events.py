@@ -0,0 +1,181 @@
+"""
+Image Status Events
+
+Compact events of the status changes of the images, pushed to clients by
+GET /events of the async application ('async_app.events'):
+
+    {"image_id": "...", "group_id": "...", "old_status": "new",
+     "new_status": "review", "ts": "2023-09-18T12:00:00Z"}
+
+The events come from one of two sources (EVENTS_SOURCE):
+
+- 'change_stream': change streams of the images collection, on a replica
+  set or a sharded cluster. Every status change is seen, also the ones
+  written by other services. old_status is read from the pre-image of
+  the document, which must be enabled on the collection (MongoDB 6.0+),
+  otherwise it is null:
+      db.runCommand({collMod: "images",
+                     changeStreamPreAndPostImages: {enabled: true}})
+  The id of an event is the resume token of the change.
+- 'publisher': the status updates of this service ('models.images',
+  'models.async_models') publish their events to a capped collection
+  after the write, for servers without change streams. Changes written
+  by other services are not seen. The oldest events are dropped when the
+  collection is full (EVENTS_COLLECTION_SIZE). The id of an event is its
+  ObjectId.
+
+'auto' uses change streams when the server supports them.
+
+Configuration (see 'config.config'):
+- EVENTS_ENABLED, EVENTS_SOURCE, EVENTS_PRE_IMAGES,
+- EVENTS_COLLECTION_SIZE and MONGODB_EVENTS_COLLECTION_NAME.
+"""
+
+import logging
+from datetime import datetime
+from pymongo.errors import CollectionInvalid, PyMongoError
+from models.models import client, db, get_collection
+from config.config import (EVENTS_ENABLED,
+                           EVENTS_SOURCE,
+                           EVENTS_COLLECTION_SIZE,
+                           MONGODB_EVENTS_COLLECTION_NAME,
+                           )
+
+logger = logging.getLogger(__name__)
+
+# status updates of the images collection, with the fields of an event
+STATUS_CHANGES_PIPELINE = [
+    {'$match': {'operationType': 'update',
+                'updateDescription.updatedFields.status': {'$exists': True}}},
+    {'$project': {'documentKey': 1,
+                  'clusterTime': 1,
+                  'wallTime': 1,
+                  'fullDocument.group_id': 1,
+                  'fullDocumentBeforeChange.status': 1,
+                  'updateDescription.updatedFields.status': 1}},
+]
+
+# change stream errors of a resume token that can not be resumed
+RESUME_ERROR_CODES = (260, 280, 286)
+
+
+def status_event(image, new_status, ts):
+    """
+    Event of a status change.
+
+    Args:
+        image (dict): The image before the change, with '_id', 'status'
+            and 'group_id'.
+        new_status (str): Status after the change.
+        ts (datetime): Time of the change, UTC.
+
+    Returns:
+        dict: The event.
+    """
+    return {
+        'image_id': image['_id'],
+        'group_id': image.get('group_id'),
+        'old_status': image.get('status'),
+        'new_status': new_status,
+        'ts': ts,
+    }
+
+
+def change_event(change):
+    """
+    Event of a change of a change stream with STATUS_CHANGES_PIPELINE.
+
+    Returns:
+        tuple: (id, event), id is the resume token of the change.
+    """
+    # wallTime since MongoDB 6.0
+    ts = change.get('wallTime')
+    if ts is None:
+        ts = change['clusterTime'].as_datetime().replace(tzinfo=None)
+    image = {
+        '_id': change['documentKey']['_id'],
+        'group_id': (change.get('fullDocument') or {}).get('group_id'),
+        'status': (change.get('fullDocumentBeforeChange') or {}).get(
+            'status'),
+    }
+    new_status = change['updateDescription']['updatedFields']['status']
+    return change['_id']['_data'], status_event(image, new_status, ts)
+
+
+def published_event(document):
+    """
+    Event of a document of the events collection.
+
+    Returns:
+        tuple: (id, event), id is the ObjectId of the document as string.
+    """
+    event = dict(document)
+    return str(event.pop('_id')), event
+
+
+_events_collection_created = False
+
+
+def events_collection():
+    """
+    The capped collection of the published events, created on first use.
+    """
+    global _events_collection_created
+    if not _events_collection_created:
+        try:
+            db.create_collection(MONGODB_EVENTS_COLLECTION_NAME,
+                                 capped=True, size=EVENTS_COLLECTION_SIZE)
+        except CollectionInvalid:
+            pass  # created by another worker
+        _events_collection_created = True
+    return get_collection(MONGODB_EVENTS_COLLECTION_NAME)
+
+
+_change_streams_supported = None
+
+
+def change_streams_supported():
+    """
+    Check whether the server is a replica set member or a mongos, which
+    have change streams. The result is cached.
+    """
+    global _change_streams_supported
+    if _change_streams_supported is None:
+        hello = client.admin.command('hello')
+        _change_streams_supported = bool(hello.get('setName')
+                                         or hello.get('msg') == 'isdbgrid')
+    return _change_streams_supported
+
+
+def publishes_events():
+    """
+    Check whether the status updates publish their events, i.e. whether
+    the events are not read from change streams.
+    """
+    if not EVENTS_ENABLED:
+        return False
+    if EVENTS_SOURCE != 'auto':
+        return EVENTS_SOURCE == 'publisher'
+    return not change_streams_supported()
+
+
+def publish_status_events(changes):
+    """
+    Publish the events of status changes written by this service, when
+    the events are not read from change streams. A failure is logged
+    only, the changes are written already.
+
+    Args:
+        changes (list): Tuples (image, new status), image as read before
+            the update (see 'models.images.IMAGE_STATE_PROJECTION').
+    """
+    if not changes or not publishes_events():
+        return
+    ts = datetime.utcnow()
+    try:
+        events_collection().insert_many(
+            [status_event(image, new_status, ts)
+             for image, new_status in changes])
+    except PyMongoError as err:
+        logger.warning("publishing %d status events failed: %s",
+                       len(changes), err)
@@ -0,0 +1,207 @@
+"""
+Image Writes
+
+Functions changing images. Every change of an image status also updates
+the materialized counters ('models.counters') and the daily statistics
+('models.statistics'); all writes run in one transaction when the server
+supports it ('models.models.run_in_transaction'). The status changes are
+then published as events when change streams are not available
+('models.events').
+"""
+
+import logging
+from pymongo import UpdateOne
+from models.models import (images_collection, counters_collection,
+                           daily_statistics_collection, run_in_transaction)
+from models.counters import counter_updates, data_version_update
+from models.statistics import daily_statistics_updates
+from models.events import publish_status_events
+
+logger = logging.getLogger(__name__)
+
+# fields of the previous image state needed to update derived data
+IMAGE_STATE_PROJECTION = {'status': 1, 'group_id': 1, 'created_at': 1}
+
+
+def status_change_requests(changes):
+    """
+    Build the updates of the data derived from status changes, shared
+    with the async models ('models.async_models').
+
+    Args:
+        changes (list): Tuples (image before the change, new status),
+            the image with the fields of IMAGE_STATE_PROJECTION.
+
+    Returns:
+        tuple: (counter requests, daily statistics requests), UpdateOne
+        requests for the bulk writes of the counters (the data version
+        included) and of the daily statistics, empty without changes.
+    """
+    counter_requests = counter_updates([(image['group_id'],
+                                         image.get('status'), new_status)
+                                        for image, new_status in changes])
+    if counter_requests:
+        counter_requests.append(data_version_update())
+    statistics_requests = daily_statistics_updates(
+        [(image.get('created_at'), image.get('status'), new_status)
+         for image, new_status in changes])
+    return counter_requests, statistics_requests
+
+
+def write_status_changes(changes, session=None):
+    """
+    Update the counters, the data version and the daily statistics for
+    status changes.
+
+    Args:
+        changes (list): Tuples (image before the change, new status).
+        session (ClientSession, optional): Session of the transaction
+            the changes belong to.
+    """
+    counter_requests, statistics_requests = status_change_requests(changes)
+    if counter_requests:
+        counters_collection.bulk_write(counter_requests, ordered=False,
+                                       session=session)
+    if statistics_requests:
+        daily_statistics_collection.bulk_write(statistics_requests,
+                                               ordered=False,
+                                               session=session)
+
+
+def set_image_status(image_id, new_status, session=None):
+    """
+    Change the status of an image.
+
+    Args:
+        image_id (ObjectId): Identifier of the image.
+        new_status (str): Valid image status.
+        session (ClientSession, optional): Session of the writes, see
+            'models.models.run_in_transaction'.
+
+    Returns:
+        dict: The image before the update ('_id', 'status', 'group_id'
+        and 'created_at'), or None if the image does not exist.
+    """
+    def update(session):
+        image = images_collection.find_one_and_update(
+            {'_id': image_id},
+            {'$set': {'status': new_status}},
+            projection=IMAGE_STATE_PROJECTION,
+            session=session,
+        )
+        if image and image.get('status') != new_status:
+            write_status_changes([(image, new_status)], session)
+        return image
+
+    image = run_in_transaction(update, session)
+    if image and image.get('status') != new_status:
+        publish_status_events([(image, new_status)])
+    return image
+
+
+def set_image_statuses(updates, session=None):
+    """
+    Change the status of many images with one bulk write.
+
+    Images are updated only if their status is still the one read before
+    the update, and only the images that were modified are counted. In a
+    transaction that is always all of them. Without transactions an image
+    may be changed concurrently by another request: the images that were
+    not modified are found by reading them again and are then updated one
+    by one, like set_image_status. Only if another request set the same
+    status on an image at the same time, which images this request
+    modified is unknown: the images that have the new status get the
+    result 'conflict' and are not counted by this request, the counters
+    may drift (see 'models.counters.rebuild_counters').
+
+    Args:
+        updates (dict): {image ObjectId: new valid status}.
+        session (ClientSession, optional): Session of the writes, see
+            'models.models.run_in_transaction'.
+
+    Returns:
+        dict: {image ObjectId: 'updated', 'unchanged', 'not_found' or
+        'conflict'}.
+    """
+    def update(session):
+        images = {image['_id']: image for image in images_collection.find(
+            {'_id': {'$in': list(updates)}},
+            IMAGE_STATE_PROJECTION,
+            session=session,
+        )}
+
+        results = {}
+        requests = []
+        changes = []
+        for image_id, new_status in updates.items():
+            image = images.get(image_id)
+            if image is None:
+                results[image_id] = 'not_found'
+            elif image.get('status') == new_status:
+                results[image_id] = 'unchanged'
+            else:
+                results[image_id] = 'updated'
+                requests.append(UpdateOne(
+                    {'_id': image_id, 'status': image.get('status')},
+                    {'$set': {'status': new_status}},
+                ))
+                changes.append((image, new_status))
+
+        if requests:
+            result = images_collection.bulk_write(requests, ordered=False,
+                                                  session=session)
+            if result.modified_count < len(requests):
+                changes = _update_conflicting(changes, result.modified_count,
+                                              results, session)
+            write_status_changes(changes, session)
+        return results, changes
+
+    results, changes = run_in_transaction(update, session)
+    publish_status_events(changes)
+    return results
+
+
+def _update_conflicting(changes, modified, results, session):
+    """
+    Settle the changes of a bulk write of set_image_statuses of which only
+    'modified' were applied, because their images changed concurrently.
+
+    The bulk write only tells how many images it modified. When as many
+    images have the new status, they were all modified by it. Otherwise
+    another request set the same status on some of them and which ones
+    is unknown, they are reported as 'conflict'.
+
+    Returns:
+        list: The changes that were applied, (image before the change,
+        new status) tuples. 'results' is updated for the others.
+    """
+    statuses = {image['_id']: image.get('status')
+                for image in images_collection.find(
+                    {'_id': {'$in': [image['_id'] for image, _ in changes]}},
+                    {'status': 1}, session=session)}
+    applied = [(image, new_status) for image, new_status in changes
+               if statuses.get(image['_id']) == new_status]
+    if len(applied) != modified:
+        logger.warning("a bulk status update modified %d images, %d have "
+                       "the new status: they were changed concurrently, "
+                       "counters may drift", modified, len(applied))
+        for image, _ in applied:
+            results[image['_id']] = 'conflict'
+        applied = []
+
+    for image, new_status in changes:
+        if statuses.get(image['_id']) == new_status:
+            continue
+        previous = images_collection.find_one_and_update(
+            {'_id': image['_id']},
+            {'$set': {'status': new_status}},
+            projection=IMAGE_STATE_PROJECTION,
+            session=session,
+        )
+        if previous is None:
+            results[image['_id']] = 'not_found'
+        elif previous.get('status') == new_status:
+            results[image['_id']] = 'unchanged'
+        else:
+            applied.append((previous, new_status))
+    return applied
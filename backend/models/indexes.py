@@ -0,0 +1,247 @@
+"""
+Index Migrations
+
+Indexes of the collections, created by versioned migrations instead of
+on every boot of a worker. Run them after a deploy that adds one:
+
+    flask --app run migrate-indexes
+
+Every migration creates and drops indexes of the collections. The
+versions that were applied are stored in the migrations collection, a
+migration runs once. Creating an index that exists and dropping one that
+does not are no-ops, so running a migration again (--force) is harmless.
+Indexes are built in the background; servers since MongoDB 4.2 build
+every index without blocking the collection anyway.
+
+The indexes follow the queries the views run:
+
+- /groups and /groups/<group_id>/images select the images of a group,
+  optionally with a status, sorted by (created_at, _id); $lookup joins
+  on group_id with the same filter and sort,
+- /statistics and the daily rollups filter images on created_at alone
+  and group them by day and status; with status in the index the
+  aggregation is covered by the index,
+- status changes find images by _id, groups are read by _id,
+- results of write coalescing batches ('models.write_queue') are found
+  by ticket and expire after WRITE_COALESCING_RESULT_TTL seconds.
+
+Workers only verify at boot that the indexes of all migrations exist
+(verify_indexes, see the post_worker_init hook in gunicorn_config.py).
+It also checks that the server runs MongoDB 5.0 or newer, a worker does
+not boot on an older server.
+index_usage() reports how often each index was used since the server
+started, according to $indexStats, to find indexes no query uses.
+
+Configuration (see 'config.config'):
+- MONGODB_MIGRATIONS_COLLECTION_NAME.
+
+The expiry of a TTL index is set when the index is created; after a
+change of WRITE_COALESCING_RESULT_TTL update it with the collMod command.
+"""
+
+from datetime import datetime
+from pymongo import ASCENDING, IndexModel
+from models.models import (get_collection, images_collection,
+                           groups_collection, counters_collection,
+                           daily_statistics_collection, check_server_version)
+from config.config import (MONGODB_IMAGE_COLLECTION_NAME,
+                           MONGODB_GROUPS_COLLECTION_NAME,
+                           MONGODB_MIGRATIONS_COLLECTION_NAME,
+                           MONGODB_WRITE_BATCHES_COLLECTION_NAME,
+                           WRITE_COALESCING_RESULT_TTL,
+                           )
+
+MIGRATIONS = [
+    {
+        'version': 1,
+        'description': "indexes of the queries of the views",
+        'create': {
+            MONGODB_IMAGE_COLLECTION_NAME: [
+                # images of a group filtered by status and sorted by
+                # creation date (the $lookup of /groups with a status
+                # filter, /groups/<group_id>/images?status=)
+                IndexModel([('group_id', ASCENDING),
+                            ('status', ASCENDING),
+                            ('created_at', ASCENDING),
+                            ('_id', ASCENDING)],
+                           name='group_id_1_status_1_created_at_1__id_1',
+                           background=True),
+                # images of a group sorted by creation date
+                IndexModel([('group_id', ASCENDING),
+                            ('created_at', ASCENDING),
+                            ('_id', ASCENDING)],
+                           name='group_id_1_created_at_1__id_1',
+                           background=True),
+                # images created in a period per status (statistics)
+                IndexModel([('created_at', ASCENDING),
+                            ('status', ASCENDING)],
+                           name='created_at_1_status_1',
+                           background=True),
+            ],
+        },
+        # indexes created by earlier versions at boot that match no query
+        'drop': {
+            MONGODB_IMAGE_COLLECTION_NAME: ['status_1_created_at_-1',
+                                            'created_at_1'],
+            MONGODB_GROUPS_COLLECTION_NAME: ['name_1'],
+        },
+    },
+    {
+        'version': 2,
+        'description': "results of the write coalescing batches",
+        'create': {
+            MONGODB_WRITE_BATCHES_COLLECTION_NAME: [
+                # status of an update by its ticket
+                IndexModel([('updates.ticket', ASCENDING)],
+                           name='updates.ticket_1',
+                           background=True),
+                # results are removed after WRITE_COALESCING_RESULT_TTL
+                IndexModel([('flushed_at', ASCENDING)],
+                           name='flushed_at_1',
+                           expireAfterSeconds=WRITE_COALESCING_RESULT_TTL,
+                           background=True),
+            ],
+        },
+        'drop': {},
+    },
+]
+
+# collections that have indexes, for index_usage
+INDEXED_COLLECTIONS = [images_collection, groups_collection,
+                       counters_collection, daily_statistics_collection]
+
+
+def migrations_collection():
+    return get_collection(MONGODB_MIGRATIONS_COLLECTION_NAME)
+
+
+def applied_versions():
+    """
+    Versions of the migrations that were applied.
+
+    Returns:
+        set: The versions.
+    """
+    return {migration['_id'] for migration in
+            migrations_collection().find({}, {'_id': 1})}
+
+
+def expected_indexes():
+    """
+    Indexes that exist after all migrations.
+
+    Returns:
+        dict: {collection name: set of index names}.
+    """
+    indexes = {}
+    for migration in MIGRATIONS:
+        for name, models in migration['create'].items():
+            indexes.setdefault(name, set()).update(
+                model.document['name'] for model in models)
+        for name, dropped in migration['drop'].items():
+            indexes.setdefault(name, set()).difference_update(dropped)
+    return indexes
+
+
+def apply_migration(migration, dry_run=False):
+    """
+    Create and drop the indexes of a migration.
+
+    Args:
+        migration (dict): One of MIGRATIONS.
+        dry_run (bool): Only report what would be done.
+
+    Returns:
+        list: Actions, tuples (action, collection name, index name) with
+        action 'create' or 'drop'. Indexes that already exist, or were
+        already dropped, are not listed.
+    """
+    actions = []
+    for name, models in migration['create'].items():
+        collection = get_collection(name)
+        existing = collection.index_information()
+        models = [model for model in models
+                  if model.document['name'] not in existing]
+        actions += [('create', name, model.document['name'])
+                    for model in models]
+        if models and not dry_run:
+            collection.create_indexes(models)
+    for name, dropped in migration['drop'].items():
+        collection = get_collection(name)
+        existing = collection.index_information()
+        for index in dropped:
+            if index in existing:
+                actions.append(('drop', name, index))
+                if not dry_run:
+                    collection.drop_index(index)
+    if not dry_run:
+        migrations_collection().replace_one(
+            {'_id': migration['version']},
+            {'description': migration['description'],
+             'applied_at': datetime.utcnow()},
+            upsert=True)
+    return actions
+
+
+def migrate_indexes(dry_run=False, force=False):
+    """
+    Apply the migrations that were not applied yet, in version order.
+
+    Args:
+        dry_run (bool): Only report what would be done.
+        force (bool): Apply all migrations again.
+
+    Returns:
+        list: Tuples (version, actions) of the applied migrations, see
+        apply_migration.
+    """
+    applied = set() if force else applied_versions()
+    results = []
+    for migration in sorted(MIGRATIONS, key=lambda item: item['version']):
+        if migration['version'] not in applied:
+            results.append((migration['version'],
+                            apply_migration(migration, dry_run)))
+    return results
+
+
+def verify_indexes():
+    """
+    Check that the server version is supported and that the indexes of
+    all migrations exist.
+
+    Returns:
+        list: Missing indexes, tuples (collection name, index name).
+
+    Raises:
+        RuntimeError: The server is older than MongoDB 5.0, see
+            'models.models.check_server_version'.
+    """
+    check_server_version()
+    missing = []
+    for name, indexes in expected_indexes().items():
+        existing = get_collection(name).index_information()
+        missing += [(name, index) for index in sorted(indexes)
+                    if index not in existing]
+    return missing
+
+
+def index_usage():
+    """
+    Usage of the indexes of the collections since the server started,
+    from $indexStats. The statistics are per server: on a replica set
+    they only cover the queries of the member that answers.
+
+    Returns:
+        list: Dicts with the collection, the index name, the number of
+        operations that used it and the time counting started.
+    """
+    usage = []
+    for collection in INDEXED_COLLECTIONS:
+        for stats in collection.aggregate([{'$indexStats': {}}]):
+            usage.append({
+                'collection': collection.name,
+                'name': stats['name'],
+                'ops': stats['accesses']['ops'],
+                'since': stats['accesses']['since'],
+            })
+    return usage
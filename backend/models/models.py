@@ -1,11 +1,33 @@
 """
-MongoDB Database Setup and Index Creation
+MongoDB Database Setup
 
 This script is responsible for setting up the MongoDB database
-connection and creating indexes
-to optimize database queries for your application. It uses the PyMongo library
+connection of your application. Indexes are created by the index
+migrations ('models.indexes'). It uses the PyMongo library
 to interact with MongoDB.
 
+The MongoClient is created on first use in every process, not at import.
+gunicorn forks its workers from the master process and a MongoClient
+must not be used across a fork, so a forked process drops the client of
+its parent and creates its own. 'client', 'db' and the collections of
+this module are stand-ins that resolve to the objects of the client of
+the current process.
+
+The connection pool of a worker is sized from the number of gunicorn
+threads (GUNICORN_THREADS): a thread uses one connection at a time, so
+a few more connections than threads are enough, and a thread waiting
+longer than MONGODB_WAIT_QUEUE_TIMEOUT_MS for a connection fails instead
+of hanging. warm_up() opens the connections before the worker accepts
+requests (see the post_worker_init hook in gunicorn_config.py).
+
+Writes always go to the primary. Reads go to the primary unless they are
+made through a Reads object with another read preference, e.g.
+secondaryPreferred with a maximum staleness for the analytics routes
+(see 'app.routing'). On a replica set the reads of a request share a
+causally consistent session: a read sees at least the data of the reads
+before it, and a client that sends the consistency token of its write
+(session_token) reads its own write even from a secondary.
+
 Usage:
 - Configure the MongoDB connection details and database/collection names in
 'config.config'.
@@ -18,23 +40,377 @@ and collection names,
   should be defined in 'config.config'.
 """
 
+import base64
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import bson
 from pymongo import MongoClient
+from pymongo.read_preferences import (Primary, PrimaryPreferred, Secondary,
+                                      SecondaryPreferred, Nearest)
+from utils.metrics import event_listeners
 from config.config import (MONGODB_URI,
                            MONGODB_DB_NAME,
                            MONGODB_IMAGE_COLLECTION_NAME,
                            MONGODB_GROUPS_COLLECTION_NAME,
+                           MONGODB_COUNTERS_COLLECTION_NAME,
+                           MONGODB_DAILY_STATISTICS_COLLECTION_NAME,
+                           MONGODB_TRANSACTIONS,
+                           MONGODB_MAX_POOL_SIZE,
+                           MONGODB_MIN_POOL_SIZE,
+                           MONGODB_WAIT_QUEUE_TIMEOUT_MS,
+                           MONGODB_CONNECT_TIMEOUT_MS,
+                           MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+                           MONGODB_SOCKET_TIMEOUT_MS,
+                           MONGODB_MAX_IDLE_TIME_MS,
+                           MONGODB_WARMUP_CONNECTIONS,
                            )
 
-# Establish a connection to the MongoDB server
-client = MongoClient(MONGODB_URI)
+_client = None
+_collections = {}
+_client_lock = threading.Lock()
+
+
+def client_options():
+    """
+    Options of the MongoClient of a worker (see 'config.config').
+    """
+    return {
+        'maxPoolSize': MONGODB_MAX_POOL_SIZE,
+        'minPoolSize': MONGODB_MIN_POOL_SIZE,
+        'waitQueueTimeoutMS': MONGODB_WAIT_QUEUE_TIMEOUT_MS,
+        'connectTimeoutMS': MONGODB_CONNECT_TIMEOUT_MS,
+        'serverSelectionTimeoutMS': MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+        # 0 means no timeout, pymongo expects None
+        'socketTimeoutMS': MONGODB_SOCKET_TIMEOUT_MS or None,
+        'maxIdleTimeMS': MONGODB_MAX_IDLE_TIME_MS or None,
+        'event_listeners': event_listeners(),
+    }
+
+
+def get_client():
+    """
+    MongoClient of the current process, created on first use.
+
+    Returns:
+        MongoClient: The client.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = MongoClient(MONGODB_URI, **client_options())
+    return _client
+
+
+def get_collection(name):
+    """
+    Collection of the database of the current process.
+
+    Args:
+        name (str): Name of the collection.
+
+    Returns:
+        Collection: The collection.
+    """
+    collection = _collections.get(name)
+    if collection is None:
+        collection = get_client()[MONGODB_DB_NAME][name]
+        _collections[name] = collection
+    return collection
+
+
+def _reset_after_fork():
+    """
+    Forget the client of the parent process in a forked child, the child
+    creates its own on first use. The parent's client is not closed, its
+    sockets still belong to the parent.
+    """
+    global _client, _client_lock
+    _client = None
+    _collections.clear()
+    _client_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class LazyProxy:
+    """
+    Stand-in for an object of the MongoClient of the current process,
+    resolved on every access.
+
+    Args:
+        resolve (callable): Function returning the object.
+    """
+
+    def __init__(self, resolve):
+        object.__setattr__(self, '_resolve', resolve)
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __getitem__(self, name):
+        return self._resolve()[name]
+
+    def __repr__(self):
+        return f"LazyProxy({self._resolve()!r})"
+
+
+def warm_up(connections=MONGODB_WARMUP_CONNECTIONS):
+    """
+    Open connections of the pool before the first request, so the first
+    requests after a deploy do not wait for connection setup.
+
+    The pings run in parallel threads, so the pool opens one connection
+    per ping (up to the pool size) instead of reusing one.
+
+    Args:
+        connections (int): Number of connections to open.
+
+    Returns:
+        int: Number of successful pings.
+    """
+    connections = min(connections, MONGODB_MAX_POOL_SIZE)
+    if connections <= 0:
+        return 0
+    client = get_client()
+    barrier = threading.Barrier(connections)
+
+    def ping():
+        barrier.wait()
+        client.admin.command('ping')
+
+    with ThreadPoolExecutor(connections) as executor:
+        futures = [executor.submit(ping) for _ in range(connections)]
+    return sum(1 for future in futures if future.exception() is None)
+
+
+# Establish a connection to the MongoDB server on first use
+client = LazyProxy(get_client)
 
 # Access the specified MongoDB database
-db = client[MONGODB_DB_NAME]
+db = LazyProxy(lambda: get_client()[MONGODB_DB_NAME])
 
 # Access the collections in the database
-images_collection = db[MONGODB_IMAGE_COLLECTION_NAME]
-groups_collection = db[MONGODB_GROUPS_COLLECTION_NAME]
+images_collection = LazyProxy(
+    lambda: get_collection(MONGODB_IMAGE_COLLECTION_NAME))
+groups_collection = LazyProxy(
+    lambda: get_collection(MONGODB_GROUPS_COLLECTION_NAME))
+counters_collection = LazyProxy(
+    lambda: get_collection(MONGODB_COUNTERS_COLLECTION_NAME))
+daily_statistics_collection = LazyProxy(
+    lambda: get_collection(MONGODB_DAILY_STATISTICS_COLLECTION_NAME))
+
+
+READ_PREFERENCE_MODES = {
+    'primary': Primary,
+    'primaryPreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest,
+}
+
+
+def read_preference(mode, max_staleness=-1):
+    """
+    Read preference from its name.
+
+    Args:
+        mode (str): One of READ_PREFERENCE_MODES.
+        max_staleness (int): Secondaries estimated to lag behind the
+            primary by more seconds are not read, -1 for no limit.
+            Ignored for 'primary'. MongoDB requires at least 90.
+
+    Returns:
+        ServerMode: The read preference.
+
+    Raises:
+        ValueError: If the mode is unknown.
+    """
+    if mode not in READ_PREFERENCE_MODES:
+        raise ValueError(f"Unknown read preference {mode!r}, expected one "
+                         f"of {list(READ_PREFERENCE_MODES)}")
+    if mode == 'primary':
+        return Primary()
+    return READ_PREFERENCE_MODES[mode](max_staleness=max_staleness)
+
+
+class Reads:
+    """
+    How the reads of a request are made: with a read preference and,
+    on a replica set, in a causally consistent session.
+
+    Usage:
+        reads(images_collection).find(query, session=reads.session)
+
+    Args:
+        preference (ServerMode, optional): Read preference, the primary
+            by default.
+        session (ClientSession, optional): Session of the reads.
+    """
+
+    def __init__(self, preference=None, session=None):
+        self.preference = preference or Primary()
+        self.session = session
+
+    def __call__(self, collection):
+        """
+        The collection reading with the read preference.
+        """
+        return collection.with_options(read_preference=self.preference)
+
+
+# reads of the primary without session, the default of the models
+PRIMARY_READS = Reads()
+
+
+_replica_set = None
+
+
+def replica_set():
+    """
+    Check whether the server is a replica set member, i.e. whether reads
+    can go to secondaries. The result is cached.
+
+    Returns:
+        bool: True for a replica set member.
+    """
+    global _replica_set
+    if _replica_set is None:
+        _replica_set = bool(client.admin.command('hello').get('setName'))
+    return _replica_set
+
+
+def causal_session():
+    """
+    Start a causally consistent session on a replica set. Servers without
+    secondaries are always consistent and get no session.
+
+    Returns:
+        ClientSession: The session, to be ended by the caller, or None.
+    """
+    if not replica_set():
+        return None
+    return client.start_session(causal_consistency=True)
+
+
+def session_token(session):
+    """
+    Consistency token of a session: its operation time, a reader
+    advancing its session to it sees the writes of the session. The
+    cluster time is not sent, it is signed by the servers and only
+    gossiped between them and the driver.
+
+    Args:
+        session (ClientSession): Session of the writes.
+
+    Returns:
+        str: The token, URL-safe base64, or None without session or
+        operation.
+    """
+    if session is None or session.operation_time is None:
+        return None
+    document = bson.encode({'operationTime': session.operation_time})
+    return base64.urlsafe_b64encode(document).decode()
+
+
+def advance_session(session, token):
+    """
+    Advance a causally consistent session to a consistency token, its
+    next read waits until the server has the data of the token.
+
+    The token comes from the client: its operation time must not be
+    newer than the cluster time, a read would wait for a write that
+    never happened. A session without cluster time learns it with a
+    ping first.
+
+    Args:
+        session (ClientSession): Session of the reads.
+        token (str): Token from session_token.
+
+    Raises:
+        ValueError: If the token is malformed or newer than the cluster
+            time.
+        OperationFailure: If the server rejects the ping.
+    """
+    try:
+        document = bson.decode(base64.urlsafe_b64decode(token.encode()))
+        operation_time = document['operationTime']
+    except Exception as err:
+        raise ValueError(f"Malformed consistency token: {err}") from err
+    if not isinstance(operation_time, bson.Timestamp):
+        raise ValueError("Malformed consistency token")
+    if session.cluster_time is None:
+        session.client.admin.command('ping', session=session)
+    cluster_time = (session.cluster_time or {}).get('clusterTime')
+    if cluster_time is None or operation_time > cluster_time:
+        raise ValueError("Consistency token is newer than the cluster time")
+    session.advance_operation_time(operation_time)
+
+
+# $lookup with localField and pipeline (/groups) and $dateTrunc
+# (/statistics) need MongoDB 5.0
+MIN_SERVER_VERSION = (5, 0)
+
+
+def check_server_version():
+    """
+    Check that the server runs at least MIN_SERVER_VERSION.
+
+    Raises:
+        RuntimeError: The server is older, the aggregations of the views
+            would fail.
+    """
+    version = client.server_info()['versionArray']
+    if tuple(version[:2]) < MIN_SERVER_VERSION:
+        raise RuntimeError(
+            f"MongoDB {'.'.join(map(str, version[:3]))} is not supported, "
+            f"the aggregations need MongoDB "
+            f"{'.'.join(map(str, MIN_SERVER_VERSION))} or newer")
+
+
+_transactions_supported = None
+
+
+def transactions_supported():
+    """
+    Check whether multi-document writes should run in a transaction.
+
+    Transactions are used when MONGODB_TRANSACTIONS is 'true', or when it
+    is 'auto' and the server is a replica set member or a mongos. The
+    result of the server check is cached.
+
+    Returns:
+        bool: True if transactions should be used.
+    """
+    global _transactions_supported
+    if MONGODB_TRANSACTIONS != 'auto':
+        return MONGODB_TRANSACTIONS == 'true'
+    if _transactions_supported is None:
+        hello = client.admin.command('hello')
+        _transactions_supported = bool(hello.get('setName')
+                                       or hello.get('msg') == 'isdbgrid')
+    return _transactions_supported
+
+
+def run_in_transaction(callback, session=None):
+    """
+    Run a function that writes several documents atomically.
+
+    Args:
+        callback (callable): Function taking a ClientSession (or None when
+            transactions are not used) that performs the writes with it.
+        session (ClientSession, optional): Session to run the writes in,
+            e.g. a causal_session whose token is returned to the client.
+            A new session is used by default.
 
-# Create indexes for optimized database queries
-images_collection.create_index([("status", 1), ("created_at", -1)])
-groups_collection.create_index([("name", 1)])
+    Returns:
+        The value returned by the callback.
+    """
+    if not transactions_supported():
+        return callback(session)
+    if session is not None:
+        return session.with_transaction(callback)
+    with client.start_session() as session:
+        return session.with_transaction(callback)
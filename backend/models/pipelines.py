@@ -0,0 +1,203 @@
+"""
+MongoDB Aggregation Pipelines
+
+Builders for the aggregation pipelines used by the views. They are kept
+apart from the views so the same pipelines can be explained in tests and
+reused by other entry points.
+
+The images of a group are joined with a correlated $lookup whose inner
+pipeline filters and sorts the images of one group. The inner pipelines
+are backed by the indexes created in 'models.indexes':
+- (group_id, status, created_at, _id) when images are filtered by status,
+- (group_id, created_at, _id) when they are not.
+The number of images of a group is read from the materialized counters
+('models.counters') by _id.
+"""
+
+from models.models import images_collection, counters_collection
+from utils.utils import encode_cursor
+from config.config import VALID_STATUSES
+
+# order of images inside a group, _id makes it stable for cursors
+IMAGES_SORT = {'created_at': 1, '_id': 1}
+
+
+def images_filter_pipeline(status_filter):
+    """
+    Inner pipeline selecting the images of one group.
+
+    Args:
+        status_filter (str): Only select images with this status,
+            None selects all images.
+
+    Returns:
+        list: Pipeline stages to run after the group_id match.
+    """
+    return [{'$match': {'status': status_filter}}] if status_filter else []
+
+
+def images_projection(fields):
+    """
+    Projection of the image fields read from the database.
+
+    Args:
+        fields (list): Field names requested by the client, None returns
+            all fields. 'created_at' is always added, it is needed for
+            the continuation cursors.
+
+    Returns:
+        dict: Projection for find or a $project stage, None for all
+        fields.
+    """
+    if fields is None:
+        return None
+    return {field: 1 for field in fields + ['created_at']}
+
+
+def images_page_pipeline(status_filter, image_limit, fields=None):
+    """
+    Inner pipeline returning the first images of one group.
+
+    Args:
+        status_filter (str): Only select images with this status,
+            None selects all images.
+        image_limit (int): Maximum number of images to return.
+        fields (list, optional): Image fields to return, all fields by
+            default, see images_projection.
+
+    Returns:
+        list: Pipeline stages to run after the group_id match.
+    """
+    pipeline = images_filter_pipeline(status_filter) + [
+        {'$sort': IMAGES_SORT},
+        {'$limit': image_limit},
+    ]
+    if fields is not None:
+        pipeline.append({'$project': images_projection(fields)})
+    return pipeline
+
+
+def group_count_expression(status_filter):
+    """
+    Expression reading the number of images of a group from the
+    'counters' array joined from the counters collection.
+
+    Args:
+        status_filter (str): Count images with this status,
+            None counts images with any status.
+
+    Returns:
+        dict: Aggregation expression.
+    """
+    statuses = [status_filter] if status_filter else VALID_STATUSES
+    return {
+        '$add': [
+            {'$ifNull': [{'$arrayElemAt': [f'$counters.counts.{status}', 0]},
+                         0]}
+            for status in statuses
+        ]
+    }
+
+
+def groups_pipeline(group_ids, status_filter, image_limit, fields=None):
+    """
+    Pipeline returning a page of groups with their images.
+
+    Args:
+        group_ids (list): ObjectIds of the groups of the page.
+        status_filter (str): Only include images with this status,
+            None includes all images.
+        image_limit (int): Maximum number of images per group.
+        fields (list, optional): Image fields to return (see
+            'utils.validators.parse_fields'), all fields by default.
+
+    Returns:
+        list: Pipeline for the groups collection. Every group has
+        'name', 'images' (at most image_limit images sorted by
+        creation date, with the requested fields) and 'count' (total
+        number of its images matching the filter, read from the
+        materialized counters). Groups without images are returned with
+        an empty list and a count of 0. Groups with more images get
+        'images_next' with 'created_at' and '_id' of their last image,
+        see add_images_next.
+    """
+    count = group_count_expression(status_filter)
+    images = '$images'
+    if fields is not None and 'created_at' not in fields:
+        # created_at was only fetched for the cursor, drop it
+        images = {
+            '$map': {
+                'input': '$images',
+                'as': 'image',
+                'in': {field: f'$$image.{field}' for field in fields},
+            }
+        }
+    return [
+        # 1 stage take only groups of the current page
+        {
+            '$match': {'_id': {'$in': group_ids}}
+        },
+        {
+            '$sort': {'_id': 1}
+        },
+        # 2d stage join the first images of every group,
+        # filtering and sorting run inside the lookup on the index
+        {
+            '$lookup': {
+                'from': images_collection.name,
+                'localField': '_id',
+                'foreignField': 'group_id',
+                'pipeline': images_page_pipeline(status_filter, image_limit,
+                                                 fields),
+                'as': 'images'
+            }
+        },
+        # 3d stage take the number of images from the group counters
+        {
+            '$lookup': {
+                'from': counters_collection.name,
+                'localField': '_id',
+                'foreignField': '_id',
+                'as': 'counters'
+            }
+        },
+        {
+            '$project': {
+                'name': 1,
+                'images': images,
+                'count': count,
+                'images_next': {
+                    '$cond': [
+                        {'$gt': [count, image_limit]},
+                        {
+                            '$let': {
+                                'vars': {'last': {
+                                    '$arrayElemAt': ['$images', -1]}},
+                                'in': {'created_at': '$$last.created_at',
+                                       '_id': '$$last._id'},
+                            }
+                        },
+                        '$$REMOVE',
+                    ]
+                },
+            }
+        },
+    ]
+
+
+def add_images_next(group):
+    """
+    Turn the 'images_next' key of a group returned by groups_pipeline
+    into the cursor of the group's next images.
+
+    Args:
+        group (dict): Group from the groups_pipeline result.
+
+    Returns:
+        dict: The same group.
+    """
+    last_image = group.get('images_next')
+    if last_image:
+        group['images_next'] = encode_cursor(last_image['created_at'],
+                                             last_image['_id'])
+    return group
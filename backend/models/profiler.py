@@ -0,0 +1,300 @@
+"""
+Slow Aggregation Profiler
+
+Times the aggregations of /groups and /statistics. When one takes longer
+than PROFILER_SLOW_MS it is recorded in a ring buffer of the worker,
+exposed by /debug/slow-queries, and a sample of the slow aggregations is
+explained with the "executionStats" verbosity. A summary of the plan is
+stored with the recorded aggregation:
+
+    {
+        "name": "groups",
+        "duration_ms": 812.4,
+        "at": "2023-09-18T12:00:00Z",
+        "pipeline": [...],
+        "plan": {
+            "plan_stages": ["IXSCAN", "FETCH"],
+            "pipeline_stages": ["$cursor", "$lookup", "$project"],
+            "keys_examined": 120,
+            "docs_examined": 5120,
+            "returned": 50,
+            "execution_ms": 790,
+            "collection_scan": true,
+            "in_memory_sort": false,
+            "used_disk": false,
+            "lookups": [{"from": "images", "collection_scans": 50, ...}]
+        }
+    }
+
+An explain runs the aggregation again, so the profiler must not make an
+overloaded server slower. Explains are sampled (PROFILER_SAMPLE_RATE),
+at most one runs at a time, in a background thread, with a time limit,
+and the same aggregation is explained at most once per
+PROFILER_MIN_INTERVAL seconds. Slow aggregations that are not explained
+are still recorded, with "plan": null.
+
+Configuration (see 'config.config'):
+- PROFILER_ENABLED, PROFILER_SLOW_MS, PROFILER_SAMPLE_RATE,
+- PROFILER_MIN_INTERVAL, PROFILER_BUFFER_SIZE and
+  PROFILER_EXPLAIN_MAX_TIME_MS.
+"""
+
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from config.config import (PROFILER_ENABLED,
+                           PROFILER_SLOW_MS,
+                           PROFILER_SAMPLE_RATE,
+                           PROFILER_MIN_INTERVAL,
+                           PROFILER_BUFFER_SIZE,
+                           PROFILER_EXPLAIN_MAX_TIME_MS,
+                           )
+
+
+def plan_summary(explain):
+    """
+    Summarize the output of an aggregate explain.
+
+    Works with the outputs of a pipeline pushed down to the query layer
+    (top level queryPlanner/executionStats), of a pipeline with separate
+    stages ('stages' with a '$cursor' stage) and of the slot based
+    engine (e.g. an EQ_LOOKUP stage in the winning plan).
+
+    Args:
+        explain (dict): Result of the explain command.
+
+    Returns:
+        dict: Stages of the winning plans and of the pipeline, examined
+        keys and documents, returned documents, execution time and flags
+        for collection scans, in-memory sorts and sorts that spilled to
+        disk.
+    """
+    summary = {
+        'plan_stages': [],
+        'pipeline_stages': [],
+        'keys_examined': 0,
+        'docs_examined': 0,
+        'returned': None,
+        'execution_ms': None,
+        'collection_scan': False,
+        'in_memory_sort': False,
+        'used_disk': False,
+        'lookups': [],
+    }
+    _walk(explain, summary)
+    stages = summary['plan_stages'] + summary['pipeline_stages']
+    summary['collection_scan'] = (
+        'COLLSCAN' in stages
+        or any(lookup['collection_scans'] for lookup in summary['lookups']))
+    summary['in_memory_sort'] = 'SORT' in stages or '$sort' in stages
+    return summary
+
+
+def _walk(value, summary):
+    if isinstance(value, list):
+        for item in value:
+            _walk(item, summary)
+        return
+    if not isinstance(value, dict):
+        return
+    for key, item in value.items():
+        if key == 'winningPlan':
+            summary['plan_stages'] += _plan_stages(item)
+        elif key == 'executionStats':
+            summary['keys_examined'] += item.get('totalKeysExamined', 0)
+            summary['docs_examined'] += item.get('totalDocsExamined', 0)
+            if summary['returned'] is None:
+                summary['returned'] = item.get('nReturned')
+            if summary['execution_ms'] is None:
+                summary['execution_ms'] = item.get('executionTimeMillis')
+        elif key == 'stages' and isinstance(item, list):
+            for stage in item:
+                _pipeline_stage(stage, summary)
+        elif key == 'usedDisk':
+            summary['used_disk'] = summary['used_disk'] or bool(item)
+        elif key not in ('rejectedPlans', 'allPlansExecution'):
+            _walk(item, summary)
+
+
+def _plan_stages(plan):
+    stages = []
+    if isinstance(plan, dict):
+        if isinstance(plan.get('stage'), str):
+            stages.append(plan['stage'])
+        for value in plan.values():
+            stages += _plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            stages += _plan_stages(value)
+    return stages
+
+
+def _pipeline_stage(stage, summary):
+    names = [key for key in stage if key.startswith('$')]
+    summary['pipeline_stages'] += names
+    if '$lookup' in names:
+        summary['lookups'].append({
+            'from': stage['$lookup'].get('from'),
+            'collection_scans': stage.get('collectionScans', 0),
+            'indexes_used': stage.get('indexesUsed', []),
+            'keys_examined': stage.get('totalKeysExamined', 0),
+            'docs_examined': stage.get('totalDocsExamined', 0),
+            'execution_ms': stage.get('executionTimeMillisEstimate'),
+        })
+        summary['keys_examined'] += stage.get('totalKeysExamined', 0)
+        summary['docs_examined'] += stage.get('totalDocsExamined', 0)
+    if stage.get('usedDisk'):
+        summary['used_disk'] = True
+    for name in names:
+        _walk(stage[name], summary)
+
+
+class SlowQueryProfiler:
+    """
+    Records slow aggregations and explains a sample of them.
+
+    Args:
+        slow_ms (float): Aggregations taking longer are recorded.
+        sample_rate (float): Share of the slow aggregations explained.
+        min_interval (float): Seconds between two explains of aggregations
+            with the same name.
+        buffer_size (int): Number of recorded aggregations kept.
+        explain_max_time_ms (int): Time limit of an explain.
+        background (bool): Explain in a background thread. When False the
+            explain runs before profile() returns, e.g. in tests.
+    """
+
+    def __init__(self, slow_ms, sample_rate, min_interval, buffer_size,
+                 explain_max_time_ms, background=True):
+        self.slow_ms = slow_ms
+        self.sample_rate = sample_rate
+        self.min_interval = min_interval
+        self.explain_max_time_ms = explain_max_time_ms
+        self.background = background
+        self.entries = deque(maxlen=buffer_size)
+        self._explaining = threading.Lock()
+        self._last_explain = {}
+        self.slow = 0
+        self.explained = 0
+        self.skipped = 0
+        self.failed = 0
+
+    @contextmanager
+    def profile(self, name, collection, pipeline):
+        """
+        Time the block running an aggregation.
+
+        Args:
+            name (str): Name of the aggregation, e.g. 'groups'.
+            collection (Collection): Collection the pipeline runs on.
+            pipeline (list): The pipeline.
+        """
+        started = time.perf_counter()
+        yield
+        duration_ms = (time.perf_counter() - started) * 1000
+        if duration_ms >= self.slow_ms:
+            self.record(name, collection, pipeline, duration_ms)
+
+    def record(self, name, collection, pipeline, duration_ms):
+        """
+        Record a slow aggregation and explain it if it is sampled.
+        """
+        entry = {
+            'name': name,
+            'collection': collection.name,
+            'duration_ms': round(duration_ms, 1),
+            'at': datetime.utcnow(),
+            'pipeline': pipeline,
+            'plan': None,
+        }
+        self.entries.append(entry)
+        self.slow += 1
+        if not self.should_explain(name):
+            self.skipped += 1
+            return
+        if self.background:
+            threading.Thread(target=self.explain,
+                             args=(entry, collection, pipeline),
+                             daemon=True).start()
+        else:
+            self.explain(entry, collection, pipeline)
+
+    def should_explain(self, name):
+        """
+        Sample an explain: taken with sample_rate, not within min_interval
+        of the last explain of the same name and not while another
+        explain runs. Holds the explain lock when it returns True.
+        """
+        if random.random() >= self.sample_rate:
+            return False
+        now = time.monotonic()
+        if now - self._last_explain.get(name, -self.min_interval) \
+                < self.min_interval:
+            return False
+        if not self._explaining.acquire(blocking=False):
+            return False
+        self._last_explain[name] = now
+        return True
+
+    def explain(self, entry, collection, pipeline):
+        """
+        Explain an aggregation and store the summary of the plan in its
+        entry. Releases the explain lock.
+
+        The explain runs with the read preference of the collection, on
+        the member that ran the aggregation (Database.command reads from
+        the primary otherwise).
+        """
+        try:
+            explain = collection.database.command(
+                'explain',
+                {'aggregate': collection.name, 'pipeline': pipeline,
+                 'cursor': {}, 'maxTimeMS': self.explain_max_time_ms},
+                verbosity='executionStats',
+                read_preference=collection.read_preference)
+            entry['plan'] = plan_summary(explain)
+            self.explained += 1
+        except Exception as err:
+            entry['explain_error'] = str(err)
+            self.failed += 1
+        finally:
+            self._explaining.release()
+
+    def stats(self):
+        """
+        Settings and counters of the profiler, with the recorded
+        aggregations, the newest first.
+        """
+        return {
+            'slow_ms': self.slow_ms,
+            'sample_rate': self.sample_rate,
+            'slow': self.slow,
+            'explained': self.explained,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'entries': list(reversed(self.entries)),
+        }
+
+
+class _DisabledProfiler:
+    """
+    Profiler used when PROFILER_ENABLED is false, records nothing.
+    """
+
+    @contextmanager
+    def profile(self, name, collection, pipeline):
+        yield
+
+    def stats(self):
+        return None
+
+
+profiler = (SlowQueryProfiler(PROFILER_SLOW_MS,
+                              PROFILER_SAMPLE_RATE,
+                              PROFILER_MIN_INTERVAL,
+                              PROFILER_BUFFER_SIZE,
+                              PROFILER_EXPLAIN_MAX_TIME_MS)
+            if PROFILER_ENABLED else _DisabledProfiler())
@@ -0,0 +1,471 @@
+"""
+Daily Image Statistics
+
+Number of images created per day and status, stored in the daily
+statistics collection:
+
+    {"_id": datetime(2023, 9, 18), "counts": {"new": 3, "review": 2}}
+
+The days before the sealed frontier are sealed, i.e. rolled up from the
+images collection. The frontier is stored in the seal document of the
+same collection:
+
+    {"_id": "seal", "sealed_until": datetime(2023, 9, 19)}
+
+Status changes made by the application are applied to the day of the
+image with $inc (see 'models.images'), also to a day that is not sealed
+yet; sealing a day replaces its counts. Days that are not sealed yet,
+normally only today, are counted live from the images collection, so
+answering a request costs one read of the rollups plus a small
+aggregation over today's images, whatever the size of the period.
+
+The days before the first frontier are sealed by
+rebuild_daily_statistics (the rebuild-statistics command), until then
+every day is counted live. After that the first request after midnight
+(UTC) seals the days that ended since the frontier, one worker at a
+time: the worker holding the lease of the seal document
+(STATISTIC_SEAL_LEASE seconds) seals, the other workers count the
+unsealed days live meanwhile. On a replica set at most
+STATISTIC_SEAL_MAX_DAYS days are counted and written in one transaction
+and the frontier moves after each of them, a concurrent status change of
+the days conflicts with it and is retried. Without transactions a status
+change made while its day is sealed may be lost or counted twice;
+rebuild_daily_statistics(dry_run=True) reports the drift.
+"""
+
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+from models.models import (images_collection, daily_statistics_collection,
+                           run_in_transaction, Reads, PRIMARY_READS)
+from models.counters import bump_data_version
+from models.profiler import profiler
+from config.config import STATISTIC_SEAL_LEASE, STATISTIC_SEAL_MAX_DAYS
+
+ONE_DAY = timedelta(days=1)
+SEAL_ID = 'seal'
+
+
+def day_start(moment):
+    """
+    Midnight (UTC) of the day of a datetime.
+    """
+    return datetime(moment.year, moment.month, moment.day)
+
+
+def images_per_day_pipeline(start, end):
+    """
+    Aggregation pipeline counting images created in a period per day
+    and status.
+
+    Args:
+        start (datetime): Beginning of the period (inclusive).
+        end (datetime): End of the period (exclusive).
+
+    Returns:
+        list: Pipeline for images_collection.aggregate returning
+        {"_id": {"day": <day>, "status": <status>}, "count": <number>}.
+    """
+    return [
+        {
+            '$match': {
+                'created_at': {'$gte': start, '$lt': end}
+            }
+        },
+        {
+            '$group': {
+                '_id': {
+                    'day': {'$dateTrunc': {'date': '$created_at',
+                                           'unit': 'day'}},
+                    'status': '$status'
+                },
+                'count': {'$sum': 1}
+            }
+        }
+    ]
+
+
+def count_images_per_day(start, end, reads=PRIMARY_READS):
+    """
+    Count images created in a period per day and status by scanning the
+    images collection.
+
+    Args:
+        start (datetime): Beginning of the period (inclusive).
+        end (datetime): End of the period (exclusive).
+        reads (Reads, optional): Read preference and session of the
+            aggregation ('models.models.Reads').
+
+    Returns:
+        dict: {day: Counter({status: number of images})}.
+    """
+    counts = defaultdict(Counter)
+    pipeline = images_per_day_pipeline(start, end)
+    collection = reads(images_collection)
+    with profiler.profile('statistics', collection, pipeline):
+        for item in collection.aggregate(
+                pipeline, session=reads.session):
+            counts[item['_id']['day']][item['_id']['status']] += \
+                item['count']
+    return counts
+
+
+def sealed_until(reads=PRIMARY_READS):
+    """
+    First day that is not sealed yet.
+
+    Args:
+        reads (Reads, optional): Read preference and session of the read
+            ('models.models.Reads'). Read the frontier in the session of
+            the sealed days, so they are at least as new.
+
+    Returns:
+        datetime: The sealed frontier, or None if no day is sealed.
+    """
+    seal = reads(daily_statistics_collection).find_one(
+        {'_id': SEAL_ID}, session=reads.session)
+    return seal.get('sealed_until') if seal else None
+
+
+def first_day():
+    """
+    Day of the oldest image.
+
+    Returns:
+        datetime: The day, or None if there are no images.
+    """
+    first_image = images_collection.find_one(
+        {'created_at': {'$ne': None}},
+        {'created_at': 1},
+        sort=[('created_at', 1)])
+    return day_start(first_image['created_at']) if first_image else None
+
+
+def acquire_seal_lease():
+    """
+    Take the lease of the seal document, if no other worker holds it or
+    its lease expired.
+
+    Returns:
+        dict: The seal document with the 'owner' of the lease, or None if
+        another worker holds the lease.
+    """
+    now = datetime.utcnow()
+    try:
+        return daily_statistics_collection.find_one_and_update(
+            {'_id': SEAL_ID,
+             '$or': [{'expires': None}, {'expires': {'$lte': now}}]},
+            {'$set': {'owner': ObjectId(),
+                      'expires': now + timedelta(
+                          seconds=STATISTIC_SEAL_LEASE)}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError:
+        return None
+
+
+def release_seal_lease(lease):
+    """
+    Give up a lease of acquire_seal_lease, unless it expired and was
+    taken by another worker.
+    """
+    daily_statistics_collection.update_one(
+        {'_id': SEAL_ID, 'owner': lease['owner']},
+        {'$unset': {'owner': '', 'expires': ''}})
+
+
+def seal_days(until):
+    """
+    Roll up the days between the sealed frontier and a day.
+
+    Days are sealed in contiguous ranges of at most
+    STATISTIC_SEAL_MAX_DAYS days, the frontier moves after each range.
+    Days without images get a document with empty counts. Nothing is
+    sealed before the first frontier is set by rebuild_daily_statistics.
+    Only the worker holding the lease of the seal document seals, the
+    call returns at once when another worker holds it. Sealing the same
+    day twice is harmless, the day is recounted.
+
+    Args:
+        until (datetime): First day that must not be sealed, normally
+            the start of today.
+
+    Returns:
+        datetime: First day that is not sealed, None if no day is sealed.
+    """
+    start = sealed_until()
+    if start is None or start >= until:
+        return start
+    lease = acquire_seal_lease()
+    if lease is None:
+        return start
+    try:
+        start = lease.get('sealed_until')
+        while start is not None and start < until:
+            end = min(until, start + STATISTIC_SEAL_MAX_DAYS * ONE_DAY)
+
+            def seal(session):
+                counts = count_images_per_day(start, end,
+                                              Reads(session=session))
+                daily_statistics_collection.bulk_write(
+                    seal_requests(start, end, counts), session=session)
+                # the frontier moves after the days are written
+                return move_frontier(lease, end, session)
+
+            if not run_in_transaction(seal):
+                # the lease expired, another worker seals
+                break
+            start = end
+        return start
+    finally:
+        release_seal_lease(lease)
+
+
+def seal_requests(start, until, counts):
+    """
+    Build the documents of sealed days.
+
+    Args:
+        start (datetime): First day to seal.
+        until (datetime): First day that must not be sealed.
+        counts (dict): Result of count_images_per_day for the days.
+
+    Returns:
+        list: UpdateOne requests for daily_statistics_collection.bulk_write,
+        one per day, also for the days without images. They replace the
+        counts of the days.
+    """
+    requests = []
+    day = start
+    while day < until:
+        requests.append(UpdateOne({'_id': day},
+                                  {'$set': {'counts': dict(
+                                      counts.get(day, {}))}},
+                                  upsert=True))
+        day += ONE_DAY
+    return requests
+
+
+def move_frontier(lease, until, session=None):
+    """
+    Move the sealed frontier and renew the lease, as long as the lease
+    is held.
+
+    Returns:
+        bool: Whether the lease was held.
+    """
+    result = daily_statistics_collection.update_one(
+        {'_id': SEAL_ID, 'owner': lease['owner']},
+        {'$set': {'sealed_until': until,
+                  'expires': datetime.utcnow() + timedelta(
+                      seconds=STATISTIC_SEAL_LEASE)}},
+        session=session)
+    return result.matched_count == 1
+
+
+def statistics_drift(stored, actual):
+    """
+    Compare stored daily counts with the counts of the images.
+
+    Args:
+        stored (dict): {day: {status: number of images}} of the rollups.
+        actual (dict): {day: {status: number of images}} counted from the
+            images collection.
+
+    Returns:
+        list: Tuples (day, status, stored count, actual count) for every
+        count that does not match.
+    """
+    drift = []
+    for day in sorted(set(stored) | set(actual)):
+        stored_counts = stored.get(day, {})
+        actual_counts = actual.get(day, {})
+        for status in sorted(set(stored_counts) | set(actual_counts)):
+            if stored_counts.get(status, 0) != actual_counts.get(status, 0):
+                drift.append((day, status, stored_counts.get(status, 0),
+                              actual_counts.get(status, 0)))
+    return drift
+
+
+def wait_for_seal_lease():
+    """
+    Take the lease of the seal document, waiting while another worker
+    seals.
+
+    Returns:
+        dict: The seal document, see acquire_seal_lease.
+    """
+    while True:
+        lease = acquire_seal_lease()
+        if lease is not None:
+            return lease
+        time.sleep(1)
+
+
+def rebuild_daily_statistics(dry_run=False):
+    """
+    Roll up the sealed days again from the images collection and report
+    the drift, e.g. after images were imported into past days. The first
+    run seals the whole history and sets the frontier, see seal_days.
+
+    The rollups are counted first and then written over the stored ones
+    day by day, a request reads either the old or the new counts of a
+    day, never a missing day. The days up to today are sealed. Status
+    changes made while the images are being counted can be lost, run it
+    when the service is quiet or check again with dry_run.
+
+    Args:
+        dry_run (bool): Only report the drift of the sealed days, do not
+            change them.
+
+    Returns:
+        list: Tuples (day, status, stored count, actual count) for every
+        count of a sealed day that did not match the images collection.
+    """
+    lease = None if dry_run else wait_for_seal_lease()
+    try:
+        sealed = sealed_until()
+        until = sealed if dry_run else day_start(datetime.utcnow())
+        if until is None:
+            return []
+        stored = {day['_id']: day.get('counts', {})
+                  for day in daily_statistics_collection.find(
+                      {'_id': {'$lt': until}})}
+        start = min([day for day in (first_day(),) if day] + list(stored),
+                    default=until)
+        actual = count_images_per_day(start, until)
+        drift = statistics_drift(
+            {day: counts for day, counts in stored.items()
+             if sealed and day < sealed},
+            {day: counts for day, counts in actual.items()
+             if sealed and day < sealed})
+        if not dry_run:
+            requests = seal_requests(start, until, actual)
+            if requests:
+                daily_statistics_collection.bulk_write(requests)
+            move_frontier(lease, until)
+            bump_data_version()
+        return drift
+    finally:
+        if lease is not None:
+            release_seal_lease(lease)
+
+
+def daily_statistics_updates(changes):
+    """
+    Build updates of the sealed days for a set of status changes.
+
+    Args:
+        changes (iterable): Tuples (created_at, old_status, new_status).
+
+    Returns:
+        list: UpdateOne requests for daily_statistics_collection.bulk_write.
+        Days that are not sealed are updated too, so the write conflicts
+        with a transaction sealing the day; their counts are replaced when
+        they are sealed.
+    """
+    increments = defaultdict(Counter)
+    for created_at, old_status, new_status in changes:
+        if not created_at:
+            continue
+        day = day_start(created_at)
+        if old_status:
+            increments[day][old_status] -= 1
+        if new_status:
+            increments[day][new_status] += 1
+    requests = []
+    for day, increment in increments.items():
+        inc = {f'counts.{status}': number
+               for status, number in increment.items() if number}
+        if inc:
+            requests.append(UpdateOne({'_id': day}, {'$inc': inc},
+                                      upsert=True))
+    return requests
+
+
+def get_daily_statistics(start, end, reads=PRIMARY_READS):
+    """
+    Number of images per day and status in a period.
+
+    Seals the days that ended since the frontier, reads the sealed days
+    of the period and counts the remaining days (normally only today)
+    from the images collection. Sealing reads from the primary, a day
+    counted from a lagging secondary would stay wrong. While another
+    worker seals, the days it seals are counted live.
+
+    Args:
+        start (datetime): First day of the period.
+        end (datetime): Day after the last day of the period.
+        reads (Reads, optional): Read preference and session of the
+            reads of the statistics ('models.models.Reads').
+
+    Returns:
+        dict: {day: Counter({status: number of images})} for the days
+        of the period that have images.
+    """
+    seal_days(day_start(datetime.utcnow()))
+    # nothing sealed: every day is counted live
+    live_from = sealed_until(reads) or start
+
+    counts = defaultdict(Counter)
+    for day in reads(daily_statistics_collection).find(
+            {'_id': {'$gte': start, '$lt': min(end, live_from)}},
+            session=reads.session):
+        counts[day['_id']].update(day.get('counts', {}))
+
+    if end > live_from:
+        live_counts = count_images_per_day(max(start, live_from), end,
+                                           reads)
+        for day, day_counts in live_counts.items():
+            counts[day].update(day_counts)
+    return counts
+
+
+def total_statistics(counts):
+    """
+    Sum daily statistics over the whole period.
+
+    Args:
+        counts (dict): Result of get_daily_statistics.
+
+    Returns:
+        dict: {status: number of images} without empty statuses.
+    """
+    totals = Counter()
+    for day_counts in counts.values():
+        totals.update(day_counts)
+    return {status: number for status, number in totals.items() if number}
+
+
+def bucket_statistics(counts, start, end, granularity):
+    """
+    Sum daily statistics into buckets of a day or a week.
+
+    Args:
+        counts (dict): Result of get_daily_statistics.
+        start (datetime): First day of the period.
+        end (datetime): Day after the last day of the period.
+        granularity (str): 'day' or 'week'. Weeks start on Monday.
+
+    Returns:
+        list: Buckets of the whole period in chronological order, also
+        the empty ones:
+        [{"start": "2023-09-18", "counts": {status: number of images}}]
+    """
+    buckets = {}
+    day = start
+    while day < end:
+        bucket = day
+        if granularity == 'week':
+            bucket = day - timedelta(days=day.weekday())
+        buckets.setdefault(bucket, Counter()).update(counts.get(day, {}))
+        day += ONE_DAY
+    return [{'start': bucket.strftime('%Y-%m-%d'),
+             'counts': {status: number
+                        for status, number in bucket_counts.items()
+                        if number}}
+            for bucket, bucket_counts in buckets.items()]
@@ -0,0 +1,338 @@
+"""
+Write Coalescing
+
+Queue of the image status updates of PUT /images/<image_id>, enabled with
+WRITE_COALESCING_ENABLED. Accepted updates are answered with
+202 Accepted and a ticket; a thread of the worker writes the queued
+updates in batches with 'models.images.set_image_statuses' (one bulk
+write, counters and daily statistics in the same transaction):
+
+- when WRITE_COALESCING_MAX_BATCH images are queued, or
+- WRITE_COALESCING_INTERVAL seconds after the oldest queued update was
+  accepted.
+
+Updates of an image that is still queued replace the queued status, so
+an image flipped several times between two batches is written once with
+its last status; the tickets of the replaced updates get the result
+'superseded'. The results of every batch are stored in the write batches
+collection for WRITE_COALESCING_RESULT_TTL seconds (a TTL index, see
+'models.indexes'), so the ticket can be checked on any worker:
+
+    GET /images/updates/<ticket>
+
+A batch that fails is queued again, after WRITE_COALESCING_MAX_ATTEMPTS
+writes its updates get the result 'failed'. When a worker already queues
+WRITE_COALESCING_MAX_PENDING images, further images are written directly
+as without coalescing. Updates of an image of the batch being written
+are always queued: written directly, they could be overwritten by the
+older status of the batch.
+
+close() writes the queued updates and stops the thread. It is called by
+the worker_exit hook of gunicorn_config.py when a worker is stopped or
+recycled, and at interpreter exit otherwise. Updates are lost only if
+the worker is killed (e.g. after the graceful timeout).
+
+Configuration (see 'config.config'):
+- WRITE_COALESCING_ENABLED, WRITE_COALESCING_MAX_BATCH,
+- WRITE_COALESCING_INTERVAL, WRITE_COALESCING_MAX_PENDING,
+- WRITE_COALESCING_MAX_ATTEMPTS, WRITE_COALESCING_RESULT_TTL and
+- MONGODB_WRITE_BATCHES_COLLECTION_NAME.
+"""
+
+import atexit
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from bson import ObjectId
+from models.models import get_collection
+from config.config import MONGODB_WRITE_BATCHES_COLLECTION_NAME
+
+logger = logging.getLogger(__name__)
+
+
+def write_batches_collection():
+    return get_collection(MONGODB_WRITE_BATCHES_COLLECTION_NAME)
+
+
+def record_batch(updates, error=None):
+    """
+    Store the results of a written batch.
+
+    Args:
+        updates (list): One dict per ticket with the 'ticket', the
+            'image_id', the requested 'status' and the 'result'.
+        error (str): Error of a batch that failed.
+    """
+    write_batches_collection().insert_one({
+        'flushed_at': datetime.utcnow(),
+        'updates': updates,
+        'error': error,
+    })
+
+
+def find_update(ticket, session=None):
+    """
+    Stored result of a written update.
+
+    Args:
+        ticket (str): Ticket of the update.
+        session (ClientSession, optional): Session of the read.
+
+    Returns:
+        dict: The 'ticket', 'image_id', 'status', 'result' and
+        'flushed_at' of the update, and the 'error' of a failed batch,
+        or None if no batch with the ticket was stored.
+    """
+    batch = write_batches_collection().find_one(
+        {'updates.ticket': ticket},
+        {'updates': {'$elemMatch': {'ticket': ticket}},
+         'flushed_at': 1, 'error': 1},
+        session=session)
+    if batch is None:
+        return None
+    update = batch['updates'][0]
+    update['flushed_at'] = batch['flushed_at']
+    if batch.get('error'):
+        update['error'] = batch['error']
+    return update
+
+
+class WriteCoalescer:
+    """
+    Queue of image status updates written in batches by a thread.
+
+    The thread is started by the first submitted update, so a queue
+    created before gunicorn forks its workers starts in the worker.
+
+    Args:
+        write (callable): Writes a batch, takes {image ObjectId: status}
+            and returns {image ObjectId: result}.
+        max_batch (int): Number of images written at most per batch, a
+            batch is written as soon as it is full.
+        interval (float): Seconds an update waits at most for a batch.
+        max_pending (int): Number of queued images.
+        max_attempts (int): Writes of a batch before its updates fail.
+        record (callable): Stores the results of a batch, see
+            record_batch.
+    """
+
+    def __init__(self, write, max_batch, interval, max_pending,
+                 max_attempts, record=record_batch):
+        self.write = write
+        self.max_batch = max_batch
+        self.interval = interval
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.record = record
+        self._condition = threading.Condition()
+        # {image id: {'status', 'tickets': [(ticket, status)], 'attempts'}}
+        # in the order the images were queued
+        self._pending = {}
+        # monotonic time the oldest queued update was accepted
+        self._oldest = None
+        # tickets queued or being written: {ticket: image id}
+        self._tickets = {}
+        # images of the batch being written
+        self._in_flight = set()
+        # results of the last written tickets of the worker
+        self._results = OrderedDict()
+        self._thread = None
+        self._closed = False
+        self.accepted = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.batches = 0
+        self.written = 0
+        self.retried = 0
+        self.failed = 0
+
+    def submit(self, image_id, status):
+        """
+        Queue a status update.
+
+        Args:
+            image_id (ObjectId): Identifier of the image.
+            status (str): Valid image status.
+
+        Returns:
+            str: Ticket of the update, or None if the queue is full or
+            closed; the caller writes the update itself then. An update
+            of an image being written is queued even then, it must be
+            written after the batch.
+        """
+        with self._condition:
+            entry = self._pending.get(image_id)
+            if image_id not in self._in_flight and (
+                    self._closed or (entry is None and len(self._pending)
+                                     >= self.max_pending)):
+                self.rejected += 1
+                return None
+            self._start()
+            ticket = str(ObjectId())
+            if entry is None:
+                if not self._pending:
+                    self._oldest = time.monotonic()
+                    self._condition.notify()
+                self._pending[image_id] = {'status': status,
+                                           'tickets': [(ticket, status)],
+                                           'attempts': 0}
+            else:
+                entry['status'] = status
+                entry['tickets'].append((ticket, status))
+                self.coalesced += 1
+            self._tickets[ticket] = image_id
+            self.accepted += 1
+            if len(self._pending) >= self.max_batch:
+                self._condition.notify()
+            return ticket
+
+    def status(self, ticket):
+        """
+        State of an update accepted by this worker.
+
+        Args:
+            ticket (str): Ticket of the update.
+
+        Returns:
+            dict: The ticket with the 'state' 'pending' while the update
+            is queued or being written, 'flushed' with its result once
+            written (see find_update), None if the worker does not know
+            the ticket.
+        """
+        with self._condition:
+            if ticket in self._tickets:
+                return {'ticket': ticket, 'state': 'pending'}
+            update = self._results.get(ticket)
+        return dict(update, state='flushed') if update else None
+
+    def stats(self):
+        """
+        Settings and counters of the queue.
+        """
+        with self._condition:
+            return {
+                'max_batch': self.max_batch,
+                'interval': self.interval,
+                'pending': len(self._pending),
+                'accepted': self.accepted,
+                'coalesced': self.coalesced,
+                'rejected': self.rejected,
+                'batches': self.batches,
+                'written': self.written,
+                'retried': self.retried,
+                'failed': self.failed,
+            }
+
+    def close(self, timeout=None):
+        """
+        Write the queued updates and stop the thread. Updates submitted
+        afterwards are rejected, except those of an image being written.
+
+        Args:
+            timeout (float): Seconds to wait for the queue to be written,
+                None waits until it is.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name='write-coalescer',
+                                            daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                while len(self._pending) < self.max_batch \
+                        and not self._closed:
+                    remaining = self._oldest + self.interval \
+                        - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                batch = self._take_batch()
+            self._flush(batch)
+
+    def _take_batch(self):
+        batch = {}
+        for image_id in list(self._pending)[:self.max_batch]:
+            batch[image_id] = self._pending.pop(image_id)
+        self._oldest = time.monotonic() if self._pending else None
+        self._in_flight = set(batch)
+        return batch
+
+    def _flush(self, batch):
+        try:
+            results = self.write({image_id: entry['status']
+                                  for image_id, entry in batch.items()})
+        except Exception as err:
+            logger.warning("writing a batch of %d image statuses failed: %s",
+                           len(batch), err)
+            self._retry(batch, err)
+        else:
+            self.batches += 1
+            self.written += len(batch)
+            self._finish(batch, results)
+        finally:
+            with self._condition:
+                self._in_flight = set()
+
+    def _retry(self, batch, err):
+        failed = {}
+        with self._condition:
+            for image_id, entry in batch.items():
+                entry['attempts'] += 1
+                if entry['attempts'] >= self.max_attempts:
+                    failed[image_id] = entry
+                    continue
+                # updates accepted while the batch was written are newer
+                newer = self._pending.pop(image_id, None)
+                if newer is not None:
+                    entry['status'] = newer['status']
+                    entry['tickets'] += newer['tickets']
+                if not self._pending:
+                    # retried after the interval
+                    self._oldest = time.monotonic()
+                self._pending[image_id] = entry
+                self.retried += 1
+            self.failed += len(failed)
+        if failed:
+            self._finish(failed, {}, error=str(err))
+
+    def _finish(self, batch, results, error=None):
+        updates = []
+        for image_id, entry in batch.items():
+            *superseded, (ticket, status) = entry['tickets']
+            updates += [{'ticket': old_ticket, 'image_id': image_id,
+                         'status': old_status, 'result': 'superseded'}
+                        for old_ticket, old_status in superseded]
+            updates.append({'ticket': ticket, 'image_id': image_id,
+                            'status': status,
+                            'result': results.get(image_id, 'failed')})
+        try:
+            self.record(updates, error)
+        except Exception as err:
+            logger.warning("storing the results of a batch failed: %s", err)
+        flushed_at = datetime.utcnow()
+        with self._condition:
+            for update in updates:
+                self._tickets.pop(update['ticket'], None)
+                update['flushed_at'] = flushed_at
+                if error:
+                    update['error'] = error
+                self._results[update['ticket']] = update
+            while len(self._results) > self.max_pending:
+                self._results.popitem(last=False)
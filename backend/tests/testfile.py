@@ -1,6 +1,130 @@
 import unittest
+import unittest.mock
+import asyncio
+import gzip
 import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import zlib
+from datetime import datetime, timedelta
+from bson import ObjectId, Timestamp
+from pymongo import ReadPreference
+from pymongo.errors import OperationFailure
+from werkzeug.exceptions import ServiceUnavailable
 from app import app
+import models.models
+from models.models import db, images_collection, groups_collection
+from models.pipelines import groups_pipeline, images_page_pipeline
+from models.profiler import SlowQueryProfiler, plan_summary
+from models.indexes import migrate_indexes, verify_indexes
+import models.images
+import models.statistics
+from models.images import set_image_status, set_image_statuses
+from models.counters import (bump_data_version, get_data_version,
+                             rebuild_counters)
+from models.statistics import (seal_days, sealed_until, day_start,
+                               acquire_seal_lease, release_seal_lease,
+                               rebuild_daily_statistics)
+from models.write_queue import WriteCoalescer, find_update
+from models.events import (events_collection, publishes_events,
+                           change_event)
+from app import views
+from app import admission as app_admission
+from app import caching as app_caching
+from app import single_flight as app_single_flight
+from app import routing
+from config.config import (VALID_STATUSES, BULK_UPDATE_MAX_ITEMS,
+                           MONGODB_MAX_POOL_SIZE)
+from utils.cache import ResponseCache
+from utils.shared_cache import SharedMemoryFile, SharedResponseCache
+from utils.admission import AdmissionController
+from utils.compression import compress_chunks
+from utils.single_flight import SingleFlight
+from utils.broadcast import Broadcaster, ResumeError, RESYNC
+from utils.serializers import (msgpack, cbor2, msgpack_ext_hook,
+                               cbor_tag_hook)
+from utils.utils import sanitize_json
+from utils import metrics
+
+try:
+    from starlette.testclient import TestClient
+    from async_app import app as async_app
+    from async_app.events import event_stream
+except ImportError:  # requirements-async.txt is not installed
+    async_app = None
+
+
+def winning_plan_stages(explain):
+    """ Collect names of the stages of all winning plans found
+        in the output of the explain command
+    """
+    stages = []
+    if isinstance(explain, dict):
+        for key, value in explain.items():
+            if key == 'winningPlan':
+                stages += plan_stages(value)
+            elif key != 'rejectedPlans':
+                stages += winning_plan_stages(value)
+    elif isinstance(explain, list):
+        for value in explain:
+            stages += winning_plan_stages(value)
+    return stages
+
+
+def plan_stages(plan):
+    stages = []
+    if isinstance(plan, dict):
+        if isinstance(plan.get('stage'), str):
+            stages.append(plan['stage'])
+        for value in plan.values():
+            stages += plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            stages += plan_stages(value)
+    return stages
+
+
+class EventLog:
+    """ Source of a Broadcaster reading a list of (id, event) tuples,
+        the ids before 'first' are dropped
+    """
+
+    def __init__(self):
+        self.events = []
+        self.first = 0
+
+    def append(self, *ids):
+        self.events += [(id_, {'image_id': id_}) for id_ in ids]
+
+    async def __call__(self, after):
+        ids = [id_ for id_, _ in self.events]
+        if after is None:
+            position = len(ids)
+        elif after in ids[self.first:]:
+            position = ids.index(after) + 1
+        else:
+            raise ResumeError(after)
+        while True:
+            if position < len(self.events):
+                yield self.events[position]
+                position += 1
+            else:
+                await asyncio.sleep(0.01)
+                yield None
+
+
+async def receive(entries, number):
+    """ First number entries of a subscription, without heartbeats
+    """
+    received = []
+    async for entry in entries:
+        if entry is not None:
+            received.append(entry if entry == RESYNC else entry[0])
+            if len(received) == number:
+                break
+    return received
 
 
 class TestGroupsAPI(unittest.TestCase):
@@ -76,6 +200,197 @@ class TestGroupsAPI(unittest.TestCase):
             self.assertEqual(response.status_code, 200)
 
 
+class TestGroupsPagination(unittest.TestCase):
+
+    def setUp(self):
+        """ Needs the same test database as TestGroupsAPI
+        """
+        self.app = app.test_client()
+
+    def test_groups_pages_do_not_overlap(self):
+        response = self.app.get('/groups?limit=1')
+        self.assertEqual(response.status_code, 200)
+        first_page = response.get_json()
+        self.assertEqual(len(first_page), 1)
+        cursor = response.headers['X-Next-Cursor']
+
+        response = self.app.get(f'/groups?limit=1&after={cursor}')
+        self.assertEqual(response.status_code, 200)
+        second_page = response.get_json()
+        self.assertEqual(len(second_page), 1)
+        self.assertNotEqual(first_page[0]['_id'], second_page[0]['_id'])
+
+    def test_group_images_continuation(self):
+        response = self.app.get('/groups?limit=1&image_limit=2')
+        group = response.get_json()[0]
+        self.assertEqual(len(group['images']), 2)
+        self.assertGreater(group['count'], 2)
+        group_id = group['_id']
+
+        response = self.app.get(f'/groups/{group_id}/images'
+                                f'?after={group["images_next"]}')
+        self.assertEqual(response.status_code, 200)
+        images = response.get_json()
+        self.assertEqual(len(images), group['count'] - 2)
+        seen = {image['_id'] for image in group['images']}
+        self.assertFalse(seen & {image['_id'] for image in images})
+
+    def test_streamed_groups_match_regular_response(self):
+        response = self.app.get('/groups?limit=3')
+        streamed = self.app.get('/groups?limit=3&stream=true')
+        self.assertEqual(streamed.status_code, 200)
+        self.assertEqual(json.loads(streamed.data), response.get_json())
+        self.assertEqual(streamed.headers.get('X-Next-Cursor'),
+                         response.headers.get('X-Next-Cursor'))
+
+    def test_group_count_matches_images(self):
+        for query in ('', '&status=new'):
+            response = self.app.get(f'/groups?limit=5&image_limit=1000{query}')
+            for group in response.get_json():
+                self.assertEqual(group['count'], len(group['images']))
+
+    def test_invalid_limit(self):
+        response = self.app.get('/groups?limit=0')
+        answer = response.get_json()
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(answer['name'], "Invalid limit")
+        self.assertEqual(answer['code'], 400)
+
+    def test_invalid_cursor(self):
+        response = self.app.get('/groups?after=notacursor')
+        answer = response.get_json()
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(answer['name'], "Invalid cursor")
+        self.assertEqual(answer['code'], 400)
+
+
+class TestGroupsFields(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app.test_client()
+
+    def test_compact_profile_by_default(self):
+        groups = self.app.get('/groups?limit=2').get_json()
+        for group in groups:
+            for image in group['images']:
+                self.assertEqual(set(image), {'_id', 'url', 'status'})
+
+    def test_selected_fields(self):
+        response = self.app.get('/groups?limit=1&image_limit=2&fields=status')
+        group = response.get_json()[0]
+        self.assertEqual(set(group['images'][0]), {'_id', 'status'})
+        # the cursor does not depend on the returned fields
+        self.assertIn('images_next', group)
+
+        response = self.app.get(f"/groups/{group['_id']}/images"
+                                f"?after={group['images_next']}"
+                                f"&fields=status,created_at")
+        self.assertEqual(set(response.get_json()[0]),
+                         {'_id', 'status', 'created_at'})
+
+    def test_full_profile(self):
+        group = self.app.get('/groups?limit=1&fields=full').get_json()[0]
+        image = group['images'][0]
+        self.assertTrue({'_id', 'url', 'status', 'created_at',
+                         'group_id'} <= set(image))
+
+    def test_invalid_fields(self):
+        response = self.app.get('/groups?fields=url,password')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()['name'], "Invalid fields")
+
+
+class TestGroupsQueryPlan(unittest.TestCase):
+
+    def setUp(self):
+        """ Needs the same test database as TestGroupsAPI.
+            Indexes are created by the index migrations
+        """
+        migrate_indexes()
+        self.group_id = groups_collection.find_one()['_id']
+
+    def explain_images(self, pipeline, verbosity='queryPlanner'):
+        return db.command('explain',
+                          {'aggregate': images_collection.name,
+                           'pipeline': pipeline,
+                           'cursor': {}},
+                          verbosity=verbosity)
+
+    def test_filtered_images_use_index(self):
+        for status in VALID_STATUSES:
+            # $lookup prepends the match on its foreignField
+            pipeline = ([{'$match': {'group_id': self.group_id}}]
+                        + images_page_pipeline(status, 10))
+            stages = winning_plan_stages(self.explain_images(pipeline))
+            self.assertIn('IXSCAN', stages)
+            self.assertNotIn('COLLSCAN', stages)
+            # the index returns images already sorted by created_at
+            self.assertNotIn('SORT', stages)
+
+    def test_unfiltered_images_use_index(self):
+        pipeline = ([{'$match': {'group_id': self.group_id}}]
+                    + images_page_pipeline(None, 10))
+        stages = winning_plan_stages(self.explain_images(pipeline))
+        self.assertIn('IXSCAN', stages)
+        self.assertNotIn('COLLSCAN', stages)
+        self.assertNotIn('SORT', stages)
+
+    def test_groups_lookups_do_not_scan_images(self):
+        pipeline = groups_pipeline([self.group_id], 'new', 10)
+        explain = db.command('explain',
+                             {'aggregate': groups_collection.name,
+                              'pipeline': pipeline,
+                              'cursor': {}},
+                             verbosity='executionStats')
+        lookups = [stage for stage in explain.get('stages', [])
+                   if '$lookup' in stage]
+        self.assertEqual(len(lookups), 2)
+        for lookup in lookups:
+            self.assertEqual(lookup['collectionScans'], 0)
+            self.assertTrue(lookup['indexesUsed'])
+
+
+class TestIndexMigrations(unittest.TestCase):
+
+    def setUp(self):
+        migrate_indexes()
+
+    def test_migrations_are_idempotent(self):
+        self.assertEqual(migrate_indexes(), [])
+        self.assertEqual(verify_indexes(), [])
+        # applying them again changes nothing
+        for version, actions in migrate_indexes(force=True):
+            self.assertEqual(actions, [])
+
+    def test_obsolete_indexes_are_dropped(self):
+        images_collection.create_index([('status', 1), ('created_at', -1)])
+        results = migrate_indexes(dry_run=True, force=True)
+        self.assertIn(('drop', images_collection.name,
+                       'status_1_created_at_-1'), results[0][1])
+        self.assertIn('status_1_created_at_-1',
+                      images_collection.index_information())
+
+        migrate_indexes(force=True)
+        self.assertNotIn('status_1_created_at_-1',
+                         images_collection.index_information())
+
+    def test_old_server_is_rejected(self):
+        old_client = unittest.mock.Mock()
+        old_client.server_info.return_value = {'versionArray': [4, 4, 24, 0]}
+        with unittest.mock.patch.object(models.models, 'client', old_client):
+            with self.assertRaisesRegex(RuntimeError, '4.4.24'):
+                verify_indexes()
+
+    def test_missing_index_is_reported(self):
+        images_collection.drop_index('created_at_1_status_1')
+        self.assertEqual(verify_indexes(),
+                         [(images_collection.name, 'created_at_1_status_1')])
+        results = migrate_indexes(force=True)
+        self.assertIn(('create', images_collection.name,
+                       'created_at_1_status_1'), results[0][1])
+        self.assertEqual(verify_indexes(), [])
+
+
 class TestImageStatusChangeAPI(unittest.TestCase):
 
     def setUp(self):
@@ -93,7 +408,7 @@ class TestImageStatusChangeAPI(unittest.TestCase):
         # we know for created that it status is new
         response = self.app.get('/groups')
         data = response.get_json()
-        image_id = data[0]['images'][0]['_id']['$oid']
+        image_id = data[0]['images'][0]['_id']
 
         # define 4valid status
         data_new = {'status': 'new'}
@@ -139,7 +454,7 @@ class TestImageStatusChangeAPI(unittest.TestCase):
 
         response = self.app.get('/groups')
         data = response.get_json()
-        image_id = data[0]['images'][0]['_id']['$oid']
+        image_id = data[0]['images'][0]['_id']
 
         data_invalid = {'status': 'invalid'}
 
@@ -188,6 +503,342 @@ class TestImageStatusChangeAPI(unittest.TestCase):
         self.assertEqual(response.status_code, 400)
 
 
+class TestBulkImageStatusUpdate(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app.test_client()
+
+    def test_mixed_results(self):
+        images = self.app.get('/groups').get_json()[0]['images']
+        first, second = images[0], images[1]
+        other = 'accepted' if first['status'] != 'accepted' else 'review'
+
+        response = self.app.patch('/images', json=[
+            {'id': first['_id'], 'status': other},
+            {'id': second['_id'], 'status': second['status']},
+            {'id': '123456789012345678901234', 'status': 'new'},
+            {'id': 'notvalidatall', 'status': 'new'},
+            {'id': second['_id'], 'status': 'invalid'},
+        ])
+        answer = response.get_json()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['result'] for item in answer['results']],
+                         ['updated', 'unchanged', 'not_found', 'invalid_id',
+                          'invalid_status'])
+        self.assertEqual(answer['summary']['updated'], 1)
+
+        # restore the status with the single status format
+        response = self.app.patch('/images', json={
+            'ids': [first['_id'], first['_id']],
+            'status': first['status'],
+        })
+        self.assertEqual([item['result']
+                          for item in response.get_json()['results']],
+                         ['duplicate', 'updated'])
+
+    def test_concurrent_change_is_not_counted_twice(self):
+        if models.models.transactions_supported():
+            self.skipTest("transactions never see concurrent changes")
+        first, second = images_collection.find({'status': 'new'}).limit(2)
+        drift = rebuild_counters(dry_run=True)
+        class ConcurrentCollection:
+            # another request changes the second image before the update
+            def __init__(self, collection):
+                self.collection = collection
+
+            def __getattr__(self, name):
+                return getattr(self.collection, name)
+
+            def bulk_write(self, requests, **kwargs):
+                set_image_status(second['_id'], 'accepted')
+                return self.collection.bulk_write(requests, **kwargs)
+
+        with unittest.mock.patch.object(
+                models.images, 'images_collection',
+                ConcurrentCollection(models.images.images_collection)):
+            results = set_image_statuses({first['_id']: 'review',
+                                          second['_id']: 'review'})
+        try:
+            self.assertEqual(results, {first['_id']: 'updated',
+                                       second['_id']: 'updated'})
+            # the second image was updated again, last write wins
+            self.assertEqual(images_collection.find_one(
+                {'_id': second['_id']})['status'], 'review')
+            self.assertEqual(rebuild_counters(dry_run=True), drift)
+        finally:
+            set_image_statuses({first['_id']: 'new', second['_id']: 'new'})
+
+    def test_ambiguous_change_is_a_conflict(self):
+        if models.models.transactions_supported():
+            self.skipTest("transactions never see concurrent changes")
+        first, second = images_collection.find({'status': 'new'}).limit(2)
+        class ConcurrentCollection:
+            # another request sets the same status on the second image
+            def __init__(self, collection):
+                self.collection = collection
+
+            def __getattr__(self, name):
+                return getattr(self.collection, name)
+
+            def bulk_write(self, requests, **kwargs):
+                set_image_status(second['_id'], 'review')
+                return self.collection.bulk_write(requests, **kwargs)
+
+        with unittest.mock.patch.object(
+                models.images, 'images_collection',
+                ConcurrentCollection(models.images.images_collection)):
+            results = set_image_statuses({first['_id']: 'review',
+                                          second['_id']: 'review'})
+        try:
+            # one image was modified by the bulk write, which is unknown
+            self.assertEqual(results, {first['_id']: 'conflict',
+                                       second['_id']: 'conflict'})
+            self.assertEqual(images_collection.count_documents(
+                {'_id': {'$in': [first['_id'], second['_id']]},
+                 'status': 'review'}), 2)
+        finally:
+            set_image_statuses({first['_id']: 'new', second['_id']: 'new'})
+            rebuild_counters()
+
+    def test_invalid_request(self):
+        for body in ({'status': 'new'}, [], ['id']):
+            response = self.app.patch('/images', json=body)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.get_json()['name'], "Invalid request")
+
+    def test_batch_too_large(self):
+        response = self.app.patch('/images', json={
+            'ids': ['123456789012345678901234'] * (BULK_UPDATE_MAX_ITEMS + 1),
+            'status': 'new',
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()['name'], "Batch too large")
+
+
+class TestWriteCoalescing(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app.test_client()
+        self.image = images_collection.find_one({'status': 'new'})
+        self.writes = []
+
+    def tearDown(self):
+        set_image_statuses({self.image['_id']: 'new'})
+
+    def coalescer(self, write=None, max_batch=100, interval=60):
+        def recorded_write(updates):
+            self.writes.append(dict(updates))
+            return (write or set_image_statuses)(updates)
+        return WriteCoalescer(recorded_write, max_batch, interval, 1000, 2)
+
+    def test_updates_of_an_image_are_coalesced(self):
+        coalescer = self.coalescer()
+        tickets = [coalescer.submit(self.image['_id'], status)
+                   for status in ('review', 'accepted', 'deleted')]
+        self.assertEqual(coalescer.status(tickets[-1])['state'], 'pending')
+
+        # closing writes the queue
+        coalescer.close()
+        self.assertEqual(self.writes, [{self.image['_id']: 'deleted'}])
+        self.assertEqual(images_collection.find_one(
+            {'_id': self.image['_id']})['status'], 'deleted')
+        self.assertEqual([find_update(ticket)['result']
+                          for ticket in tickets],
+                         ['superseded', 'superseded', 'updated'])
+        self.assertEqual(coalescer.status(tickets[-1])['state'], 'flushed')
+        self.assertEqual(coalescer.stats()['coalesced'], 2)
+        self.assertIsNone(coalescer.submit(self.image['_id'], 'new'))
+
+    def test_full_batch_is_written(self):
+        coalescer = self.coalescer(max_batch=2)
+        images = list(images_collection.find({'status': 'new'},
+                                             {'_id': 1}).limit(2))
+        for image in images:
+            coalescer.submit(image['_id'], 'new')
+        for _ in range(100):
+            if self.writes:
+                break
+            threading.Event().wait(0.05)
+        self.assertEqual(len(self.writes), 1)
+        self.assertEqual(len(self.writes[0]), 2)
+        coalescer.close()
+
+    def test_failed_batch_is_retried(self):
+        def failing_write(updates):
+            raise RuntimeError("not writable")
+        coalescer = self.coalescer(write=failing_write, interval=0)
+        ticket = coalescer.submit(self.image['_id'], 'review')
+        coalescer.close()
+
+        # max_attempts writes, then the update fails
+        self.assertEqual(len(self.writes), 2)
+        result = find_update(ticket)
+        self.assertEqual(result['result'], 'failed')
+        self.assertEqual(result['error'], "not writable")
+
+    def test_update_of_image_being_written_is_queued(self):
+        started, release = threading.Event(), threading.Event()
+        writes = []
+
+        def blocking_write(updates):
+            writes.append(dict(updates))
+            started.set()
+            release.wait(5)
+            return set_image_statuses(updates)
+
+        coalescer = WriteCoalescer(blocking_write, 1, 0, 1, 2)
+        other = images_collection.find_one(
+            {'status': 'new', '_id': {'$ne': self.image['_id']}})
+        coalescer.submit(self.image['_id'], 'review')
+        started.wait(5)
+        # the queue is full, but the image is being written: written
+        # directly, the update could be overwritten by the batch
+        self.assertIsNotNone(coalescer.submit(other['_id'], 'new'))
+        self.assertIsNotNone(coalescer.submit(self.image['_id'], 'accepted'))
+        self.assertIsNone(coalescer.submit(ObjectId(), 'review'))
+        release.set()
+        coalescer.close()
+        self.assertEqual(writes, [{self.image['_id']: 'review'},
+                                  {other['_id']: 'new'},
+                                  {self.image['_id']: 'accepted'}])
+        self.assertEqual(images_collection.find_one(
+            {'_id': self.image['_id']})['status'], 'accepted')
+
+    def test_put_is_accepted(self):
+        coalescer = self.coalescer()
+        with unittest.mock.patch.object(views, 'write_coalescer',
+                                        coalescer):
+            response = self.app.put(f"/images/{self.image['_id']}",
+                                    json={'status': 'review'})
+            self.assertEqual(response.status_code, 202)
+            status_url = response.get_json()['status_url']
+            self.assertEqual(response.headers['Location'], status_url)
+            self.assertEqual(self.app.get(status_url).get_json()['state'],
+                             'pending')
+
+            coalescer.close()
+            answer = self.app.get(status_url).get_json()
+            self.assertEqual(answer['state'], 'flushed')
+            self.assertEqual(answer['result'], 'updated')
+
+            # a ticket of another worker not written yet
+            response = self.app.get(f'/images/updates/{ObjectId()}')
+            self.assertEqual(response.get_json()['state'], 'pending')
+
+    def test_status_without_coalescing(self):
+        response = self.app.get(f'/images/updates/{ObjectId()}')
+        self.assertEqual(response.status_code, 404)
+
+
+class TestStatusEvents(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app.test_client()
+        self.image = images_collection.find_one({'status': 'new'})
+
+    def tearDown(self):
+        set_image_statuses({self.image['_id']: 'new'})
+
+    def test_status_update_publishes_event(self):
+        if not publishes_events():
+            self.skipTest("events are read from change streams")
+        response = self.app.put(f"/images/{self.image['_id']}",
+                                json={'status': 'review'})
+        self.assertEqual(response.status_code, 200)
+        event = events_collection().find_one(sort=[('$natural', -1)])
+        self.assertEqual(event['image_id'], self.image['_id'])
+        self.assertEqual(event['group_id'], self.image['group_id'])
+        self.assertEqual((event['old_status'], event['new_status']),
+                         ('new', 'review'))
+
+        # the same status is no change
+        count = events_collection().count_documents({})
+        self.app.put(f"/images/{self.image['_id']}",
+                     json={'status': 'review'})
+        self.assertEqual(events_collection().count_documents({}), count)
+
+    def test_change_event(self):
+        change = {
+            '_id': {'_data': '8265'},
+            'clusterTime': Timestamp(1695124818, 1),
+            'documentKey': {'_id': self.image['_id']},
+            'fullDocument': {'_id': self.image['_id'],
+                             'group_id': self.image['group_id']},
+            'updateDescription': {'updatedFields': {'status': 'review'}},
+        }
+        id_, event = change_event(change)
+        self.assertEqual(id_, '8265')
+        self.assertEqual(event['ts'], datetime(2023, 9, 19, 12, 0, 18))
+        # without pre-image the old status is unknown
+        self.assertIsNone(event['old_status'])
+        self.assertEqual(event['new_status'], 'review')
+        self.assertEqual(event['group_id'], self.image['group_id'])
+
+    def test_broadcast_resumes_after_last_event(self):
+        async def run():
+            log = EventLog()
+            broadcaster = Broadcaster(log, buffer_size=2, queue_size=10)
+            live = asyncio.ensure_future(
+                receive(broadcaster.subscribe(heartbeat=0.05), 4))
+            await asyncio.sleep(0.05)
+            log.append('a', 'b', 'c', 'd')
+            results = [await live]
+            # from the buffer, and from a source of its own until the
+            # buffer is reached
+            results.append(await receive(broadcaster.subscribe('c'), 1))
+            results.append(await receive(broadcaster.subscribe('a'), 3))
+            # lost events
+            log.first = 2
+            log.append('e')
+            results.append(await receive(broadcaster.subscribe('a'), 2))
+            await broadcaster.close()
+            return results
+
+        self.assertEqual(asyncio.run(run()),
+                         [['a', 'b', 'c', 'd'], ['d'], ['b', 'c', 'd'],
+                          [RESYNC, 'e']])
+
+    def test_slow_subscriber_is_disconnected(self):
+        async def run():
+            log = EventLog()
+            broadcaster = Broadcaster(log, buffer_size=10, queue_size=2)
+            slow = broadcaster.subscribe()
+            first = asyncio.ensure_future(slow.__anext__())
+            await asyncio.sleep(0.05)
+            log.append('a', 'b', 'c', 'd')
+            await asyncio.sleep(0.1)
+            received = [(await first)[0]] + [id_ async for id_, _ in slow]
+            stats = broadcaster.stats()
+            await broadcaster.close()
+            return received, stats
+
+        received, stats = asyncio.run(run())
+        # the waiting events are sent before the disconnect
+        self.assertEqual(received, ['a', 'b'])
+        self.assertEqual((stats['dropped'], stats['subscribers']), (1, 0))
+
+    @unittest.skipUnless(async_app, "requirements-async.txt is not installed")
+    def test_event_stream(self):
+        async def run():
+            log = EventLog()
+            broadcaster = Broadcaster(log, buffer_size=10, queue_size=10)
+            stream = event_stream(None, broadcaster)
+            messages = [await stream.__anext__()]
+            message = asyncio.ensure_future(stream.__anext__())
+            await asyncio.sleep(0.05)
+            log.append('a')
+            messages.append(await message)
+            await stream.aclose()
+            await broadcaster.close()
+            return messages
+
+        retry, message = asyncio.run(run())
+        self.assertTrue(retry.startswith(b'retry: '))
+        self.assertEqual(message, b'id: a\nevent: status\n'
+                                  b'data: {"image_id":"a"}\n\n')
+
+
 class TestImageStatistics(unittest.TestCase):
 
     def setUp(self):
@@ -212,7 +863,7 @@ class TestImageStatistics(unittest.TestCase):
         # find some image
         response = self.app.get('/groups')
         data = response.get_json()
-        image_id = data[0]['images'][0]['_id']['$oid']
+        image_id = data[0]['images'][0]['_id']
 
         # define status change json
         data_new = {'status': 'new'}
@@ -250,6 +901,974 @@ class TestImageStatistics(unittest.TestCase):
         self.assertEqual(answer['new'],  new)
         self.assertEqual(answer['accepted'],  accepted)
 
+    def test_get_statistics_all_time(self):
+        response = self.app.get('/statistics?period=all')
+        self.assertEqual(response.status_code, 200)
+        answer = response.get_json()
+        new = answer.get('new', 0)
+        accepted = answer.get('accepted', 0)
+
+        response = self.app.get('/groups?status=new')
+        image_id = response.get_json()[0]['images'][0]['_id']
+
+        response = self.app.put(f'/images/{image_id}',
+                                data=json.dumps({'status': 'accepted'}),
+                                content_type='application/json',
+                                )
+        self.assertEqual(response.status_code, 200)
+        answer = self.app.get('/statistics?period=all').get_json()
+        self.assertEqual(answer.get('new', 0), new - 1)
+        self.assertEqual(answer['accepted'], accepted + 1)
+
+        response = self.app.put(f'/images/{image_id}',
+                                data=json.dumps({'status': 'new'}),
+                                content_type='application/json',
+                                )
+        answer = self.app.get('/statistics?period=all').get_json()
+        self.assertEqual(answer['new'], new)
+        self.assertEqual(answer.get('accepted', 0), accepted)
+
+    def test_get_statistics_buckets_sum_to_totals(self):
+        totals = self.app.get('/statistics?days=14').get_json()
+        for granularity in ('day', 'week'):
+            response = self.app.get(f'/statistics?days=14'
+                                    f'&granularity={granularity}')
+            self.assertEqual(response.status_code, 200)
+            buckets = response.get_json()
+            summed = {}
+            for bucket in buckets:
+                for status, count in bucket['counts'].items():
+                    summed[status] = summed.get(status, 0) + count
+            self.assertEqual(summed, totals)
+        # 14 days touch two or three weeks
+        self.assertIn(len(buckets), (2, 3))
+
+    def test_sealed_days(self):
+        statistics = models.models.daily_statistics_collection
+        today = day_start(datetime.utcnow())
+        past = today - timedelta(days=3)
+        image_id = images_collection.insert_one(
+            {'created_at': past + timedelta(hours=1), 'status': 'new',
+             'group_id': ObjectId(), 'url': 'http://x/past'}).inserted_id
+        try:
+            # nothing is sealed before the first rebuild
+            self.assertIsNone(seal_days(today))
+            self.assertIsNone(statistics.find_one({'_id': 'seal'}))
+            self.assertEqual(rebuild_daily_statistics(), [])
+            self.assertEqual(sealed_until(), today)
+            self.assertEqual(statistics.find_one({'_id': past})['counts'],
+                             {'new': 1})
+            # a status change updates the sealed day
+            set_image_status(image_id, 'review')
+            self.assertEqual(statistics.find_one({'_id': past})['counts'],
+                             {'new': 0, 'review': 1})
+            self.assertEqual(rebuild_daily_statistics(dry_run=True), [])
+            # drift is reported and fixed
+            statistics.update_one({'_id': past},
+                                  {'$inc': {'counts.review': 1}})
+            self.assertEqual(rebuild_daily_statistics(dry_run=True),
+                             [(past, 'review', 2, 1)])
+            self.assertEqual(rebuild_daily_statistics(),
+                             [(past, 'review', 2, 1)])
+            self.assertEqual(rebuild_daily_statistics(dry_run=True), [])
+            self.assertEqual(statistics.find_one({'_id': past})['counts'],
+                             {'review': 1})
+        finally:
+            images_collection.delete_one({'_id': image_id})
+            statistics.delete_many({})
+
+    def test_days_are_sealed_in_chunks(self):
+        statistics = models.models.daily_statistics_collection
+        today = day_start(datetime.utcnow())
+        past = today - timedelta(days=5)
+        image_id = images_collection.insert_one(
+            {'created_at': past + timedelta(hours=1), 'status': 'new',
+             'group_id': ObjectId(), 'url': 'http://x/past'}).inserted_id
+        statistics.insert_one({'_id': 'seal', 'sealed_until': past})
+        try:
+            with unittest.mock.patch.object(models.statistics,
+                                            'STATISTIC_SEAL_MAX_DAYS', 2), \
+                    unittest.mock.patch.object(
+                        models.statistics, 'count_images_per_day',
+                        wraps=models.statistics.count_images_per_day) \
+                    as count:
+                self.assertEqual(seal_days(today), today)
+            self.assertEqual(count.call_count, 3)
+            self.assertEqual(sealed_until(), today)
+            self.assertEqual(statistics.count_documents(
+                {'_id': {'$gte': past, '$lt': today}}), 5)
+            self.assertEqual(statistics.find_one({'_id': past})['counts'],
+                             {'new': 1})
+        finally:
+            images_collection.delete_one({'_id': image_id})
+            statistics.delete_many({})
+
+    def test_sealing_worker_holds_lease(self):
+        statistics = models.models.daily_statistics_collection
+        today = day_start(datetime.utcnow())
+        past = today - timedelta(days=3)
+        image_id = images_collection.insert_one(
+            {'created_at': past + timedelta(hours=1), 'status': 'new',
+             'group_id': ObjectId(), 'url': 'http://x/past'}).inserted_id
+        statistics.insert_one({'_id': 'seal', 'sealed_until': past})
+        lease = acquire_seal_lease()
+        try:
+            self.assertIsNone(acquire_seal_lease())
+            # another worker seals, the days are counted live
+            self.assertEqual(seal_days(today), past)
+            self.assertIsNone(statistics.find_one({'_id': past}))
+            counts = self.app.get('/statistics?days=7').get_json()
+            self.assertEqual(counts['new'],
+                             images_collection.count_documents(
+                                 {'status': 'new'}))
+            release_seal_lease(lease)
+            self.assertEqual(seal_days(today), today)
+        finally:
+            release_seal_lease(lease)
+            images_collection.delete_one({'_id': image_id})
+            statistics.delete_many({})
+
+    def test_get_statistics_invalid_days(self):
+        response = self.app.get('/statistics?days=week')
+        answer = response.get_json()
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(answer['name'], "Invalid days")
+        self.assertEqual(answer['code'], 400)
+
+
+class TestAdmissionControl(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app.test_client()
+
+    def waiting(self, controller, route, results):
+        # a request waiting for a slot in another thread
+        thread = threading.Thread(
+            target=lambda: results.append(controller.acquire(route)))
+        thread.start()
+        for _ in range(100):
+            if controller.stats()['routes'][route]['waiting']:
+                break
+            threading.Event().wait(0.01)
+        return thread
+
+    def test_waiting_request_is_admitted(self):
+        controller = AdmissionController({'/groups': 1}, 1, 5, 10)
+        self.assertEqual(controller.acquire('/groups')[0], None)
+        results = []
+        thread = self.waiting(controller, '/groups', results)
+        # the queue of the route is full
+        self.assertEqual(controller.acquire('/groups'), ('queue_full', 0.0))
+
+        controller.release('/groups')
+        thread.join()
+        self.assertIsNone(results[0][0])
+        stats = controller.stats()['routes']['/groups']
+        self.assertEqual((stats['admitted'], stats['queued']), (2, 1))
+        self.assertEqual(stats['shed']['queue_full'], 1)
+
+    def test_queue_timeout(self):
+        controller = AdmissionController({'/groups': 1}, 1, 0.05, 10)
+        controller.acquire('/groups')
+        reason, waited = controller.acquire('/groups')
+        self.assertEqual(reason, 'timeout')
+        self.assertGreaterEqual(waited, 0.05)
+
+    def test_threads_are_kept_free(self):
+        controller = AdmissionController({'/groups': 2, '/statistics': 2},
+                                         2, 5, 2)
+        controller.acquire('/groups')
+        controller.acquire('/statistics')
+        self.assertEqual(controller.acquire('/groups')[0], 'threads')
+        self.assertFalse(controller.limited('/images/<image_id>'))
+
+    def test_followers_occupy_threads(self):
+        controller = AdmissionController({'/groups': 1}, 1, 5, 2)
+        controller.acquire('/groups')
+        self.assertTrue(controller.follow())
+        # the follower takes no slot of the route, but a thread
+        self.assertFalse(controller.follow())
+        self.assertEqual(controller.acquire('/groups')[0], 'threads')
+        controller.unfollow()
+        stats = controller.stats()
+        self.assertEqual((stats['occupied'], stats['following'],
+                          stats['followers_shed']), (1, 0, 1))
+
+    def test_rejected_request(self):
+        controller = AdmissionController({'/groups': 1}, 0, 0, 10)
+        views.invalidate_responses()
+        with unittest.mock.patch.object(app_admission, 'admission',
+                                        controller):
+            controller.acquire('/groups')
+            response = self.app.get('/groups?limit=3')
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], '1')
+            self.assertEqual(response.get_json()['name'],
+                             "Service Unavailable")
+
+            # writes are not limited
+            image = images_collection.find_one()
+            response = self.app.put(f"/images/{image['_id']}",
+                                    json={'status': image['status']})
+            self.assertEqual(response.status_code, 200)
+
+            controller.release('/groups')
+            response = self.app.get('/groups?limit=3')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(controller.stats()['occupied'], 0)
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def follow(self, flights, key, function, results):
+        # a call of another thread joining the call in flight
+        thread = threading.Thread(target=lambda: results.append(
+            self.call(flights, key, function)))
+        followers = flights.stats()['followers']
+        thread.start()
+        for _ in range(100):
+            if flights.stats()['followers'] > followers:
+                break
+            threading.Event().wait(0.01)
+        return thread
+
+    def call(self, flights, key, function):
+        try:
+            return flights.do(key, function)
+        except Exception as err:
+            return err
+
+    def test_concurrent_calls_share_the_result(self):
+        flights = SingleFlight(timeout=5)
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'result'
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(
+            self.call(flights, 'key', slow)))
+        leader.start()
+        started.wait(5)
+        followers = [self.follow(flights, 'key', slow, results)
+                     for _ in range(3)]
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [('result', False)]
+                         + [('result', True)] * 3)
+        # nothing is kept, the next call runs the function again
+        self.assertEqual(flights.do('key', lambda: 'new'), ('new', False))
+
+    def test_error_is_raised_in_followers(self):
+        flights = SingleFlight(timeout=5)
+        started, release = threading.Event(), threading.Event()
+
+        def failing():
+            started.set()
+            release.wait(5)
+            raise ValueError("failed")
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(
+            self.call(flights, 'key', failing)))
+        leader.start()
+        started.wait(5)
+        follower = self.follow(flights, 'key', failing, results)
+        release.set()
+        leader.join()
+        follower.join()
+        self.assertEqual([str(result) for result in results],
+                         ["failed", "failed"])
+        self.assertEqual(flights.stats()['errors'], 1)
+
+    def test_follower_timeout(self):
+        flights = SingleFlight(timeout=0.05)
+        started, release = threading.Event(), threading.Event()
+
+        def slow():
+            started.set()
+            release.wait(5)
+            return 'leader'
+
+        leader = threading.Thread(target=flights.do, args=('key', slow))
+        leader.start()
+        started.wait(5)
+        # the follower stops waiting and calls the function itself
+        self.assertEqual(flights.do('key', lambda: 'own'), ('own', False))
+        release.set()
+        leader.join()
+        self.assertEqual(flights.stats()['timeouts'], 1)
+
+    def test_identical_requests_run_one_aggregation(self):
+        flights = SingleFlight(timeout=5)
+        started, release = threading.Event(), threading.Event()
+        calls = []
+        groups_pipeline = views.groups_pipeline
+
+        def blocking_pipeline(*args, **kwargs):
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return groups_pipeline(*args, **kwargs)
+
+        views.invalidate_responses()
+        responses = []
+
+        def get():
+            responses.append(app.test_client().get('/groups?status=review'))
+
+        with unittest.mock.patch.object(app_single_flight, 'flights',
+                                        flights), \
+                unittest.mock.patch.object(views, 'groups_pipeline',
+                                           blocking_pipeline):
+            leader = threading.Thread(target=get)
+            leader.start()
+            started.wait(5)
+            threads = [threading.Thread(target=get) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for _ in range(100):
+                if flights.stats()['followers'] == 2:
+                    break
+                threading.Event().wait(0.01)
+            release.set()
+            for thread in [leader] + threads:
+                thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual({response.status_code for response in responses},
+                         {200})
+        self.assertEqual(len({response.get_data()
+                              for response in responses}), 1)
+
+    def test_waiting_requests_count_against_threads(self):
+        flights = SingleFlight(timeout=5)
+        controller = AdmissionController({'/groups': 2}, 2, 5, 2)
+        started, release = threading.Event(), threading.Event()
+        groups_pipeline = views.groups_pipeline
+
+        def blocking_pipeline(*args, **kwargs):
+            started.set()
+            release.wait(5)
+            return groups_pipeline(*args, **kwargs)
+
+        views.invalidate_responses()
+        responses = []
+
+        def get():
+            responses.append(app.test_client().get('/groups?status=review'))
+
+        with unittest.mock.patch.object(app_single_flight, 'flights',
+                                        flights), \
+                unittest.mock.patch.object(app_admission, 'admission',
+                                           controller), \
+                unittest.mock.patch.object(views, 'groups_pipeline',
+                                           blocking_pipeline):
+            leader = threading.Thread(target=get)
+            leader.start()
+            started.wait(5)
+            follower = threading.Thread(target=get)
+            follower.start()
+            for _ in range(100):
+                if controller.stats()['following']:
+                    break
+                threading.Event().wait(0.01)
+            # the leader and the follower occupy both threads
+            response = app.test_client().get('/groups?status=review')
+            self.assertEqual(response.status_code, 503)
+            release.set()
+            for thread in (leader, follower):
+                thread.join()
+
+        self.assertEqual([response.status_code for response in responses],
+                         [200, 200])
+        stats = controller.stats()
+        self.assertEqual((stats['occupied'], stats['followers_shed']),
+                         (0, 1))
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app.test_client()
+        self.cache = ResponseCache(maxsize=2, max_bytes=100, ttl=60)
+
+    def test_lru_eviction(self):
+        for key in ('a', 'b'):
+            self.cache.set(key, key, 1, self.cache.generation.value)
+        self.assertEqual(self.cache.get('a'), 'a')
+        self.cache.set('c', 'c', 1, self.cache.generation.value)
+        # 'b' is the least recently used entry
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 'a')
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_invalidation(self):
+        generation = self.cache.generation.value
+        self.cache.set('a', 'a', 1, generation)
+        self.cache.invalidate()
+        self.assertIsNone(self.cache.get('a'))
+        # value computed before the invalidation is not cached
+        self.cache.set('a', 'a', 1, generation)
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_expiration(self):
+        cache = ResponseCache(maxsize=2, max_bytes=100, ttl=-1)
+        cache.set('a', 'a', 1, cache.generation.value)
+        self.assertIsNone(cache.get('a'))
+
+    def test_cached_endpoint_invalidated_by_update(self):
+        self.app.get('/statistics?days=7')
+        response = self.app.get('/statistics?days=7')
+        self.assertEqual(response.headers['X-Cache'], 'HIT')
+
+        image_id = self.app.get('/groups').get_json()[0]['images'][0]['_id']
+        for status in ('review', 'new'):
+            self.app.put(f'/images/{image_id}',
+                         data=json.dumps({'status': status}),
+                         content_type='application/json',
+                         )
+        response = self.app.get('/statistics?days=7')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+
+    def test_cached_endpoint_missed_after_foreign_write(self):
+        self.app.get('/statistics?days=7')
+        # a write of another service changes the data version only
+        bump_data_version()
+        response = self.app.get('/statistics?days=7')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertEqual(response.headers['ETag'].strip('"').split('-')[0],
+                         str(get_data_version()))
+
+
+class TestConditionalGet(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app.test_client()
+
+    def test_not_modified(self):
+        for url in ('/groups?limit=2', '/statistics'):
+            response = self.app.get(url)
+            etag = response.headers['ETag']
+            self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+
+            response = self.app.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.data, b'')
+            self.assertEqual(response.headers['ETag'], etag)
+
+    def test_modified_after_update(self):
+        response = self.app.get('/groups?limit=2')
+        etag = response.headers['ETag']
+        image = response.get_json()[0]['images'][0]
+        for status in ('deleted', image['status']):
+            self.app.put(f'/images/{image["_id"]}',
+                         data=json.dumps({'status': status}),
+                         content_type='application/json',
+                         )
+        response = self.app.get('/groups?limit=2',
+                                headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+
+def bump_shared_generation(path):
+    """ Invalidate a shared cache from another process
+    """
+    SharedResponseCache(SharedMemoryFile(path, 4, 4096), 60).generation.bump()
+
+
+class TestSharedResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+        self.cache = SharedResponseCache(SharedMemoryFile(self.path, 4, 4096),
+                                         ttl=60)
+
+    def tearDown(self):
+        os.remove(self.path)
+        os.remove(self.cache.file.path)
+
+    def test_set_and_get(self):
+        self.cache.set('a', b'value', self.cache.generation.value)
+        self.assertEqual(self.cache.get('a'), b'value')
+        self.assertIsNone(self.cache.get('b'))
+
+    def test_value_larger_than_slot_is_not_cached(self):
+        self.cache.set('a', b'x' * 4096, self.cache.generation.value)
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_invalidation_from_another_process(self):
+        self.cache.set('a', b'value', self.cache.generation.value)
+        process = multiprocessing.Process(target=bump_shared_generation,
+                                          args=(self.path,))
+        process.start()
+        process.join()
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_other_geometry_uses_another_file(self):
+        self.cache.set('a', b'value', self.cache.generation.value)
+        generation = self.cache.generation.value
+        other = SharedResponseCache(SharedMemoryFile(self.path, 8, 4096), 60)
+        try:
+            self.assertIsNone(other.get('a'))
+            self.assertNotEqual(other.file.path, self.cache.file.path)
+        finally:
+            os.remove(other.file.path)
+        # the file in use is left alone
+        self.assertEqual(self.cache.get('a'), b'value')
+        self.assertEqual(self.cache.generation.value, generation)
+
+
+def report_client_after_fork(queue):
+    """ Tell the parent whether the client of the parent was dropped
+    """
+    queue.put(models.models._client is None)
+
+
+class TestMongoClient(unittest.TestCase):
+
+    def test_client_is_dropped_after_fork(self):
+        parent_client = models.models.get_client()
+        context = multiprocessing.get_context('fork')
+        queue = context.Queue()
+        process = context.Process(target=report_client_after_fork,
+                                  args=(queue,))
+        process.start()
+        self.assertTrue(queue.get(timeout=30))
+        process.join()
+        self.assertIs(models.models.get_client(), parent_client)
+
+    def test_proxies_resolve_to_the_client(self):
+        self.assertEqual(images_collection.name,
+                         models.models.get_collection(
+                             images_collection.name).name)
+        self.assertEqual(db.name, images_collection.database.name)
+
+    def test_pool_options(self):
+        options = models.models.client_options()
+        self.assertEqual(options['maxPoolSize'], MONGODB_MAX_POOL_SIZE)
+        self.assertGreater(options['waitQueueTimeoutMS'], 0)
+
+    def test_warm_up(self):
+        self.assertEqual(models.models.warm_up(3), 3)
+        self.assertEqual(models.models.warm_up(0), 0)
+
+
+class TestReadRouting(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app.test_client()
+
+    def test_read_preference(self):
+        preference = models.models.read_preference('secondaryPreferred', 90)
+        self.assertEqual(preference.mongos_mode, 'secondaryPreferred')
+        self.assertEqual(preference.max_staleness, 90)
+        self.assertEqual(models.models.read_preference('primary').mode, 0)
+        with self.assertRaises(ValueError):
+            models.models.read_preference('secondaries')
+
+    def test_route_read_preferences(self):
+        self.assertEqual(
+            set(routing.ROUTE_READ_PREFERENCES),
+            {'/groups', '/groups/<group_id>/images', '/statistics'})
+        reads = models.models.Reads(routing.ROUTE_READ_PREFERENCES['/groups'])
+        self.assertEqual(reads(images_collection).read_preference,
+                         routing.ROUTE_READ_PREFERENCES['/groups'])
+        self.assertEqual(models.models.PRIMARY_READS.preference.mode, 0)
+        self.assertIsNone(models.models.PRIMARY_READS.session)
+
+    def test_consistency_token_round_trip(self):
+        operation_time = Timestamp(1700000000, 7)
+        cluster_time = {'clusterTime': operation_time,
+                        'signature': {'keyId': 0}}
+        writer = unittest.mock.Mock(operation_time=operation_time,
+                                    cluster_time=cluster_time)
+        token = models.models.session_token(writer)
+        reader = unittest.mock.Mock(cluster_time=None)
+
+        def ping(*args, **kwargs):
+            # the reader learns the cluster time
+            reader.cluster_time = {'clusterTime': Timestamp(1700000001, 1)}
+
+        reader.client.admin.command.side_effect = ping
+        models.models.advance_session(reader, token)
+        reader.advance_operation_time.assert_called_once_with(operation_time)
+        # the cluster time of the client is never trusted
+        reader.advance_cluster_time.assert_not_called()
+        self.assertIsNone(models.models.session_token(None))
+        with self.assertRaises(ValueError):
+            models.models.advance_session(reader, 'not-a-token')
+
+    def test_consistency_token_from_the_future(self):
+        writer = unittest.mock.Mock(operation_time=Timestamp(1800000000, 1))
+        token = models.models.session_token(writer)
+        reader = unittest.mock.Mock(
+            cluster_time={'clusterTime': Timestamp(1700000000, 1)})
+        with self.assertRaises(ValueError):
+            models.models.advance_session(reader, token)
+        reader.advance_operation_time.assert_not_called()
+
+    def test_rejected_consistency_token(self):
+        rejection = OperationFailure("afterClusterTime is newer", code=72)
+        with app.test_request_context(
+                '/groups', headers={routing.TOKEN_HEADER: 'token'}):
+            response = app.make_response(
+                routing.handle_rejected_token(rejection))
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.get_json()['name'],
+                             "Invalid consistency token")
+            with self.assertRaises(OperationFailure):
+                routing.handle_rejected_token(OperationFailure("failed",
+                                                               code=2))
+        with app.test_request_context('/groups'):
+            with self.assertRaises(OperationFailure):
+                routing.handle_rejected_token(rejection)
+
+    def test_read_your_writes(self):
+        if not models.models.replica_set():
+            self.skipTest("the server is not a replica set member")
+        image = self.app.get('/groups').get_json()[0]['images'][0]
+        response = self.app.put(f"/images/{image['_id']}",
+                                data=json.dumps({'status': image['status']}),
+                                content_type='application/json',
+                                )
+        token = response.headers[routing.TOKEN_HEADER]
+        response = self.app.get(f"/groups?status={image['status']}",
+                                headers={routing.TOKEN_HEADER: token})
+        self.assertEqual(response.status_code, 200)
+        response = self.app.get('/groups',
+                                headers={routing.TOKEN_HEADER: 'bad'})
+        self.assertEqual(response.status_code, 400)
+
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app.test_client()
+
+    def test_gzip_response(self):
+        plain = self.app.get('/groups?fields=full')
+        response = self.app.get('/groups?fields=full',
+                                headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertLess(len(response.data), len(plain.data))
+        self.assertEqual(gzip.decompress(response.data), plain.data)
+
+        # compressed representation has its own ETag
+        etag = response.headers['ETag']
+        self.assertNotEqual(etag, plain.headers['ETag'])
+        response = self.app.get('/groups?fields=full',
+                                headers={'Accept-Encoding': 'gzip',
+                                         'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+    def test_gzip_streamed_response(self):
+        plain = self.app.get('/groups?limit=3')
+        response = self.app.get('/groups?limit=3&stream=true',
+                                headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(response.data)),
+                         plain.get_json())
+
+    def test_streamed_chunks_are_flushed(self):
+        chunks = compress_chunks(iter([b'[1', b',2', b']']), 'gzip', 6)
+        decompressor = zlib.decompressobj(31)
+        self.assertEqual(decompressor.decompress(next(chunks)), b'[1')
+        self.assertEqual(decompressor.decompress(next(chunks)), b',2')
+        self.assertEqual(decompressor.decompress(b''.join(chunks)), b']')
+        self.assertTrue(decompressor.eof)
+
+    def test_small_response_not_compressed(self):
+        response = self.app.get('/groups?status=invalid',
+                                headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+
+
+class TestBinaryFormats(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app.test_client()
+
+    @unittest.skipUnless(msgpack, "msgpack is not installed")
+    def test_msgpack_groups(self):
+        expected = self.app.get('/groups?limit=2&fields=full')
+        response = self.app.get('/groups?limit=2&fields=full',
+                                headers={'Accept': 'application/msgpack'})
+        self.assertEqual(response.mimetype, 'application/msgpack')
+        self.assertIn('Accept', response.headers['Vary'])
+        self.assertNotEqual(response.headers['ETag'],
+                            expected.headers['ETag'])
+
+        groups = msgpack.unpackb(response.data, ext_hook=msgpack_ext_hook,
+                                 timestamp=3)
+        image = groups[0]['images'][0]
+        self.assertIsInstance(image['_id'], ObjectId)
+        self.assertIsInstance(image['created_at'], datetime)
+        self.assertEqual(sanitize_json(groups), expected.get_json())
+
+    @unittest.skipUnless(cbor2, "cbor2 is not installed")
+    def test_cbor_statistics(self):
+        expected = self.app.get('/statistics?granularity=week')
+        response = self.app.get('/statistics?granularity=week',
+                                headers={'Accept': 'application/cbor'})
+        self.assertEqual(response.mimetype, 'application/cbor')
+        self.assertEqual(cbor2.loads(response.data, tag_hook=cbor_tag_hook),
+                         expected.get_json())
+
+    def test_json_by_default(self):
+        response = self.app.get('/statistics', headers={'Accept': '*/*'})
+        self.assertEqual(response.mimetype, 'application/json')
+
+
+class TestSlowQueryProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app.test_client()
+        group_ids = [group['_id'] for group in groups_collection.find()]
+        self.pipeline = groups_pipeline(group_ids, None, 10)
+
+    def run_profiled(self, profiler):
+        with profiler.profile('groups', groups_collection, self.pipeline):
+            list(groups_collection.aggregate(self.pipeline))
+
+    def test_slow_aggregation_is_explained(self):
+        profiler = SlowQueryProfiler(0, 1, 0, 10, 5000, background=False)
+        self.run_profiled(profiler)
+        entry = profiler.stats()['entries'][0]
+        self.assertEqual(entry['name'], 'groups')
+        self.assertEqual(entry['pipeline'], self.pipeline)
+        # mongomock and old servers can not explain aggregations
+        if 'explain_error' not in entry:
+            self.assertEqual(profiler.explained, 1)
+            self.assertTrue(entry['plan']['plan_stages'])
+
+    def test_explains_are_sampled(self):
+        profiler = SlowQueryProfiler(0, 0, 0, 10, 5000, background=False)
+        self.run_profiled(profiler)
+        self.assertEqual((profiler.slow, profiler.skipped), (1, 1))
+        self.assertIsNone(profiler.stats()['entries'][0]['plan'])
+
+        profiler = SlowQueryProfiler(0, 1, 3600, 10, 5000, background=False)
+        self.run_profiled(profiler)
+        self.run_profiled(profiler)
+        self.assertEqual((profiler.slow, profiler.skipped), (2, 1))
+
+    def test_explain_uses_read_preference(self):
+        profiler = SlowQueryProfiler(0, 1, 0, 10, 5000, background=False)
+        collection = groups_collection.with_options(
+            read_preference=ReadPreference.SECONDARY_PREFERRED)
+        with unittest.mock.patch.object(type(collection.database),
+                                        'command',
+                                        return_value={}) as command:
+            with profiler.profile('groups', collection, self.pipeline):
+                pass
+        self.assertEqual(command.call_args.kwargs['read_preference'],
+                         ReadPreference.SECONDARY_PREFERRED)
+
+    def test_fast_aggregation_is_not_recorded(self):
+        profiler = SlowQueryProfiler(60000, 1, 0, 10, 5000)
+        self.run_profiled(profiler)
+        self.assertEqual(profiler.stats()['entries'], [])
+
+    def test_plan_summary(self):
+        explain = {'stages': [
+            {'$cursor': {
+                'queryPlanner': {
+                    'winningPlan': {'stage': 'FETCH', 'inputStage': {
+                        'stage': 'IXSCAN', 'keyPattern': {'_id': 1}}},
+                    'rejectedPlans': [{'stage': 'COLLSCAN'}]},
+                'executionStats': {'nReturned': 5,
+                                   'executionTimeMillis': 12,
+                                   'totalKeysExamined': 5,
+                                   'totalDocsExamined': 5}}},
+            {'$lookup': {'from': 'images', 'as': 'images'},
+             'totalDocsExamined': 500, 'totalKeysExamined': 0,
+             'collectionScans': 5, 'indexesUsed': []},
+            {'$sort': {'sortKey': {'name': 1}}, 'usedDisk': False},
+        ]}
+        summary = plan_summary(explain)
+        self.assertEqual(summary['plan_stages'], ['FETCH', 'IXSCAN'])
+        self.assertEqual(summary['pipeline_stages'],
+                         ['$cursor', '$lookup', '$sort'])
+        self.assertEqual((summary['keys_examined'],
+                          summary['docs_examined'],
+                          summary['returned'],
+                          summary['execution_ms']), (5, 505, 5, 12))
+        self.assertTrue(summary['collection_scan'])
+        self.assertTrue(summary['in_memory_sort'])
+        self.assertFalse(summary['used_disk'])
+        self.assertEqual(summary['lookups'][0]['from'], 'images')
+
+    def test_debug_endpoint(self):
+        response = self.app.get('/debug/slow-queries')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('entries', response.get_json())
+
+
+@unittest.skipUnless(metrics.ENABLED, "prometheus_client is not installed")
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app.test_client()
+
+    def sample(self, name, **labels):
+        return metrics.prometheus_client.REGISTRY.get_sample_value(
+            name, labels) or 0
+
+    def test_request_metrics(self):
+        labels = {'method': 'GET', 'route': '/groups/<group_id>/images'}
+        count = self.sample('http_request_duration_seconds_count',
+                            status='200', **labels)
+        sizes = self.sample('http_response_size_bytes_count', **labels)
+
+        group_id = groups_collection.find_one()['_id']
+        self.app.get(f'/groups/{group_id}/images')
+        self.assertEqual(self.sample('http_request_duration_seconds_count',
+                                     status='200', **labels), count + 1)
+        self.assertEqual(self.sample('http_response_size_bytes_count',
+                                     **labels), sizes + 1)
+        self.assertEqual(self.sample('http_requests_in_progress', **labels),
+                         0)
+
+    def test_streamed_and_unmatched_requests(self):
+        labels = {'method': 'GET', 'route': '/groups'}
+        size = self.sample('http_response_size_bytes_sum', **labels)
+        # recorded when the streamed body was sent
+        body = self.app.get('/groups?limit=2&stream=true').data
+        self.assertEqual(self.sample('http_response_size_bytes_sum',
+                                     **labels), size + len(body))
+
+        count = self.sample('http_request_duration_seconds_count',
+                            method='GET', route='unmatched', status='404')
+        self.app.get('/no/such/route')
+        self.assertEqual(self.sample('http_request_duration_seconds_count',
+                                     method='GET', route='unmatched',
+                                     status='404'), count + 1)
+
+    def test_metrics_endpoint(self):
+        self.app.get('/statistics')
+        response = self.app.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/plain')
+        self.assertIn(b'http_request_duration_seconds_bucket{',
+                      response.data)
+        self.assertIn(b'route="/statistics"', response.data)
+
+    def test_command_timer(self):
+        labels = {'command': 'aggregate', 'collection': 'images',
+                  'outcome': 'succeeded'}
+        count = self.sample('mongodb_command_duration_seconds_count',
+                            **labels)
+        timer = metrics.CommandTimer()
+        timer.started(unittest.mock.Mock(
+            request_id=1, connection_id=('localhost', 27017),
+            command_name='aggregate',
+            command={'aggregate': 'images', 'pipeline': []}))
+        timer.succeeded(unittest.mock.Mock(
+            request_id=1, connection_id=('localhost', 27017),
+            command_name='aggregate', duration_micros=1500))
+        self.assertEqual(self.sample('mongodb_command_duration_seconds_count',
+                                     **labels), count + 1)
+        self.assertEqual(metrics.command_collection(
+            'getMore', {'getMore': 42, 'collection': 'groups'}), 'groups')
+        self.assertEqual(metrics.command_collection('hello', {'hello': 1}),
+                         '')
+
+    def test_pool_checkout_timer(self):
+        count = self.sample('mongodb_pool_checkout_seconds_count')
+        timer = metrics.PoolCheckoutTimer()
+        timer.connection_check_out_started(None)
+        timer.connection_checked_out(None)
+        self.assertEqual(self.sample('mongodb_pool_checkout_seconds_count'),
+                         count + 1)
+
+
+@unittest.skipUnless(async_app, "requirements-async.txt is not installed")
+class TestAsyncApp(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # one client (and event loop) for all tests, the Motor client is
+        # bound to the loop it was first used in
+        cls.async_client = TestClient(async_app).__enter__()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.async_client.__exit__(None, None, None)
+
+    def setUp(self):
+        self.app = app.test_client()
+
+    def test_same_responses_as_flask(self):
+        for url in ('/groups?limit=3&image_limit=2',
+                    '/groups?limit=2&stream=true',
+                    '/statistics?granularity=week',
+                    '/statistics?period=all'):
+            expected = self.app.get(url)
+            response = self.async_client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content, expected.data)
+            self.assertEqual(response.headers.get('X-Next-Cursor'),
+                             expected.headers.get('X-Next-Cursor'))
+
+    def test_same_errors_as_flask(self):
+        for url in ('/groups?status=invalid', '/statistics?days=0',
+                    '/wrong_endpoint'):
+            expected = self.app.get(url)
+            response = self.async_client.get(url)
+            self.assertEqual(response.status_code, expected.status_code)
+            self.assertEqual(response.json(), expected.get_json())
+
+    def test_update_image_status(self):
+        image = self.app.get('/groups').get_json()[0]['images'][0]
+        other = 'accepted' if image['status'] != 'accepted' else 'review'
+
+        response = self.async_client.put(f"/images/{image['_id']}",
+                                         json={'status': other})
+        self.assertEqual(response.json()['message'], 'Image status updated')
+        response = self.async_client.put(f"/images/{image['_id']}",
+                                         json={'status': image['status']})
+        self.assertEqual(response.status_code, 200)
+
+    def test_update_drops_cached_responses(self):
+        if app_caching.shared_cache is None:
+            self.skipTest("the shared response cache is disabled")
+        image = self.app.get('/groups').get_json()[0]['images'][0]
+        other = 'accepted' if image['status'] != 'accepted' else 'review'
+        generation = app_caching.response_cache.generation.value
+        self.async_client.put(f"/images/{image['_id']}",
+                              json={'status': other})
+        self.assertGreater(app_caching.response_cache.generation.value,
+                           generation)
+        self.async_client.put(f"/images/{image['_id']}",
+                              json={'status': image['status']})
+
+    def test_error_headers(self):
+        response = self.async_client.delete('/groups')
+        self.assertEqual(response.status_code, 405)
+        self.assertIn('GET', response.headers['Allow'])
+        self.assertEqual(response.json()['name'], "Method Not Allowed")
+        # headers of a werkzeug error raised by a view
+        with unittest.mock.patch(
+                'async_app.views.get_global_counts',
+                side_effect=ServiceUnavailable("busy", retry_after=3)):
+            response = self.async_client.get('/statistics?period=all')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '3')
+        self.assertEqual(response.headers['Content-Type'],
+                         'application/json')
+
+
 
 if __name__ == '__main__':
     unittest.main()
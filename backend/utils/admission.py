@@ -0,0 +1,184 @@
+"""
+Admission Control
+
+Limits the number of concurrent requests of the expensive read routes
+(the aggregations of /groups and /statistics) in a worker. A request
+beyond the limit of its route waits for a free slot in a bounded queue:
+
+- if ADMISSION_QUEUE_SIZE requests of the route already wait, or
+- if it waited ADMISSION_QUEUE_TIMEOUT seconds without a free slot, or
+- if the limited requests of all routes, running and waiting, already
+  occupy ADMISSION_MAX_THREADS threads of the worker,
+
+it is rejected with 503 Service Unavailable and a Retry-After header,
+instead of adding one more aggregation to an overloaded server.
+
+In a gunicorn gthread worker a waiting request holds a thread as well,
+so the last condition keeps threads free for the routes that are not
+limited. Requests waiting for an identical request in flight
+('utils.single_flight') take no slot of their route, but occupy a
+thread the same way (follow). Status updates (PUT and PATCH /images) are never limited and
+always find a thread: writes take priority over the heavy reads, which
+are shed first.
+
+Configuration (see 'config.config'):
+- ADMISSION_CONTROL_ENABLED, ADMISSION_LIMITS, ADMISSION_QUEUE_SIZE,
+- ADMISSION_QUEUE_TIMEOUT, ADMISSION_MAX_THREADS and
+  ADMISSION_RETRY_AFTER.
+"""
+
+import threading
+import time
+
+SHED_REASONS = ('queue_full', 'timeout', 'threads')
+
+
+class AdmissionController:
+    """
+    Concurrency limits of routes with bounded queues of waiting requests.
+
+    Args:
+        limits (dict): {route: number of concurrent requests}, routes
+            with a limit of 0 are not limited.
+        queue_size (int): Number of waiting requests per route.
+        queue_timeout (float): Seconds a request waits at most.
+        max_threads (int): Number of limited requests of all routes,
+            running or waiting.
+    """
+
+    def __init__(self, limits, queue_size, queue_timeout, max_threads):
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.max_threads = max_threads
+        self._lock = threading.Lock()
+        self._routes = {
+            route: {
+                'limit': limit,
+                'running': 0,
+                'waiting': 0,
+                'admitted': 0,
+                'queued': 0,
+                'shed': dict.fromkeys(SHED_REASONS, 0),
+                # waiting requests of the route are woken one by one
+                'condition': threading.Condition(self._lock),
+            }
+            for route, limit in limits.items() if limit > 0
+        }
+        self._occupied = 0
+        self._following = 0
+        self._followers_shed = 0
+
+    def limited(self, route):
+        """
+        Whether requests of a route are limited.
+        """
+        return route in self._routes
+
+    def acquire(self, route):
+        """
+        Take a slot of a route, waiting for a free one if needed.
+
+        Args:
+            route (str): A limited route, e.g. '/groups'.
+
+        Returns:
+            tuple: (reason, waited). reason is None if the request is
+            admitted, otherwise why it was rejected: 'queue_full',
+            'timeout' or 'threads'. waited is the time spent waiting in
+            seconds.
+        """
+        state = self._routes[route]
+        started = time.monotonic()
+        with self._lock:
+            if self._occupied >= self.max_threads:
+                return self._shed(state, 'threads'), 0.0
+            if state['running'] >= state['limit']:
+                if state['waiting'] >= self.queue_size:
+                    return self._shed(state, 'queue_full'), 0.0
+                if not self._wait(state, started + self.queue_timeout):
+                    return (self._shed(state, 'timeout'),
+                            time.monotonic() - started)
+            state['running'] += 1
+            state['admitted'] += 1
+            self._occupied += 1
+        return None, time.monotonic() - started
+
+    def follow(self):
+        """
+        Take a thread for a request waiting for an identical request in
+        flight, without a slot of a route.
+
+        Returns:
+            bool: True if the request may wait, False if the limited
+            requests of all routes already occupy max_threads threads.
+        """
+        with self._lock:
+            if self._occupied >= self.max_threads:
+                self._followers_shed += 1
+                return False
+            self._occupied += 1
+            self._following += 1
+            return True
+
+    def unfollow(self):
+        """
+        Free the thread taken by follow.
+        """
+        with self._lock:
+            self._occupied -= 1
+            self._following -= 1
+
+    def release(self, route):
+        """
+        Free the slot taken by an admitted request.
+        """
+        state = self._routes[route]
+        with self._lock:
+            state['running'] -= 1
+            self._occupied -= 1
+            state['condition'].notify()
+
+    def stats(self):
+        """
+        Settings and counters of the limited routes.
+        """
+        with self._lock:
+            return {
+                'queue_size': self.queue_size,
+                'queue_timeout': self.queue_timeout,
+                'max_threads': self.max_threads,
+                'occupied': self._occupied,
+                'following': self._following,
+                'followers_shed': self._followers_shed,
+                'routes': {
+                    route: {
+                        'limit': state['limit'],
+                        'running': state['running'],
+                        'waiting': state['waiting'],
+                        'admitted': state['admitted'],
+                        'queued': state['queued'],
+                        'shed': dict(state['shed']),
+                    }
+                    for route, state in self._routes.items()
+                },
+            }
+
+    def _wait(self, state, deadline):
+        # called with the lock held
+        state['waiting'] += 1
+        state['queued'] += 1
+        self._occupied += 1
+        try:
+            while state['running'] >= state['limit']:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                state['condition'].wait(remaining)
+            return True
+        finally:
+            state['waiting'] -= 1
+            self._occupied -= 1
+
+    def _shed(self, state, reason):
+        state['shed'][reason] += 1
+        return reason
@@ -0,0 +1,232 @@
+"""
+Event Broadcast
+
+Fans out the events of one source to many asyncio subscribers, e.g. the
+Server-Sent Events clients of a worker ('async_app.events'). The source
+is read by one task of the worker however many clients subscribe, and
+the last events are kept in a ring buffer.
+
+A source is a function source(after) returning an async iterator of
+(id, event) tuples: the events after the one with the id 'after' in
+order, or the new events for None. It yields None when no event arrived
+for a while, and raises ResumeError when it can not resume after the id
+(e.g. the event was dropped from its history).
+
+A subscriber passing the id of the last event it got (the Last-Event-ID
+of a reconnecting client) first gets the events it missed: from the
+buffer when the id is still there, otherwise from a source of its own
+until it reaches the buffer or the newest event. If the events after the
+id are lost it gets RESYNC, then the new events.
+
+A subscriber is never awaited by the source: a subscriber that has
+'queue_size' events waiting (a client reading slower than the events
+arrive) is disconnected after the waiting events, it resumes with the
+id of the last one.
+"""
+
+import asyncio
+import logging
+from collections import deque
+from contextlib import aclosing
+
+logger = logging.getLogger(__name__)
+
+# yielded to a subscriber whose events may have been lost
+RESYNC = 'resync'
+
+
+class ResumeError(Exception):
+    """
+    The source can not resume after an id.
+    """
+
+
+class _Subscriber:
+
+    def __init__(self):
+        self.events = deque()
+        self.ready = asyncio.Event()
+        self.dropped = False
+
+
+class Broadcaster:
+    """
+    Fans out the events of a source to subscribers.
+
+    Args:
+        source (callable): source(after), see above.
+        buffer_size (int): Number of last events kept for resuming
+            subscribers.
+        queue_size (int): Number of events waiting for a subscriber.
+        retry_delay (float): Seconds before the source is read again
+            after an error.
+    """
+
+    def __init__(self, source, buffer_size, queue_size, retry_delay=1.0):
+        self._source = source
+        self.queue_size = queue_size
+        self.retry_delay = retry_delay
+        # (sequence number, id, event) of the last events
+        self._buffer = deque(maxlen=max(1, buffer_size))
+        self._positions = {}
+        self._sequence = 0
+        self._last_id = None
+        self._subscribers = set()
+        self._task = None
+        self.published = 0
+        self.dropped = 0
+        self.catch_ups = 0
+        self.resyncs = 0
+        self.errors = 0
+
+    def start(self):
+        """
+        Start reading the source in the running event loop, once.
+        """
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def close(self):
+        """
+        Stop reading the source.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def subscribe(self, after=None, heartbeat=None):
+        """
+        Events after the one with the id 'after', then the new events as
+        they are published.
+
+        Args:
+            after (str, optional): Id of the last event of the subscriber.
+            heartbeat (float, optional): Seconds without event after which
+                None is yielded.
+
+        Yields:
+            (id, event) tuples, RESYNC when events were lost, or None.
+            The iteration ends when the subscriber was too slow.
+        """
+        self.start()
+        subscriber = None
+        try:
+            if after is None:
+                subscriber, backlog = self._join(self._sequence)
+            elif after in self._positions:
+                subscriber, backlog = self._join(self._positions[after])
+            else:
+                self.catch_ups += 1
+                started = self._sequence
+                seen = set()
+                try:
+                    async with aclosing(self._source(after)) as events:
+                        async for entry in events:
+                            if entry is None:
+                                # the newest event, the buffer has the
+                                # events published since the start
+                                subscriber, backlog = self._join(started,
+                                                                 seen)
+                                break
+                            position = self._positions.get(entry[0])
+                            if position is not None:
+                                subscriber, backlog = self._join(
+                                    position - 1)
+                                break
+                            seen.add(entry[0])
+                            yield entry
+                except ResumeError:
+                    self.resyncs += 1
+                    subscriber, backlog = self._join(self._sequence)
+                    backlog.insert(0, RESYNC)
+                if subscriber is None:
+                    # the source of the subscriber ended
+                    subscriber, backlog = self._join(started, seen)
+
+            for entry in backlog:
+                yield entry
+            while True:
+                while subscriber.events:
+                    yield subscriber.events.popleft()
+                if subscriber.dropped:
+                    return
+                subscriber.ready.clear()
+                try:
+                    await asyncio.wait_for(subscriber.ready.wait(),
+                                           heartbeat)
+                except asyncio.TimeoutError:
+                    yield None
+        finally:
+            self._subscribers.discard(subscriber)
+
+    def stats(self):
+        """
+        Counters of the events and the subscribers.
+        """
+        return {
+            'subscribers': len(self._subscribers),
+            'buffered': len(self._buffer),
+            'last_id': self._last_id,
+            'published': self.published,
+            'dropped': self.dropped,
+            'catch_ups': self.catch_ups,
+            'resyncs': self.resyncs,
+            'errors': self.errors,
+        }
+
+    def _join(self, position, skip=()):
+        # register a subscriber, with the buffered events after position;
+        # no event is published in between, nothing is missed
+        subscriber = _Subscriber()
+        self._subscribers.add(subscriber)
+        backlog = [(id_, event) for sequence, id_, event in self._buffer
+                   if sequence > position and id_ not in skip]
+        return subscriber, backlog
+
+    async def _run(self):
+        while True:
+            try:
+                async with aclosing(self._source(self._last_id)) as events:
+                    async for entry in events:
+                        if entry is not None:
+                            self._publish(*entry)
+            except ResumeError as err:
+                logger.warning("events after %s are lost: %s",
+                               self._last_id, err)
+                self._resync()
+                continue
+            except Exception as err:
+                self.errors += 1
+                logger.warning("reading the events failed: %s", err)
+            await asyncio.sleep(self.retry_delay)
+
+    def _publish(self, id_, event):
+        self._sequence += 1
+        if len(self._buffer) == self._buffer.maxlen:
+            del self._positions[self._buffer[0][1]]
+        self._buffer.append((self._sequence, id_, event))
+        self._positions[id_] = self._sequence
+        self._last_id = id_
+        self.published += 1
+        for subscriber in list(self._subscribers):
+            if len(subscriber.events) >= self.queue_size:
+                subscriber.dropped = True
+                self._subscribers.discard(subscriber)
+                self.dropped += 1
+            else:
+                subscriber.events.append((id_, event))
+            subscriber.ready.set()
+
+    def _resync(self):
+        # the buffer does not continue with the next events
+        self._buffer.clear()
+        self._positions.clear()
+        self._last_id = None
+        self.resyncs += 1
+        for subscriber in self._subscribers:
+            subscriber.events.append(RESYNC)
+            subscriber.ready.set()
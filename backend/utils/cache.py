@@ -0,0 +1,151 @@
+"""
+Response Cache
+
+Bounded in-process cache for serialized responses with TTL and LRU
+eviction. Entries are stamped with a generation number; bumping the
+generation (after any write to the data) invalidates all entries at once.
+
+The cache is thread-safe, one instance is shared by all threads of a
+gunicorn worker.
+"""
+
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+CacheEntry = namedtuple('CacheEntry', ['value', 'size', 'generation',
+                                       'expires'])
+
+
+class LocalGeneration:
+    """
+    Generation counter of a single process.
+    """
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    @property
+    def value(self):
+        return self._value
+
+    def bump(self):
+        """
+        Increment the generation.
+
+        Returns:
+            int: The new generation.
+        """
+        with self._lock:
+            self._value += 1
+            return self._value
+
+
+class ResponseCache:
+    """
+    Thread-safe TTL/LRU cache.
+
+    Args:
+        maxsize (int): Maximum number of entries.
+        max_bytes (int): Maximum total size of the cached values.
+        ttl (float): Time to live of an entry in seconds.
+        generation (LocalGeneration, optional): Generation counter,
+            a new LocalGeneration by default.
+    """
+
+    def __init__(self, maxsize, max_bytes, ttl, generation=None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.generation = generation or LocalGeneration()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """
+        Get a value if it is cached, not expired and not invalidated.
+
+        Args:
+            key (hashable): Cache key.
+
+        Returns:
+            The cached value or None.
+        """
+        generation = self.generation.value
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if (entry.generation != generation
+                    or entry.expires < time.monotonic()):
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.value
+
+    def set(self, key, value, size, generation):
+        """
+        Cache a value.
+
+        Args:
+            key (hashable): Cache key.
+            value: Value to cache.
+            size (int): Size of the value in bytes.
+            generation (int): Generation read before the value was
+                computed. If the generation changed meanwhile, the value
+                may be stale and is not cached.
+        """
+        if generation != self.generation.value or size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = CacheEntry(value, size, generation,
+                                            time.monotonic() + self.ttl)
+            self._bytes += size
+            while (len(self._entries) > self.maxsize
+                   or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self):
+        """
+        Invalidate all entries by bumping the generation.
+        """
+        self.generation.bump()
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.invalidations += 1
+
+    def stats(self):
+        """
+        Counters of the cache.
+
+        Returns:
+            dict: Number of entries, their size and hit, miss, eviction
+            and invalidation counters.
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'generation': self.generation.value,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
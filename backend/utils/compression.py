@@ -0,0 +1,123 @@
+"""
+Response Compression
+
+Helpers compressing response bodies with gzip, or with brotli when the
+brotli package is installed, and choosing the encoding from the
+Accept-Encoding header of a request. Whole bodies and streamed bodies
+(an iterable of chunks) are supported.
+
+Dependencies:
+- brotli is optional. Without it only gzip is offered.
+"""
+
+import zlib
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional dependency
+    brotli = None
+
+
+def available_encodings():
+    """
+    Content codings that can be produced, the preferred one first.
+    """
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+def negotiate_encoding(accept_encodings):
+    """
+    Choose the content coding of a response.
+
+    Args:
+        accept_encodings (werkzeug.datastructures.Accept): Parsed
+            Accept-Encoding header of the request.
+
+    Returns:
+        str: 'br' or 'gzip', the available encoding with the highest
+        quality (the preferred one on a tie), or None if the client
+        accepts neither.
+    """
+    best, best_quality = None, 0
+    for encoding in available_encodings():
+        quality = accept_encodings.quality(encoding)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+class _BrotliCompressor:
+    """
+    brotli.Compressor with the interface of a zlib compression object.
+    """
+
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self, mode=zlib.Z_FINISH):
+        if mode == zlib.Z_FINISH:
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+def compressor(encoding, level):
+    """
+    Create an incremental compressor.
+
+    Args:
+        encoding (str): 'gzip' or 'br'.
+        level (int): Compression level, 1-9 for gzip and 0-11 for brotli.
+
+    Returns:
+        object: Compressor with compress(data) and flush(mode) methods,
+        flush(zlib.Z_SYNC_FLUSH) returns everything compressed so far
+        without ending the body.
+    """
+    if encoding == 'br':
+        return _BrotliCompressor(level)
+    # wbits 31: deflate with a gzip header and trailer
+    return zlib.compressobj(level, zlib.DEFLATED, 31)
+
+
+def compress(data, encoding, level):
+    """
+    Compress a whole body.
+
+    Returns:
+        bytes: Compressed body.
+    """
+    body = compressor(encoding, level)
+    return body.compress(data) + body.flush()
+
+
+def compress_chunks(chunks, encoding, level):
+    """
+    Compress a streamed body chunk by chunk. Every chunk is flushed, so
+    the client can decompress it as soon as it arrives instead of when
+    the compressor's buffer is full.
+
+    Args:
+        chunks (iterable): Chunks (bytes or str) of the body. Its close()
+            method is called when the generator is closed.
+        encoding (str): 'gzip' or 'br'.
+        level (int): Compression level.
+
+    Yields:
+        bytes: Compressed chunks, empty chunks are skipped.
+    """
+    body = compressor(encoding, level)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = body.compress(chunk) + body.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield body.flush()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
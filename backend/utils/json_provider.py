@@ -0,0 +1,164 @@
+"""
+BSON-aware JSON Provider
+
+Flask JSON provider that serializes documents read from MongoDB in a
+single pass. ObjectId, datetime and Decimal128 values are encoded
+directly, so the documents do not have to be converted with
+bson.json_util before they are passed to jsonify.
+
+Usage:
+- Set the provider on the Flask application:
+    app.json = MongoJSONProvider(app)
+
+Responses created with jsonify are also available as MessagePack or CBOR
+('utils.serializers'), chosen from the Accept header of the request.
+
+Dependencies:
+- orjson is used as a faster backend when it is installed. Without it
+the provider falls back to the standard json module. Both backends
+produce the same output.
+"""
+
+import json
+from datetime import datetime, timezone
+from decimal import Decimal
+from bson import ObjectId
+from bson.decimal128 import Decimal128
+from flask import request, has_request_context
+from flask.json.provider import DefaultJSONProvider
+from utils.serializers import negotiate_format, JSON_MIMETYPE, SERIALIZERS
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+
+def format_datetime(value):
+    """
+    Format a datetime as ISO 8601. MongoDB returns naive datetimes in
+    UTC, they are formatted with the "Z" suffix.
+
+    Args:
+        value (datetime): Datetime to format.
+
+    Returns:
+        str: Formatted datetime, e.g. "2023-09-18T12:00:00Z".
+    """
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    text = value.isoformat()
+    return text[:-6] + 'Z' if text.endswith('+00:00') else text
+
+
+def mongo_default(value):
+    """
+    Convert a value that is not natively JSON serializable.
+
+    Args:
+        value: Value found in the serialized data.
+
+    Returns:
+        A JSON serializable representation of the value:
+        - ObjectId as its 24-character hex string,
+        - datetime as an ISO 8601 string,
+        - Decimal128 and Decimal as a string, so no precision is lost.
+        Other values are handled by Flask's default provider.
+
+    Raises:
+        TypeError: If the value can not be serialized.
+    """
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return format_datetime(value)
+    if isinstance(value, (Decimal128, Decimal)):
+        return str(value)
+    return DefaultJSONProvider.default(value)
+
+
+def dumps_bytes(obj, sort_keys=True, ensure_ascii=True):
+    """
+    Serialize data to compact UTF-8 encoded JSON without a Flask
+    application, e.g. for the async entry point ('async_app').
+
+    Args:
+        obj: Data to serialize.
+        sort_keys (bool): Sort the keys of objects.
+        ensure_ascii (bool): Escape non-ASCII characters, only used by
+            the standard json backend.
+
+    Returns:
+        bytes: JSON document.
+    """
+    if orjson is not None:
+        option = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=mongo_default, option=option)
+    return json.dumps(obj, default=mongo_default, sort_keys=sort_keys,
+                      ensure_ascii=ensure_ascii,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def negotiated_format():
+    """
+    Mimetype of the responses to the current request.
+
+    Returns:
+        str: 'application/json', 'application/msgpack' or
+        'application/cbor', JSON outside of a request.
+    """
+    if not has_request_context():
+        return JSON_MIMETYPE
+    return negotiate_format(request.accept_mimetypes)
+
+
+class MongoJSONProvider(DefaultJSONProvider):
+    """
+    JSON provider for responses containing MongoDB documents.
+
+    Uses orjson when it is installed and the standard json module
+    otherwise. Pretty-printed output (debug mode) always uses the
+    standard json module.
+
+    Responses are serialized to MessagePack or CBOR instead of JSON when
+    the request prefers them (see negotiated_format), and get a
+    'Vary: Accept' header.
+    """
+
+    default = staticmethod(mongo_default)
+
+    def dumps(self, obj, **kwargs):
+        if orjson is not None and kwargs.get('indent') is None:
+            return self.dumps_bytes(obj).decode('utf-8')
+        return super().dumps(obj, **kwargs)
+
+    def dumps_bytes(self, obj):
+        """
+        Serialize data to UTF-8 encoded JSON.
+
+        Args:
+            obj: Data to serialize.
+
+        Returns:
+            bytes: JSON document.
+        """
+        return dumps_bytes(obj, sort_keys=self.sort_keys,
+                           ensure_ascii=self.ensure_ascii)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        mimetype = negotiated_format()
+        if mimetype != JSON_MIMETYPE:
+            response = self._app.response_class(SERIALIZERS[mimetype](obj),
+                                                mimetype=mimetype)
+        elif ((self.compact is None and self._app.debug)
+                or self.compact is False):
+            response = super().response(obj)
+        else:
+            body = self.dumps_bytes(obj) + b'\n'
+            response = self._app.response_class(body, mimetype=self.mimetype)
+        if has_request_context():
+            response.vary.add('Accept')
+        return response
@@ -0,0 +1,225 @@
+"""
+Prometheus Metrics
+
+Metrics of the service in the Prometheus text format:
+
+- http_request_duration_seconds: latency per route, method and status,
+- http_requests_in_progress: requests being served per route,
+- http_response_size_bytes: size of the response bodies sent per route,
+- http_admission_wait_seconds and http_requests_shed_total: time the
+  requests of the limited routes waited for a slot and requests rejected
+  by admission control ('utils.admission') per route and reason,
+- mongodb_command_duration_seconds: duration of the MongoDB commands per
+  command, collection and outcome, measured by a pymongo CommandListener,
+- mongodb_pool_checkout_seconds and mongodb_pool_checkout_failures_total:
+  time spent waiting for a connection of the pool of the MongoClient.
+
+The HTTP metrics are recorded by 'app.metrics' and 'app.admission', the
+MongoDB listeners are registered on the client in 'models.models'.
+
+With gunicorn every worker process has its own metrics. When the
+environment variable PROMETHEUS_MULTIPROC_DIR is set (gunicorn_config.py
+sets it) the workers write their metrics to files in that directory and
+render() aggregates the files of all workers, so /metrics returns the
+same totals whichever worker answers.
+
+Configuration (see 'config.config'):
+- METRICS_ENABLED.
+
+Dependencies:
+- prometheus_client is optional. Without it no metrics are recorded and
+/metrics is not available.
+"""
+
+import os
+import threading
+import time
+from pymongo import monitoring
+from config.config import METRICS_ENABLED
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:  # pragma: no cover - optional dependency
+    prometheus_client = None
+
+ENABLED = METRICS_ENABLED and prometheus_client is not None
+
+# Mongo commands take from well below a millisecond to seconds
+COMMAND_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304,
+                16777216)
+
+if ENABLED:
+    REQUEST_DURATION = prometheus_client.Histogram(
+        'http_request_duration_seconds',
+        'Time spent serving HTTP requests.',
+        ['method', 'route', 'status'])
+    REQUESTS_IN_PROGRESS = prometheus_client.Gauge(
+        'http_requests_in_progress',
+        'HTTP requests being served.',
+        ['method', 'route'],
+        multiprocess_mode='livesum')
+    RESPONSE_SIZE = prometheus_client.Histogram(
+        'http_response_size_bytes',
+        'Size of the HTTP response bodies.',
+        ['method', 'route'],
+        buckets=SIZE_BUCKETS)
+    ADMISSION_WAIT = prometheus_client.Histogram(
+        'http_admission_wait_seconds',
+        'Time requests of limited routes waited for a slot.',
+        ['route'],
+        buckets=COMMAND_BUCKETS)
+    REQUESTS_SHED = prometheus_client.Counter(
+        'http_requests_shed',
+        'Requests rejected by admission control.',
+        ['route', 'reason'])
+    COMMAND_DURATION = prometheus_client.Histogram(
+        'mongodb_command_duration_seconds',
+        'Duration of MongoDB commands.',
+        ['command', 'collection', 'outcome'],
+        buckets=COMMAND_BUCKETS)
+    POOL_CHECKOUT = prometheus_client.Histogram(
+        'mongodb_pool_checkout_seconds',
+        'Time spent waiting for a connection of the MongoDB pool.',
+        buckets=COMMAND_BUCKETS)
+    POOL_CHECKOUT_FAILURES = prometheus_client.Counter(
+        'mongodb_pool_checkout_failures',
+        'Failed checkouts of a connection of the MongoDB pool.',
+        ['reason'])
+
+
+def command_collection(command_name, command):
+    """
+    Name of the collection a command runs on.
+
+    Args:
+        command_name (str): Name of the command, e.g. 'find'.
+        command (dict): The command document.
+
+    Returns:
+        str: The collection, '' for commands on the database or the
+        server (e.g. 'hello' or 'aggregate' with the value 1).
+    """
+    collection = command.get(command_name)
+    if isinstance(collection, str):
+        return collection
+    # getMore names the collection in a separate field
+    collection = command.get('collection')
+    return collection if isinstance(collection, str) else ''
+
+
+class CommandTimer(monitoring.CommandListener):
+    """
+    Records the duration of every command sent by a MongoClient.
+
+    The succeeded and failed events do not include the command, so the
+    collection is remembered from the started event by request and
+    connection id.
+    """
+
+    def __init__(self):
+        self._collections = {}
+
+    def started(self, event):
+        self._collections[(event.request_id, event.connection_id)] = (
+            command_collection(event.command_name, event.command))
+
+    def succeeded(self, event):
+        self._observe(event, 'succeeded')
+
+    def failed(self, event):
+        self._observe(event, 'failed')
+
+    def _observe(self, event, outcome):
+        collection = self._collections.pop(
+            (event.request_id, event.connection_id), '')
+        COMMAND_DURATION.labels(event.command_name, collection,
+                                outcome).observe(
+            event.duration_micros / 1e6)
+
+
+class PoolCheckoutTimer(monitoring.ConnectionPoolListener):
+    """
+    Records how long threads wait to check out a connection of the pool.
+
+    A checkout starts and ends in the same thread, so the start time is
+    kept in a thread local. Only the checkout events are of interest,
+    the other pool events are ignored.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        self._observe()
+
+    def connection_check_out_failed(self, event):
+        self._observe()
+        POOL_CHECKOUT_FAILURES.labels(str(event.reason)).inc()
+
+    def _observe(self):
+        started = getattr(self._local, 'started', None)
+        if started is not None:
+            POOL_CHECKOUT.observe(time.perf_counter() - started)
+            self._local.started = None
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+    def connection_checked_in(self, event):
+        pass
+
+
+def event_listeners():
+    """
+    pymongo event listeners recording the MongoDB metrics.
+
+    Returns:
+        list: Listeners for the event_listeners argument of MongoClient,
+        empty when metrics are disabled.
+    """
+    if not ENABLED:
+        return []
+    return [CommandTimer(), PoolCheckoutTimer()]
+
+
+def render():
+    """
+    Render the metrics of the service, aggregated over all worker
+    processes in multiprocess mode.
+
+    Returns:
+        tuple: (bytes, str), the metrics in the Prometheus text format
+        and their content type.
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return (prometheus_client.generate_latest(registry),
+            prometheus_client.CONTENT_TYPE_LATEST)
+
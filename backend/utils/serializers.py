@@ -0,0 +1,159 @@
+"""
+Binary Response Formats
+
+Serializers for MessagePack and CBOR responses, the binary counterparts
+of the JSON conversion in 'utils.json_provider' (used by jsonify) and
+'utils.utils.sanitize_json'. MongoDB types are encoded natively instead
+of as strings:
+
+- MessagePack: datetime as the Timestamp extension type (-1), ObjectId as
+the extension type OBJECTID_EXT_TYPE with the 12 bytes of the id,
+- CBOR: datetime as an epoch timestamp (tag 1), ObjectId as the 12 bytes
+of the id with the tag OBJECTID_CBOR_TAG, Decimal128 as a decimal
+fraction (tag 4).
+
+Naive datetimes read from MongoDB are UTC. Decimal128 values are sent as
+strings in MessagePack, like in JSON.
+
+The format of a response is negotiated from the Accept header
+(negotiate_format), JSON stays the default.
+
+Dependencies:
+- msgpack and cbor2 are optional. A format whose package is not
+installed is not offered.
+"""
+
+from datetime import datetime, timezone
+from decimal import Decimal
+from bson import ObjectId
+from bson.decimal128 import Decimal128
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - optional dependency
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:  # pragma: no cover - optional dependency
+    cbor2 = None
+
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPE = 'application/msgpack'
+CBOR_MIMETYPE = 'application/cbor'
+
+# application specific type numbers of ObjectId
+OBJECTID_EXT_TYPE = 1
+OBJECTID_CBOR_TAG = 27017
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def available_formats():
+    """
+    Mimetypes of the formats that can be produced, JSON first.
+    """
+    formats = [JSON_MIMETYPE]
+    if msgpack is not None:
+        formats.append(MSGPACK_MIMETYPE)
+    if cbor2 is not None:
+        formats.append(CBOR_MIMETYPE)
+    return formats
+
+
+def negotiate_format(accept_mimetypes):
+    """
+    Choose the format of a response.
+
+    Args:
+        accept_mimetypes (werkzeug.datastructures.MIMEAccept): Parsed
+            Accept header of the request.
+
+    Returns:
+        str: Mimetype of the best available format, JSON if the request
+        has no Accept header or accepts none of them. 'x-msgpack' is
+        accepted as an alias of 'msgpack'.
+    """
+    formats = available_formats()
+    if msgpack is not None:
+        formats.append('application/x-msgpack')
+    best = accept_mimetypes.best_match(formats, default=JSON_MIMETYPE)
+    return MSGPACK_MIMETYPE if best == 'application/x-msgpack' else best
+
+
+def msgpack_default(value):
+    """
+    Convert a value MessagePack can not serialize natively.
+    """
+    if isinstance(value, ObjectId):
+        return msgpack.ExtType(OBJECTID_EXT_TYPE, value.binary)
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        # exact, Timestamp.from_datetime rounds through a float
+        delta = value - EPOCH
+        return msgpack.Timestamp(delta.days * 86400 + delta.seconds,
+                                 delta.microseconds * 1000)
+    if isinstance(value, (Decimal128, Decimal)):
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} "
+                    f"is not MessagePack serializable")
+
+
+def msgpack_ext_hook(code, data):
+    """
+    ext_hook for msgpack.unpackb decoding ObjectIds of responses.
+    """
+    if code == OBJECTID_EXT_TYPE:
+        return ObjectId(data)
+    return msgpack.ExtType(code, data)
+
+
+def dumps_msgpack(obj):
+    """
+    Serialize data to MessagePack.
+
+    Returns:
+        bytes: MessagePack document.
+    """
+    return msgpack.packb(obj, default=msgpack_default, use_bin_type=True)
+
+
+def cbor_default(encoder, value):
+    """
+    Encode a value CBOR can not serialize natively.
+    """
+    if isinstance(value, ObjectId):
+        encoder.encode(cbor2.CBORTag(OBJECTID_CBOR_TAG, value.binary))
+    elif isinstance(value, Decimal128):
+        encoder.encode(value.to_decimal())
+    else:
+        raise cbor2.CBOREncodeTypeError(
+            f"Object of type {type(value).__name__} "
+            f"is not CBOR serializable")
+
+
+def cbor_tag_hook(decoder, tag):
+    """
+    tag_hook for cbor2.loads decoding ObjectIds of responses.
+    """
+    if tag.tag == OBJECTID_CBOR_TAG:
+        return ObjectId(tag.value)
+    return tag
+
+
+def dumps_cbor(obj):
+    """
+    Serialize data to CBOR.
+
+    Returns:
+        bytes: CBOR document.
+    """
+    return cbor2.dumps(obj, default=cbor_default, timezone=timezone.utc,
+                       datetime_as_timestamp=True)
+
+
+SERIALIZERS = {
+    MSGPACK_MIMETYPE: dumps_msgpack,
+    CBOR_MIMETYPE: dumps_cbor,
+}
@@ -0,0 +1,293 @@
+"""
+Shared Response Cache
+
+Cache of serialized responses shared by all worker processes of a host.
+It lives in a memory-mapped file (in /dev/shm by default), so a response
+computed by one gunicorn worker is served by all of them, and the cache
+survives worker restarts.
+
+File layout:
+- header page: magic, number of slots, slot size and the generation,
+- slots of a fixed size: key digest, generation, expiration time, value
+length and the value.
+
+A key is stored in the slot selected by its digest (a direct-mapped
+table), a new value replaces whatever the slot held. Entries are valid
+only while the generation in the header equals the generation they were
+stored with, so bumping the generation from any process invalidates the
+cache of all processes. Access is serialized with flock between
+processes and with a lock between the threads of a process.
+
+The number of slots and the slot size are part of the file name, so
+processes configured differently use different files and a file mapped
+by other processes is never resized. The pages of a new file are
+allocated when it is created: a tmpfs that is too small (e.g. the 64 MB
+/dev/shm of a Docker container) fails there with an OSError, not with
+SIGBUS on a later access. The generation of a new file starts at the
+current time in milliseconds, so it never goes back when the file is
+recreated.
+"""
+
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+MAGIC = b'IMGCACH1'
+HEADER = struct.Struct('<8sIQQ')  # magic, slots, slot size, generation
+HEADER_SIZE = mmap.PAGESIZE
+GENERATION_OFFSET = 8 + 4 + 8
+GENERATION = struct.Struct('<Q')
+SLOT_HEADER = struct.Struct('<16sQdQ')  # digest, generation, expires, length
+
+logger = logging.getLogger(__name__)
+
+
+class SharedMemoryFile:
+    """
+    Memory-mapped cache file, opened lazily in every process.
+
+    Args:
+        path (str): Path of the file, the geometry is appended, e.g.
+            '/dev/shm/cache-32x1048576'. Created if it does not exist.
+        slots (int): Number of slots.
+        slot_size (int): Size of a slot in bytes, header included.
+    """
+
+    def __init__(self, path, slots, slot_size):
+        self.path = f'{path}-{slots}x{slot_size}'
+        self.slots = slots
+        self.slot_size = slot_size
+        self.size = HEADER_SIZE + slots * slot_size
+        self._pid = None
+        self._fd = None
+        self._map = None
+        self._lock = threading.RLock()
+
+    def _open(self):
+        # a mapping inherited from the parent process is not reused,
+        # every process opens its own
+        if self._pid == os.getpid():
+            return
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                header = os.pread(fd, HEADER.size, 0)
+                if len(header) < HEADER.size or header[:8] != MAGIC:
+                    # new file, no other process maps it yet
+                    allocate(fd, self.size)
+                    os.pwrite(fd, HEADER.pack(MAGIC, self.slots,
+                                              self.slot_size,
+                                              time.time_ns() // 1000000),
+                              0)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            self._map = mmap.mmap(fd, self.size)
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd = fd
+        self._pid = os.getpid()
+
+    def open(self):
+        """
+        Open and map the file in this process.
+
+        Raises:
+            OSError: If the file can not be created, e.g. because the
+                file system is full.
+        """
+        with self._lock:
+            self._open()
+
+    def locked(self, exclusive):
+        """
+        Context manager locking the file for this thread and process.
+        """
+        return _FileLock(self, exclusive)
+
+    @property
+    def map(self):
+        return self._map
+
+
+def open_shared_file(path, slots, slot_size):
+    """
+    Open the shared cache file at the start of a process, so a failure
+    shows now rather than in every request.
+
+    Args:
+        path, slots, slot_size: See SharedMemoryFile.
+
+    Returns:
+        SharedMemoryFile: The opened file, or None if it can not be
+        created (e.g. /dev/shm is smaller than the cache), which is
+        logged.
+    """
+    shared_file = SharedMemoryFile(path, slots, slot_size)
+    try:
+        shared_file.open()
+    except OSError as err:
+        logger.warning("shared response cache %s disabled: %s",
+                       shared_file.path, err)
+        return None
+    return shared_file
+
+
+def allocate(fd, size):
+    """
+    Allocate the pages of a file up to size bytes.
+    """
+    if hasattr(os, 'posix_fallocate'):
+        os.posix_fallocate(fd, 0, size)
+    else:  # macOS, the file is sparse
+        os.ftruncate(fd, size)
+
+
+class _FileLock:
+
+    def __init__(self, shared_file, exclusive):
+        self.file = shared_file
+        self.operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+
+    def __enter__(self):
+        self.file._lock.acquire()
+        try:
+            self.file._open()
+            fcntl.flock(self.file._fd, self.operation)
+        except BaseException:
+            self.file._lock.release()
+            raise
+        return self.file.map
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self.file._fd, fcntl.LOCK_UN)
+        self.file._lock.release()
+
+
+class SharedGeneration:
+    """
+    Generation counter stored in the header of the shared cache file,
+    the cross-process counterpart of 'utils.cache.LocalGeneration'.
+    """
+
+    def __init__(self, shared_file):
+        self.file = shared_file
+
+    @property
+    def value(self):
+        with self.file.locked(exclusive=False) as shared_map:
+            return GENERATION.unpack_from(shared_map, GENERATION_OFFSET)[0]
+
+    def bump(self):
+        """
+        Increment the generation for all processes.
+
+        Returns:
+            int: The new generation.
+        """
+        with self.file.locked(exclusive=True) as shared_map:
+            value = GENERATION.unpack_from(shared_map, GENERATION_OFFSET)[0]
+            GENERATION.pack_into(shared_map, GENERATION_OFFSET, value + 1)
+            return value + 1
+
+
+class SharedResponseCache:
+    """
+    Cache of byte strings shared by the processes using the same file.
+
+    Args:
+        shared_file (SharedMemoryFile): Cache file.
+        ttl (float): Time to live of an entry in seconds.
+    """
+
+    def __init__(self, shared_file, ttl):
+        self.file = shared_file
+        self.ttl = ttl
+        self.generation = SharedGeneration(shared_file)
+        self.max_value_size = shared_file.slot_size - SLOT_HEADER.size
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.replacements = 0
+
+    def _slot(self, key):
+        digest = hashlib.blake2b(repr(key).encode('utf-8'),
+                                 digest_size=16).digest()
+        index = int.from_bytes(digest[:8], 'little') % self.file.slots
+        return digest, HEADER_SIZE + index * self.file.slot_size
+
+    def get(self, key):
+        """
+        Get a value if it is cached, not expired and not invalidated.
+
+        Args:
+            key (hashable): Cache key with a stable repr().
+
+        Returns:
+            bytes: The cached value or None.
+        """
+        digest, offset = self._slot(key)
+        with self.file.locked(exclusive=False) as shared_map:
+            generation = GENERATION.unpack_from(shared_map,
+                                                GENERATION_OFFSET)[0]
+            (slot_digest, slot_generation,
+             expires, length) = SLOT_HEADER.unpack_from(shared_map, offset)
+            value = None
+            if (slot_digest == digest and slot_generation == generation
+                    and expires >= time.time()):
+                start = offset + SLOT_HEADER.size
+                value = shared_map[start:start + length]
+        self._count('hits' if value is not None else 'misses')
+        return value
+
+    def set(self, key, value, generation):
+        """
+        Cache a value.
+
+        Args:
+            key (hashable): Cache key with a stable repr().
+            value (bytes): Value to cache.
+            generation (int): Generation read before the value was
+                computed. If the generation changed meanwhile, the value
+                is not cached.
+        """
+        if len(value) > self.max_value_size:
+            return
+        digest, offset = self._slot(key)
+        with self.file.locked(exclusive=True) as shared_map:
+            current = GENERATION.unpack_from(shared_map, GENERATION_OFFSET)[0]
+            if generation != current:
+                return
+            slot_digest = SLOT_HEADER.unpack_from(shared_map, offset)[0]
+            start = offset + SLOT_HEADER.size
+            shared_map[start:start + len(value)] = value
+            SLOT_HEADER.pack_into(shared_map, offset, digest, generation,
+                                  time.time() + self.ttl, len(value))
+        self._count('stores')
+        if slot_digest not in (digest, b'\0' * 16):
+            self._count('replacements')
+
+    def stats(self):
+        """
+        Counters of this process and the current generation.
+        """
+        with self._stats_lock:
+            stats = {
+                'hits': self.hits,
+                'misses': self.misses,
+                'stores': self.stores,
+                'replacements': self.replacements,
+            }
+        stats['generation'] = self.generation.value
+        return stats
+
+    def _count(self, name):
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
@@ -0,0 +1,108 @@
+"""
+Single-Flight Calls
+
+Runs a function once for concurrent calls with the same key: the first
+call (the leader) runs it, calls with the same key arriving while it
+runs (the followers) wait for it and get its result, or its exception.
+Nothing is kept after the leader returns, the next call runs the
+function again; unlike a cache a result is never older than the call
+that gets it.
+
+A follower waits at most 'timeout' seconds and then runs the function
+itself.
+"""
+
+import threading
+from contextlib import nullcontext
+
+
+class _Flight:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Deduplicates concurrent calls by key.
+
+    Args:
+        timeout (float): Seconds a follower waits for the leader.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.leaders = 0
+        self.followers = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    def do(self, key, function, waiting=None):
+        """
+        Call function, or wait for the call with the same key in flight.
+
+        Args:
+            key (hashable): Key of the call.
+            function (callable): Called without arguments.
+            waiting (contextmanager, optional): Entered by a follower while
+                it waits, e.g. to account for its thread. An exception it
+                raises is raised in the follower.
+
+        Returns:
+            tuple: (result, shared), shared is True if the result is the
+            one of another call.
+
+        Raises:
+            Exception: The exception raised by the function, in the
+                leader and in all its followers.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.leaders += 1
+            else:
+                self.followers += 1
+
+        if leader:
+            try:
+                flight.result = function()
+            except Exception as err:
+                flight.error = err
+                with self._lock:
+                    self.errors += 1
+                raise
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight.done.set()
+            return flight.result, False
+
+        with waiting if waiting is not None else nullcontext():
+            done = flight.done.wait(self.timeout)
+        if not done:
+            with self._lock:
+                self.timeouts += 1
+            return function(), False
+        if flight.error is not None:
+            raise flight.error
+        return flight.result, True
+
+    def stats(self):
+        """
+        Counters of the calls and the number of calls in flight.
+        """
+        with self._lock:
+            return {
+                'timeout': self.timeout,
+                'in_flight': len(self._flights),
+                'leaders': self.leaders,
+                'followers': self.followers,
+                'timeouts': self.timeouts,
+                'errors': self.errors,
+            }
@@ -1,5 +1,8 @@
-from bson import json_util
-import json
+from bson import BSON
+from bson.errors import BSONError
+from utils.json_provider import mongo_default
+import base64
+import binascii
 
 
 def sanitize_json(mongo_db_data):
@@ -10,6 +13,10 @@ def sanitize_json(mongo_db_data):
     It ensures that special MongoDB data types, such as ObjectId and datetime,
     are properly converted to JSON.
 
+    Responses do not need it: the application's JSON provider
+    (utils.json_provider.MongoJSONProvider) encodes these types directly.
+    Use it when plain JSON-compatible data is needed outside of a response.
+
     Args:
         mongo_db_data (dict): MongoDB data to be sanitized.
 
@@ -32,5 +39,53 @@ def sanitize_json(mongo_db_data):
         }
     """
 
-    json_sanitized = json.loads(json_util.dumps(mongo_db_data))
-    return json_sanitized
+    if isinstance(mongo_db_data, dict):
+        return {key: sanitize_json(value)
+                for key, value in mongo_db_data.items()}
+    if isinstance(mongo_db_data, (list, tuple)):
+        return [sanitize_json(value) for value in mongo_db_data]
+    if mongo_db_data is None or isinstance(mongo_db_data,
+                                           (str, int, float, bool)):
+        return mongo_db_data
+    return mongo_default(mongo_db_data)
+
+
+def encode_cursor(*values):
+    """
+    Pack values into an opaque, URL-safe pagination cursor.
+
+    Values are stored as BSON, so ObjectId and datetime survive the
+    round-trip with their original types.
+
+    Args:
+        *values: Values describing the position of the last returned
+            item, e.g. its ObjectId or (created_at, ObjectId).
+
+    Returns:
+        str: Cursor to be handed to the client.
+    """
+    raw = BSON.encode({'k': list(values)})
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Unpack a cursor created by encode_cursor.
+
+    Args:
+        cursor (str): Cursor received from the client.
+
+    Returns:
+        list: The values passed to encode_cursor.
+
+    Raises:
+        ValueError: If the cursor is not a valid cursor.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = BSON(raw).decode()['k']
+    except (binascii.Error, BSONError, KeyError, TypeError) as err:
+        raise ValueError(f"Invalid cursor: {err}")
+    if not isinstance(values, list):
+        raise ValueError("Invalid cursor: no values stored")
+    return values
@@ -0,0 +1,313 @@
+"""
+Request Argument Validation
+
+Helpers that parse and validate request arguments shared by the views.
+Every helper raises ValidationError on bad input. ValidationError is a
+werkzeug BadRequest, so it is rendered by the application's HTTPException
+handler in the usual JSON error format:
+
+    {
+        "code": 400,
+        "name": "<short error name>",
+        "description": "<error description>"
+    }
+"""
+
+from datetime import datetime, timedelta
+from bson import ObjectId
+from bson.errors import InvalidId
+from markupsafe import escape
+from werkzeug.exceptions import BadRequest
+from config.config import VALID_STATUSES
+from utils.utils import decode_cursor
+
+
+class ValidationError(BadRequest):
+    """
+    400 Bad Request with a custom error name.
+
+    Args:
+        name (str): Short error name returned in the "name" field.
+        description (str): Error description returned in the
+            "description" field.
+    """
+
+    def __init__(self, name, description):
+        super().__init__(description)
+        self._name = name
+
+    @property
+    def name(self):
+        return self._name
+
+
+def parse_object_id(value):
+    """
+    Convert a string into an ObjectId.
+
+    Args:
+        value (str): 24-character hex string.
+
+    Returns:
+        ObjectId: The parsed identifier.
+
+    Raises:
+        ValidationError: If the value is not a valid ObjectId.
+    """
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError) as err:
+        raise ValidationError("Invalid ObjectId", str(err))
+
+
+def parse_status(value, required=False):
+    """
+    Validate an image status.
+
+    Args:
+        value (str): Status received from the client, may be None.
+        required (bool): Whether a missing status is an error.
+
+    Returns:
+        str: The status, or None if it was not provided and not required.
+
+    Raises:
+        ValidationError: If the status is not one of VALID_STATUSES.
+    """
+    if not value and not required:
+        return None
+    if not isinstance(value, str) or escape(value) not in VALID_STATUSES:
+        raise ValidationError("Invalid status",
+                              f"Valid statuses are - {VALID_STATUSES}")
+    return value
+
+
+def parse_limit(value, default, maximum):
+    """
+    Validate a page size argument.
+
+    Args:
+        value (str): Value of the query argument, may be None.
+        default (int): Page size used when the argument is missing.
+        maximum (int): Largest page size a client may request.
+
+    Returns:
+        int: Page size between 1 and maximum.
+
+    Raises:
+        ValidationError: If the value is not an integer in range.
+    """
+    if value is None:
+        return default
+    try:
+        limit = int(value)
+    except ValueError:
+        limit = 0
+    if not 1 <= limit <= maximum:
+        raise ValidationError("Invalid limit",
+                              f"limit must be a number from 1 to {maximum}")
+    return limit
+
+
+def parse_cursor(value, size):
+    """
+    Decode a pagination cursor received from the client.
+
+    Args:
+        value (str): Opaque cursor, may be None.
+        size (int): Number of values the cursor must contain.
+
+    Returns:
+        list: The values stored in the cursor, or None if no cursor
+        was provided.
+
+    Raises:
+        ValidationError: If the cursor can not be decoded.
+    """
+    if not value:
+        return None
+    try:
+        values = decode_cursor(value)
+    except ValueError:
+        values = None
+    if not values or len(values) != size:
+        raise ValidationError("Invalid cursor",
+                              "Cursor is malformed or expired")
+    return values
+
+
+def parse_fields(value, fields, profiles, default):
+    """
+    Validate the list of fields requested by the client.
+
+    Args:
+        value (str): Name of a profile or comma separated field names,
+            may be None.
+        fields (list): Fields a client may request.
+        profiles (dict): {profile name: list of fields}, None instead of
+            a list selects all fields.
+        default (str): Profile used when the argument is missing.
+
+    Returns:
+        list: Requested fields, '_id' is always the first one, or None
+        if all fields were requested.
+
+    Raises:
+        ValidationError: If the value is neither a profile nor a list
+            of known fields.
+    """
+    if not value:
+        value = default
+    if value in profiles:
+        selected = profiles[value]
+    else:
+        selected = [name.strip() for name in value.split(',')
+                    if name.strip()]
+        if not selected or not set(selected) <= set(fields):
+            raise ValidationError(
+                "Invalid fields",
+                f"Valid fields are - {fields} or one of the profiles "
+                f"{list(profiles)}")
+    if selected is None:
+        return None
+    return ['_id'] + [name for name in dict.fromkeys(selected)
+                      if name != '_id']
+
+
+def parse_flag(value, default=False):
+    """
+    Validate a boolean query argument.
+
+    Args:
+        value (str): Value of the query argument, may be None.
+        default (bool): Value used when the argument is missing.
+
+    Returns:
+        bool: True for "1", "true" and "yes", False for "0", "false"
+        and "no" (case insensitive).
+
+    Raises:
+        ValidationError: If the value is not a boolean.
+    """
+    if value is None:
+        return default
+    if value.lower() in ('1', 'true', 'yes'):
+        return True
+    if value.lower() in ('0', 'false', 'no'):
+        return False
+    raise ValidationError("Invalid flag",
+                          "flag must be one of true, false, 1, 0, yes, no")
+
+
+def parse_days(value, maximum):
+    """
+    Validate a number of days.
+
+    Args:
+        value (str): Value of the query argument, may be None.
+        maximum (int): Largest number of days a client may request.
+
+    Returns:
+        int: Number of days between 1 and maximum, or None if the
+        argument is missing.
+
+    Raises:
+        ValidationError: If the value is not an integer in range.
+    """
+    if value is None:
+        return None
+    try:
+        days = int(value)
+    except ValueError:
+        days = 0
+    if not 1 <= days <= maximum:
+        raise ValidationError("Invalid days",
+                              f"days must be a number from 1 to {maximum}")
+    return days
+
+
+def parse_date(value):
+    """
+    Validate a date in YYYY-MM-DD format.
+
+    Args:
+        value (str): Value of the query argument, may be None.
+
+    Returns:
+        datetime: Midnight of the date, or None if the argument
+        is missing.
+
+    Raises:
+        ValidationError: If the value is not a date.
+    """
+    if value is None:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise ValidationError("Invalid date",
+                              "dates must be in YYYY-MM-DD format")
+
+
+def parse_choice(value, choices, default, name):
+    """
+    Validate an argument that takes one of a few values.
+
+    Args:
+        value (str): Value of the query argument, may be None.
+        choices (list): Allowed values.
+        default (str): Value used when the argument is missing.
+        name (str): Name of the argument used in the error.
+
+    Returns:
+        str: One of the choices.
+
+    Raises:
+        ValidationError: If the value is not one of the choices.
+    """
+    if value is None:
+        return default
+    if value not in choices:
+        raise ValidationError(f"Invalid {name}",
+                              f"Valid values of {name} are - {choices}")
+    return value
+
+
+def parse_period(days, first_day, last_day, default_days, maximum):
+    """
+    Validate the period of the statistics, given either as a number of
+    days up to today or as a range of dates.
+
+    Args:
+        days (str): Value of the 'days' argument, may be None.
+        first_day (str): Value of the 'from' argument, may be None.
+        last_day (str): Value of the 'to' argument, may be None.
+        default_days (int): Number of days used when neither 'days' nor
+            'from' is given.
+        maximum (int): Longest period in days.
+
+    Returns:
+        tuple: (start, end) - midnight (UTC) of the first day of the
+        period and of the day after its last day. The last day is
+        today by default.
+
+    Raises:
+        ValidationError: If an argument is invalid, 'days' is combined
+            with dates or the period is empty or too long.
+    """
+    days = parse_days(days, maximum)
+    first_day = parse_date(first_day)
+    last_day = parse_date(last_day)
+    if days and (first_day or last_day):
+        raise ValidationError("Invalid period",
+                              "use either days or from and to")
+
+    now = datetime.utcnow()
+    today = datetime(now.year, now.month, now.day)
+    end = (last_day or today) + timedelta(days=1)
+    start = first_day or end - timedelta(days=days or default_days)
+    if not timedelta(days=1) <= end - start <= timedelta(days=maximum):
+        raise ValidationError(
+            "Invalid period",
+            f"period must be from 1 to {maximum} days")
+    return start, end
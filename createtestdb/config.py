@@ -14,5 +14,11 @@ MONGODB_IMAGE_COLLECTION_NAME = os.environ.get('MONGODB_IMAGE_COLLECTION_NAME')
 MONGODB_GROUPS_COLLECTION_NAME = os.environ.get(
                                             'MONGODB_GROUPS_COLLECTION_NAME'
                                             )
+MONGODB_COUNTERS_COLLECTION_NAME = os.environ.get(
+                                        'MONGODB_COUNTERS_COLLECTION_NAME',
+                                        'counters')
+MONGODB_DAILY_STATISTICS_COLLECTION_NAME = os.environ.get(
+                                'MONGODB_DAILY_STATISTICS_COLLECTION_NAME',
+                                'daily_statistics')
 
 IMAGE_FOLDER_NAME = os.environ.get('IMAGE_FOLDER_NAME')
@@ -12,6 +12,8 @@ from config import (AWS_SERVICE_NAME,
                     MONGODB_DB_NAME,
                     MONGODB_IMAGE_COLLECTION_NAME,
                     MONGODB_GROUPS_COLLECTION_NAME,
+                    MONGODB_COUNTERS_COLLECTION_NAME,
+                    MONGODB_DAILY_STATISTICS_COLLECTION_NAME,
                     IMAGE_FOLDER_NAME
                     )
 
@@ -29,11 +31,21 @@ client = MongoClient(MONGODB_URI)
 db = client[MONGODB_DB_NAME]
 images_collection = db[MONGODB_IMAGE_COLLECTION_NAME]
 groups_collection = db[MONGODB_GROUPS_COLLECTION_NAME]
+counters_collection = db[MONGODB_COUNTERS_COLLECTION_NAME]
+daily_statistics_collection = db[MONGODB_DAILY_STATISTICS_COLLECTION_NAME]
 
 
-# clean database
+# clean database, the data version of the service keeps counting so
+# ETags of the old data never match the new data
 images_collection.delete_many({})
 groups_collection.delete_many({})
+counters_collection.delete_many({'_id': {'$ne': 'data_version'}})
+counters_collection.update_one({'_id': 'data_version'},
+                               {'$inc': {'version': 1}},
+                               upsert=True)
+# the images are created today, the days are counted live by the
+# service until they are rolled up with 'flask --app run rebuild-statistics'
+daily_statistics_collection.delete_many({})
 
 # create images and database entry
 statuses = ["new", "review", "accepted", "deleted"]
@@ -113,5 +125,15 @@ for group_numer in range(n):
             'group_id': group_id
         }
         images_collection.insert_one(image)
+        # keep image counters and the data version of the service in sync
+        for counter_id in (group_id, 'global'):
+            counters_collection.update_one(
+                {'_id': counter_id},
+                {'$inc': {f"counts.{image['status']}": 1}},
+                upsert=True,
+                )
+        counters_collection.update_one({'_id': 'data_version'},
+                                       {'$inc': {'version': 1}},
+                                       upsert=True)
 
 print("Test database was created")
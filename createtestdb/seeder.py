@@ -0,0 +1,445 @@
+"""
+High-volume Test Data Seeder
+
+Fills the database with N groups of M images each, for load tests and
+for development with realistic data volumes. Unlike imagecreator.py,
+which renders, uploads and inserts one image at a time, the seeder:
+
+- inserts groups and images with batched, unordered insert_many calls
+  from several writer threads,
+- renders the PNG images (optionally) in a process pool and stores them
+  through a thread pool in a pluggable storage backend: an S3 bucket,
+  a local directory, or nowhere ('metadata', only the documents with the
+  URL the image would have in the bucket are written),
+- updates the image counters once per group and batch instead of once
+  per image, right after the batch was inserted; the daily statistics
+  are not updated, run 'flask --app run rebuild-statistics' afterwards,
+- reports the number of documents written per second.
+
+The status of an image depends on its age: recent images are mostly
+'new' or in 'review', older ones were mostly 'accepted' or 'deleted'.
+Creation times are spread over the last --days days with fewer images
+at weekends and most images during the day.
+
+Usage:
+    python seeder.py --groups 10000 --images 100 --storage metadata
+    python seeder.py --groups 100 --images 50 --storage local \\
+        --render-processes 4 --upload-threads 16
+    python seeder.py --groups 10 --images 10 --storage s3 --append
+"""
+
+import argparse
+import io
+import math
+import os
+import random
+import sys
+import time
+from collections import Counter
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                wait, FIRST_COMPLETED)
+from datetime import datetime, timedelta
+from pymongo import MongoClient, UpdateOne
+from config import (AWS_SERVICE_NAME,
+                    AWS_ACCESS_KEY_ID,
+                    AWS_SECRET_ACCESS_KEY,
+                    AWS_BUCKET,
+                    AWS_REGION,
+                    MONGODB_URI,
+                    MONGODB_DB_NAME,
+                    MONGODB_IMAGE_COLLECTION_NAME,
+                    MONGODB_GROUPS_COLLECTION_NAME,
+                    MONGODB_COUNTERS_COLLECTION_NAME,
+                    MONGODB_DAILY_STATISTICS_COLLECTION_NAME,
+                    IMAGE_FOLDER_NAME
+                    )
+
+STATUSES = ["new", "review", "accepted", "deleted"]
+# share of the statuses among images older than AGE_SCALE_DAYS
+STATUS_WEIGHTS = {"new": 5, "review": 10, "accepted": 60, "deleted": 25}
+# images younger than this are mostly still 'new' or in 'review'
+AGE_SCALE_DAYS = 7
+WEEKEND_FACTOR = 0.4
+# hours of the day images are collected, mean and standard deviation
+DAY_HOURS = (14, 4)
+GLOBAL_COUNTER_ID = 'global'
+DATA_VERSION_ID = 'data_version'
+
+
+def data_version_update():
+    """
+    Request incrementing the data version of the service, see
+    'models.counters' of the backend.
+    """
+    return UpdateOne({'_id': DATA_VERSION_ID}, {'$inc': {'version': 1}},
+                     upsert=True)
+
+
+class MetadataStorage:
+    """
+    Stores nothing. Images get the URL they would have in the S3 bucket
+    of the configuration (or on example.com if there is none).
+    """
+
+    stores_files = False
+
+    def url(self, key):
+        if AWS_BUCKET:
+            return (f"https://{AWS_BUCKET}.{AWS_SERVICE_NAME}.{AWS_REGION}"
+                    f".amazonaws.com/{key}")
+        return f"https://example.com/{key}"
+
+    def store(self, key, data):
+        return self.url(key)
+
+
+class LocalStorage(MetadataStorage):
+    """
+    Writes the images to a local directory and returns file:// URLs.
+    """
+
+    stores_files = True
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+
+    def url(self, key):
+        return f"file://{self.directory}/{key}"
+
+    def store(self, key, data):
+        path = os.path.join(self.directory, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            file.write(data)
+        return self.url(key)
+
+
+class S3Storage(MetadataStorage):
+    """
+    Uploads the images to the S3 bucket of the configuration. boto3
+    clients are thread safe, the upload threads share one.
+    """
+
+    stores_files = True
+
+    def __init__(self):
+        import boto3
+        self.client = boto3.client(AWS_SERVICE_NAME,
+                                   region_name=AWS_REGION,
+                                   aws_access_key_id=AWS_ACCESS_KEY_ID,
+                                   aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+                                   )
+
+    def store(self, key, data):
+        self.client.put_object(Bucket=AWS_BUCKET, Key=key, Body=data,
+                               ContentType='image/png')
+        return self.url(key)
+
+
+STORAGES = {
+    'metadata': lambda args: MetadataStorage(),
+    'local': lambda args: LocalStorage(args.directory),
+    's3': lambda args: S3Storage(),
+}
+
+
+def image_key(group_number, image_number):
+    """
+    Storage key of an image, the same as in imagecreator.py.
+    """
+    return (f"{IMAGE_FOLDER_NAME or 'output'}/"
+            f"group_{group_number}_image_{image_number}.png")
+
+
+def render_image(numbers):
+    """
+    Render the test image of imagecreator.py as PNG.
+
+    Args:
+        numbers (tuple): (group_number, image_number).
+
+    Returns:
+        bytes: PNG file.
+    """
+    from PIL import Image, ImageDraw
+    group_number, image_number = numbers
+    img = Image.new('RGB', (300, 300))
+    draw = ImageDraw.Draw(img)
+    txt = (f"This is a test image\n"
+           f"Image number: {image_number}\n"
+           f"Group number: {group_number}"
+           )
+    draw.text((100, 100), txt, fill=(255, 255, 255))
+    file = io.BytesIO()
+    img.save(file, format='PNG')
+    return file.getvalue()
+
+
+def random_created_at(rng, now, days):
+    """
+    Creation time within the last days. Weekend days get WEEKEND_FACTOR
+    of the images of a working day, the time of day is normally
+    distributed around DAY_HOURS.
+    """
+    while True:
+        day = now - timedelta(days=rng.randrange(days))
+        if day.weekday() < 5 or rng.random() < WEEKEND_FACTOR:
+            break
+    hours = min(max(rng.gauss(*DAY_HOURS), 0), 23.999)
+    created_at = (day.replace(hour=0, minute=0, second=0, microsecond=0)
+                  + timedelta(hours=hours))
+    return min(created_at, now)
+
+
+def random_status(rng, age_days):
+    """
+    Status of an image of an age: images leave 'new' and 'review' as
+    they get older.
+    """
+    recent = math.exp(-age_days / AGE_SCALE_DAYS)
+    weights = [STATUS_WEIGHTS['new'] + 80 * recent,
+               STATUS_WEIGHTS['review'] + 30 * recent,
+               STATUS_WEIGHTS['accepted'] * (1 - recent),
+               STATUS_WEIGHTS['deleted'] * (1 - recent)]
+    return rng.choices(STATUSES, weights)[0]
+
+
+def generate_images(group_ids, first_group, images, days, rng):
+    """
+    Image documents of groups, without URLs.
+
+    Yields:
+        tuple: (group_number, image_number, document).
+    """
+    now = datetime.utcnow()
+    for offset, group_id in enumerate(group_ids):
+        for image_number in range(images):
+            created_at = random_created_at(rng, now, days)
+            age_days = (now - created_at).total_seconds() / 86400
+            yield first_group + offset, image_number, {
+                'created_at': created_at,
+                'status': random_status(rng, age_days),
+                'group_id': group_id,
+            }
+
+
+def batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Seeder:
+    """
+    Writes groups and images with a bounded number of insert_many calls
+    in flight, and updates the counters of every inserted batch of
+    images.
+    """
+
+    def __init__(self, db, storage, args):
+        self.db = db
+        self.storage = storage
+        self.args = args
+        self.images_collection = db[MONGODB_IMAGE_COLLECTION_NAME]
+        self.groups_collection = db[MONGODB_GROUPS_COLLECTION_NAME]
+        self.counters_collection = db[MONGODB_COUNTERS_COLLECTION_NAME]
+        self.writers = ThreadPoolExecutor(args.writers)
+        self.uploaders = (ThreadPoolExecutor(args.upload_threads)
+                          if storage.stores_files else None)
+        self.renderers = (ProcessPoolExecutor(args.render_processes)
+                          if storage.stores_files and args.render_processes
+                          else None)
+        self.pending = set()
+        self.documents = 0
+        self.started = time.monotonic()
+        self.reported = self.started
+
+    def write(self, collection, documents, counts=None):
+        """
+        Insert documents in a writer thread. Waits while twice as many
+        batches as there are writers are in flight.
+
+        Args:
+            collection (Collection): Collection of the documents.
+            documents (list): The documents.
+            counts (dict, optional): {group id: Counter of statuses} of
+                the images, added to the counters once they are
+                inserted.
+        """
+        while len(self.pending) >= 2 * self.args.writers:
+            done, self.pending = wait(self.pending,
+                                      return_when=FIRST_COMPLETED)
+            for future in done:
+                self.documents += len(future.result().inserted_ids)
+            self.report()
+        self.pending.add(self.writers.submit(self.insert, collection,
+                                             documents, counts))
+
+    def insert(self, collection, documents, counts):
+        # the counters of a batch are updated only after it is inserted,
+        # a failed batch changes neither
+        result = collection.insert_many(documents, ordered=False)
+        if counts:
+            self.write_counters(counts)
+        return result
+
+    def flush(self):
+        for future in self.pending:
+            self.documents += len(future.result().inserted_ids)
+        self.pending = set()
+
+    def report(self, final=False):
+        now = time.monotonic()
+        if final or now - self.reported >= 5:
+            self.reported = now
+            elapsed = now - self.started
+            print(f"{self.documents} documents in {elapsed:.1f} s, "
+                  f"{self.documents / elapsed:.0f} docs/s", file=sys.stderr)
+
+    def add_urls(self, batch):
+        """
+        Set the URLs of a batch of images, rendering and storing the
+        image files if the storage keeps them.
+        """
+        keys = [image_key(group_number, image_number)
+                for group_number, image_number, _ in batch]
+        if not self.storage.stores_files:
+            urls = [self.storage.url(key) for key in keys]
+        else:
+            numbers = [(group_number, image_number)
+                       for group_number, image_number, _ in batch]
+            if self.renderers:
+                files = self.renderers.map(render_image, numbers,
+                                           chunksize=64)
+            else:
+                files = map(render_image, numbers)
+            urls = list(self.uploaders.map(self.storage.store, keys, files))
+        for (_, _, image), url in zip(batch, urls):
+            image['url'] = url
+
+    def seed(self, rng):
+        """
+        Write args.groups groups of args.images images each.
+        """
+        args = self.args
+        first_group = self.groups_collection.estimated_document_count()
+        for group_numbers in batches(range(args.groups), args.batch_size):
+            groups = [{'name': f"Group {first_group + number}"}
+                      for number in group_numbers]
+            group_ids = self.groups_collection.insert_many(
+                groups, ordered=False).inserted_ids
+            self.documents += len(group_ids)
+            images = generate_images(group_ids,
+                                     first_group + group_numbers[0],
+                                     args.images, args.days, rng)
+            for batch in batches(images, args.batch_size):
+                self.add_urls(batch)
+                counts = {}
+                for _, _, image in batch:
+                    counts.setdefault(image['group_id'],
+                                      Counter())[image['status']] += 1
+                self.write(self.images_collection,
+                           [image for _, _, image in batch], counts)
+        self.flush()
+        self.report(final=True)
+
+    def write_counters(self, counts):
+        """
+        Add the counts of inserted images to the counters, one update per
+        group plus the global counter and the data version.
+
+        Args:
+            counts (dict): {group id: Counter of statuses}.
+        """
+        total = Counter()
+        requests = []
+        for group_id, group_counts in counts.items():
+            total.update(group_counts)
+            requests.append(self.counter_update(group_id, group_counts))
+        requests.append(self.counter_update(GLOBAL_COUNTER_ID, total))
+        requests.append(data_version_update())
+        self.counters_collection.bulk_write(requests, ordered=False)
+
+    @staticmethod
+    def counter_update(counter_id, counts):
+        return UpdateOne({'_id': counter_id},
+                         {'$inc': {f"counts.{status}": number
+                                   for status, number in counts.items()}},
+                         upsert=True)
+
+    def close(self):
+        self.writers.shutdown()
+        if self.uploaders:
+            self.uploaders.shutdown()
+        if self.renderers:
+            self.renderers.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--groups', type=int, default=10)
+    parser.add_argument('--images', type=int, default=10,
+                        help="images per group")
+    parser.add_argument('--days', type=int, default=90,
+                        help="images are created over this many days")
+    parser.add_argument('--storage', choices=list(STORAGES),
+                        default='metadata')
+    parser.add_argument('--directory', default=IMAGE_FOLDER_NAME or 'output',
+                        help="directory of the local storage")
+    parser.add_argument('--render-processes', type=int,
+                        default=os.cpu_count(),
+                        help="processes rendering images, 0 renders in "
+                             "the main process")
+    parser.add_argument('--upload-threads', type=int, default=16)
+    parser.add_argument('--writers', type=int, default=4,
+                        help="threads running insert_many")
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--append', action='store_true',
+                        help="keep the existing groups and images")
+    parser.add_argument('--seed', type=int, default=None,
+                        help="seed of the random data")
+    args = parser.parse_args()
+
+    client = MongoClient(MONGODB_URI)
+    db = client[MONGODB_DB_NAME]
+    counters_collection = db[MONGODB_COUNTERS_COLLECTION_NAME]
+    if not args.append:
+        for name in (MONGODB_IMAGE_COLLECTION_NAME,
+                     MONGODB_GROUPS_COLLECTION_NAME):
+            db[name].delete_many({})
+        # the data version keeps counting, so ETags of the old data never
+        # match the new data
+        counters_collection.delete_many({'_id': {'$ne': DATA_VERSION_ID}})
+        counters_collection.bulk_write([data_version_update()])
+
+    seeder = Seeder(db, STORAGES[args.storage](args), args)
+    try:
+        seeder.seed(random.Random(args.seed))
+    except BaseException:
+        # the counters of the batches that failed or were not written
+        # yet are missing
+        print("Seeding failed, the counters may not match the images. "
+              "Rebuild them in the backend directory with:\n"
+              "    flask --app run rebuild-counters", file=sys.stderr)
+        raise
+    else:
+        if not args.append:
+            # reset after seeding, days sealed by the service while the
+            # images were written would keep partial counts
+            db[MONGODB_DAILY_STATISTICS_COLLECTION_NAME].delete_many({})
+    finally:
+        seeder.close()
+        client.close()
+    print(f"{args.groups} groups with {args.images} images each were "
+          f"created. The seeded images are not in the daily statistics, "
+          f"roll the days up in the backend directory with:\n"
+          f"    flask --app run rebuild-statistics", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()